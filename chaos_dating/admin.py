@@ -6,6 +6,9 @@ from chaos_dating.models import Profile, Pronoun
 from chaos_dating.models import Gender
 from chaos_dating.models import Interest
 from chaos_dating.models import Wish
+from chaos_dating.models import HiddenProfile
+from chaos_dating.models import Recommendation
+from chaos_dating.models import SavedSearch
 
 # Register your models here.
 admin.site.unregister(User)
@@ -27,3 +30,26 @@ admin.site.register(Profile)
 admin.site.register(Gender)
 admin.site.register(Interest)
 admin.site.register(Wish)
+
+
+class RecommendationAdmin(admin.ModelAdmin):
+    raw_id_fields = ('profile', 'recommended')
+
+
+admin.site.register(Recommendation, RecommendationAdmin)
+
+
+class SavedSearchAdmin(admin.ModelAdmin):
+    raw_id_fields = ('user',)
+    list_display = ('name', 'user', 'last_seq', 'evaluated_at')
+
+
+admin.site.register(SavedSearch, SavedSearchAdmin)
+
+
+class HiddenProfileAdmin(admin.ModelAdmin):
+    raw_id_fields = ('user', 'profile')
+    list_display = ('user', 'profile', 'blocked', 'created_at')
+
+
+admin.site.register(HiddenProfile, HiddenProfileAdmin)
@@ -5,3 +5,6 @@ from django.apps import AppConfig
 class ChaosDatingConfig(AppConfig):
     name = 'chaos_dating'
     verbose_name = 'Dating app for Chaos environment'
+
+    def ready(self):
+        from chaos_dating import signals  # noqa: F401
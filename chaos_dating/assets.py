@@ -0,0 +1,223 @@
+# coding=utf-8
+"""
+Fingerprinted, precompressed static files served by the app itself.
+
+``collectstatic`` copies the static files into ``settings.STATIC_ROOT`` through
+``CompressedManifestStaticFilesStorage``, which adds the hash of their content to the file
+names and writes gzip and, if the ``brotli`` package is installed, brotli compressed variants
+next to them. ``StaticFilesMiddleware`` serves these files without running the rest of the
+middleware; fingerprinted files never change and are cached by browsers for a year.
+"""
+import gzip
+import json
+import mimetypes
+import os
+from typing import Dict
+from typing import Iterable
+from typing import NamedTuple
+from typing import Optional
+from typing import Set
+from urllib.parse import unquote
+from urllib.parse import urlsplit
+
+from asgiref.sync import iscoroutinefunction
+from asgiref.sync import markcoroutinefunction
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from django.http import HttpResponseNotAllowed
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSED_EXTENSIONS = ('.css', '.js', '.map', '.json', '.svg', '.txt', '.html', '.xml', '.ico', '.ttf', '.otf',
+                         '.eot')
+# smaller files do not get smaller enough to outweigh the extra lookup
+MIN_COMPRESSED_SIZE = 256
+# variants in the order they are preferred, with the suffix of their files
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+
+
+def _compress(data: bytes) -> Dict[str, bytes]:
+    variants = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data, quality=11)
+    return variants
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Manifest storage writing compressed variants of the collected files.
+
+    Files that were not collected, e.g. ``vendor/`` without ``npm run build:vendor``, are linked
+    under their plain name instead of failing the page; base.html falls back to other copies.
+    """
+    manifest_strict = False
+
+    def stored_name(self, name):
+        path = urlsplit(unquote(name)).path.strip()
+        if self.hash_key(path) not in self.hashed_files and not self.exists(path):
+            return name
+        return super().stored_name(name)
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+
+        names = set(paths) | set(self.hashed_files.values())
+        for name in sorted(names):
+            if name.endswith(COMPRESSED_EXTENSIONS) and self.exists(name):
+                self._write_variants(name)
+
+    def _write_variants(self, name: str):
+        path = self.path(name)
+        with open(path, 'rb') as file:
+            data = file.read()
+        if len(data) < MIN_COMPRESSED_SIZE:
+            return
+
+        variants = _compress(data)
+        for encoding, suffix in ENCODINGS:
+            # the variant of an earlier collectstatic must not outlive a changed original
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+            if encoding in variants and len(variants[encoding]) < len(data) * 0.95:
+                with open(path + suffix, 'wb') as file:
+                    file.write(variants[encoding])
+
+
+class Asset(NamedTuple):
+    path: str
+    content_type: str
+    size: int
+    modified: float
+    immutable: bool
+    # the files of the compressed variants by encoding
+    variants: Dict[str, str]
+
+
+def find_assets(root: str, hashed_names: Set[str]) -> Dict[str, Asset]:
+    """
+    Returns the files below the root by their name relative to it.
+    """
+    assets = {}
+    suffixes = tuple(suffix for encoding, suffix in ENCODINGS)
+    for directory, subdirectories, files in os.walk(root):
+        for filename in files:
+            if filename.endswith(suffixes):
+                continue
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, root).replace(os.sep, '/')
+            content_type, encoding = mimetypes.guess_type(filename)
+            if content_type is not None and content_type.startswith('text/'):
+                content_type += '; charset=utf-8'
+            stat = os.stat(path)
+            assets[name] = Asset(
+                path=path,
+                content_type=content_type or 'application/octet-stream',
+                size=stat.st_size,
+                modified=stat.st_mtime,
+                immutable=name in hashed_names,
+                variants={encoding: path + suffix for encoding, suffix in ENCODINGS if os.path.exists(path + suffix)},
+            )
+
+    return assets
+
+
+def _accepted_encodings(header: str) -> Set[str]:
+    encodings = set()
+    for value in header.split(','):
+        encoding, _separator, parameters = value.partition(';')
+        name, _separator, quality = parameters.strip().partition('=')
+        try:
+            if name == 'q' and float(quality) == 0:
+                continue
+        except ValueError:
+            continue
+        encodings.add(encoding.strip().lower())
+    return encodings
+
+
+def _variant(asset: Asset, accepted: Iterable[str]) -> Optional[str]:
+    accepted = set(accepted)
+    for encoding, suffix in ENCODINGS:
+        if encoding in asset.variants and (encoding in accepted or '*' in accepted):
+            return encoding
+    return None
+
+
+class StaticFilesMiddleware:
+    """
+    Serves the files collected into ``settings.STATIC_ROOT``; belongs right after
+    ``SecurityMiddleware`` in ``settings.MIDDLEWARE``.
+
+    The files are listed once when the process starts, so it has to be restarted after
+    ``collectstatic``. Without a collected manifest the middleware is not used.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+        manifest = os.path.join(settings.STATIC_ROOT or '', CompressedManifestStaticFilesStorage.manifest_name)
+        if not settings.STATIC_ROOT or not settings.STATIC_URL.startswith('/') or not os.path.exists(manifest):
+            raise MiddlewareNotUsed()
+
+        with open(manifest) as file:
+            hashed_names = set(json.load(file)['paths'].values())
+        self.prefix = settings.STATIC_URL
+        self.assets = find_assets(settings.STATIC_ROOT, hashed_names)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self._acall(request)
+
+        asset = self._asset(request)
+        if asset is None:
+            return self.get_response(request)
+        return self._response(request, asset)
+
+    async def _acall(self, request):
+        asset = self._asset(request)
+        if asset is None:
+            return await self.get_response(request)
+        return await sync_to_async(self._response, thread_sensitive=False)(request, asset)
+
+    def _asset(self, request) -> Optional[Asset]:
+        if not request.path_info.startswith(self.prefix):
+            return None
+        return self.assets.get(request.path_info[len(self.prefix):])
+
+    def _response(self, request, asset: Asset) -> HttpResponse:
+        if request.method not in ('GET', 'HEAD'):
+            return HttpResponseNotAllowed(['GET', 'HEAD'])
+
+        encoding = _variant(asset, _accepted_encodings(request.headers.get('Accept-Encoding', '')))
+        etag = f'"{int(asset.modified):x}-{asset.size:x}{"-" + encoding if encoding else ""}"'
+        response = get_conditional_response(request, etag=etag, last_modified=int(asset.modified))
+        if response is None:
+            with open(asset.variants[encoding] if encoding else asset.path, 'rb') as file:
+                response = HttpResponse(file.read(), content_type=asset.content_type)
+            if encoding:
+                response['Content-Encoding'] = encoding
+
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(int(asset.modified))
+        if asset.variants:
+            response['Vary'] = 'Accept-Encoding'
+        if asset.immutable:
+            response['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+        else:
+            response['Cache-Control'] = f'public, max-age={settings.STATIC_MAX_AGE}'
+        return response
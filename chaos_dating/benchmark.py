@@ -0,0 +1,331 @@
+# coding=utf-8
+"""
+Benchmarks of the listing, filter and profile endpoints.
+
+Every scenario is requested repeatedly through the Django test client, both with cold
+result and card caches and with warm ones. For each request the latency, the number and
+total time of the SQL queries and the time spent rendering templates are recorded, and
+summarized as percentiles. Results are plain dictionaries, so they can be stored as JSON
+and compared against a baseline with ``compare()``.
+
+``throughput()`` measures how many concurrent requests per second the sync views behind the
+WSGI handler and the async views behind the ASGI handler serve.
+"""
+import asyncio
+import importlib
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+import numpy as np
+from asgiref.sync import ThreadSensitiveContext
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db import connections
+from django.db.models import Count
+from django.template import base
+from django.test import AsyncClient
+from django.test import Client
+from django.test import override_settings
+from django.urls import clear_url_caches
+from django.urls import reverse
+
+from chaos_dating import caching
+from chaos_dating import listing
+from chaos_dating import models
+from chaos_dating import vocabulary
+from chaos_dating.cards import VOCABULARY_VERSION_KEY
+
+# timings compared against the baseline with a threshold and the differences below which they are noise
+COMPARED_TIMINGS = {'p50_ms': 2.0, 'p95_ms': 5.0}
+# counts that must not grow at all
+COMPARED_COUNTS = ('queries', 'errors')
+# the scenarios served by views with an async version
+THROUGHPUT_SCENARIOS = ('index', 'filter_all', 'filter_combined', 'profile')
+
+
+class Scenario(NamedTuple):
+    name: str
+    url: str
+    data: dict
+
+
+class Sample(NamedTuple):
+    status: int
+    latency: float
+    queries: int
+    sql_time: float
+    render_time: float
+
+
+def scenarios(client: Client) -> List[Scenario]:
+    """
+    Returns representative requests for the profiles in the database.
+    """
+    genders = list(models.Gender.objects.order_by('pk').values_list('pk', flat=True)[:2])
+    through = models.Profile.wishes.through.objects
+    wishes = [row['wish_id'] for row in through.values('wish_id').annotate(count=Count('profile_id'))
+              .order_by('-count')[:2]]
+    username = models.Profile.objects.order_by('pk').values_list('username', flat=True).first()
+    filter_url = reverse('chaos_dating:filterREST')
+    combined = {'gender': genders[:1], 'wishes': wishes, 'min_age': 20, 'max_age': 40,
+                'order_by': 'age', 'order_direction': '-'}
+    return [
+        Scenario('index', reverse('chaos_dating:index'), {}),
+        Scenario('filter_all', filter_url, {}),
+        Scenario('filter_age', filter_url, {'min_age': 25, 'max_age': 35}),
+        Scenario('filter_gender', filter_url, {'gender': genders}),
+        Scenario('filter_wishes', filter_url, {'wishes': wishes}),
+        Scenario('filter_combined', filter_url, combined),
+        Scenario('filter_page_5', filter_url, dict(combined, cursor=_cursor(client, filter_url, combined, 4))),
+        Scenario('filter_best_match', filter_url, {'order_by': 'match'}),
+        Scenario('filter_best_match_page_5', filter_url,
+                 {'order_by': 'match', 'cursor': _cursor(client, filter_url, {'order_by': 'match'}, 4)}),
+        Scenario('profiles_api', reverse('chaos_dating:profilesAPI'), {'min_age': 25}),
+        Scenario('profile', reverse('chaos_dating:profile', kwargs={'username': username or '-'}), {}),
+    ]
+
+
+def _cursor(client: Client, url: str, data: dict, pages: int) -> str:
+    # the cursor of a page deep into the results
+    cursor = ''
+    for _ in range(pages):
+        response = client.get(url, dict(data, cursor=cursor), secure=True)
+        if response.status_code != 200 or not response.json()['next_cursor']:
+            break
+        cursor = response.json()['next_cursor']
+    return cursor
+
+
+@contextmanager
+def _timed_queries(sample: dict) -> Iterator[None]:
+    def execute(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            sample['queries'] += 1
+            sample['sql_time'] += time.perf_counter() - start
+
+    with connection.execute_wrapper(execute):
+        yield
+
+
+@contextmanager
+def _timed_templates(sample: dict) -> Iterator[None]:
+    # included and extended templates render inside their parents, only the outermost ones are timed
+    render = base.Template.render
+    depth = [0]
+
+    def timed_render(template, context):
+        depth[0] += 1
+        start = time.perf_counter()
+        try:
+            return render(template, context)
+        finally:
+            depth[0] -= 1
+            if depth[0] == 0:
+                sample['render_time'] += time.perf_counter() - start
+
+    base.Template.render = timed_render
+    try:
+        yield
+    finally:
+        base.Template.render = render
+
+
+def _cool_down():
+    # empties the result and card caches, the index and the vocabulary stay loaded like in a running process
+    listing.clear_results()
+    caching.bump(VOCABULARY_VERSION_KEY)
+    vocabulary.reset()
+    vocabulary.get_vocabulary()
+
+
+def request(client: Client, scenario: Scenario) -> Sample:
+    sample = {'queries': 0, 'sql_time': 0.0, 'render_time': 0.0}
+    with _timed_queries(sample), _timed_templates(sample):
+        start = time.perf_counter()
+        try:
+            status = client.get(scenario.url, scenario.data, secure=True).status_code
+        except Exception:
+            status = 500
+        latency = time.perf_counter() - start
+
+    return Sample(status, latency, sample['queries'], sample['sql_time'], sample['render_time'])
+
+
+def summarize(samples: List[Sample]) -> dict:
+    latencies = np.array([sample.latency for sample in samples]) * 1000
+    return {
+        'requests':  len(samples),
+        'errors':    sum(sample.status >= 400 for sample in samples),
+        'p50_ms':    round(float(np.percentile(latencies, 50)), 3),
+        'p95_ms':    round(float(np.percentile(latencies, 95)), 3),
+        'p99_ms':    round(float(np.percentile(latencies, 99)), 3),
+        'queries':   int(np.median([sample.queries for sample in samples])),
+        'sql_ms':    round(float(np.median([sample.sql_time for sample in samples])) * 1000, 3),
+        'render_ms': round(float(np.median([sample.render_time for sample in samples])) * 1000, 3),
+    }
+
+
+def run(client: Client, repeat: int, only: Optional[List[str]] = None) -> Dict[str, dict]:
+    """
+    Returns the summaries of every scenario with cold and with warm caches by ``<scenario>:<cold|warm>``.
+
+    The client has to be logged in as a user with a profile.
+    """
+    results = {}
+    for scenario in scenarios(client):
+        if only and scenario.name not in only:
+            continue
+
+        cold = []
+        for _ in range(repeat):
+            _cool_down()
+            cold.append(request(client, scenario))
+        results[f'{scenario.name}:cold'] = summarize(cold)
+
+        request(client, scenario)
+        results[f'{scenario.name}:warm'] = summarize([request(client, scenario) for _ in range(repeat)])
+
+    return results
+
+
+def compare(results: Dict[str, Dict[str, dict]], baseline: Dict[str, Dict[str, dict]],
+            threshold: float) -> List[str]:
+    """
+    Returns a description of every timing that got worse than the baseline by more than the
+    threshold, and of every query or error count that grew at all.
+
+    Both arguments map database sizes to the results of ``run()``; sizes and scenarios missing
+    from either side are skipped.
+    """
+    regressions = []
+    for size, summaries in results.items():
+        for key, summary in summaries.items():
+            expected = baseline.get(size, {}).get(key)
+            if expected is None:
+                continue
+            limits = {metric: max(expected[metric] * (1 + threshold), expected[metric] + noise)
+                      for metric, noise in COMPARED_TIMINGS.items() if metric in expected}
+            limits.update((metric, expected[metric]) for metric in COMPARED_COUNTS if metric in expected)
+            for metric, limit in limits.items():
+                if summary[metric] > limit:
+                    regressions.append(f'{size} profiles, {key}: {metric} {summary[metric]} '
+                                       f'exceeds baseline {expected[metric]}')
+
+    return regressions
+
+
+@contextmanager
+def async_views(enabled: bool) -> Iterator[None]:
+    """
+    Serves the async or the sync versions of the read views within the block.
+    """
+    try:
+        with override_settings(ASYNC_VIEWS=enabled):
+            _reload_urls()
+            yield
+    finally:
+        _reload_urls()
+
+
+def _reload_urls():
+    # the views are chosen when the URLconfs are imported
+    for name in ('chaos_dating.urls', settings.ROOT_URLCONF):
+        if name in sys.modules:
+            importlib.reload(sys.modules[name])
+    clear_url_caches()
+
+
+def _wsgi_worker(client: Client, scenario: Scenario, count: int, start: threading.Barrier, statuses: list):
+    try:
+        client.get(scenario.url, scenario.data, secure=True)
+        start.wait()
+        for _ in range(count):
+            statuses.append(client.get(scenario.url, scenario.data, secure=True).status_code)
+    finally:
+        connections.close_all()
+
+
+def _wsgi_run(clients: List[Client], scenario: Scenario, count: int) -> tuple:
+    statuses = []
+    start = threading.Barrier(len(clients) + 1)
+    threads = [threading.Thread(target=_wsgi_worker, args=(client, scenario, count, start, statuses))
+               for client in clients]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+
+    return time.perf_counter() - started, statuses
+
+
+async def _asgi_request(client: AsyncClient, scenario: Scenario) -> int:
+    # like ASGIHandler, every request gets its own thread for the sync code it runs
+    async with ThreadSensitiveContext():
+        response = await client.get(scenario.url, scenario.data, secure=True)
+    return response.status_code
+
+
+async def _asgi_run(clients: List[AsyncClient], scenario: Scenario, count: int) -> tuple:
+    async def worker(client: AsyncClient) -> List[int]:
+        return [await _asgi_request(client, scenario) for _ in range(count)]
+
+    await asyncio.gather(*(_asgi_request(client, scenario) for client in clients))
+    started = time.perf_counter()
+    statuses = await asyncio.gather(*(worker(client) for client in clients))
+    return time.perf_counter() - started, [status for worker_statuses in statuses for status in worker_statuses]
+
+
+def throughput(user: User, scenario: Scenario, handler: str, concurrency: int, count: int) -> dict:
+    """
+    Returns the requests per second of concurrency clients each requesting the scenario count times.
+
+    The ``wsgi`` handler serves the sync views with one thread per client, the ``asgi`` handler
+    the async views with one task per client on an event loop.
+    """
+    with async_views(handler == 'asgi'):
+        client_class = AsyncClient if handler == 'asgi' else Client
+        clients = [client_class(raise_request_exception=False) for _ in range(concurrency)]
+        for client in clients:
+            client.force_login(user)
+        if handler == 'asgi':
+            seconds, statuses = asyncio.run(_asgi_run(clients, scenario, count))
+        else:
+            seconds, statuses = _wsgi_run(clients, scenario, count)
+
+    return {
+        'concurrency':     concurrency,
+        'requests':        len(statuses),
+        'errors':          sum(status >= 400 for status in statuses),
+        'seconds':         round(seconds, 3),
+        'requests_per_s':  round(len(statuses) / seconds, 1),
+    }
+
+
+def run_throughput(client: Client, user: User, concurrencies: List[int], count: int,
+                   only: Optional[List[str]] = None) -> Dict[str, dict]:
+    """
+    Returns the throughput of every scenario with an async view by ``<scenario>:<handler>:<concurrency>``.
+    """
+    results = {}
+    for scenario in scenarios(client):
+        if scenario.name not in THROUGHPUT_SCENARIOS or (only and scenario.name not in only):
+            continue
+        for concurrency in concurrencies:
+            for handler in ('wsgi', 'asgi'):
+                results[f'{scenario.name}:{handler}:{concurrency}'] = throughput(user, scenario, handler,
+                                                                                  concurrency, count)
+
+    return results
@@ -0,0 +1,165 @@
+# coding=utf-8
+"""
+Bulk creation and streaming export of profiles for the data management commands.
+
+Profiles are written with ``bulk_create`` in batches together with their search rows and
+facet counts, bypassing the model signals, so ``invalidate()`` has to be called once all
+batches are written. Exports read the profiles in keyset-paginated batches, so memory use
+does not grow with the number of profiles.
+"""
+from collections import Counter
+from itertools import chain
+from typing import Dict
+from typing import FrozenSet
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db import transaction
+
+from chaos_dating import facets
+from chaos_dating import listing
+from chaos_dating import models
+from chaos_dating import profile_index
+from chaos_dating import search
+from chaos_dating.vocabulary import get_vocabulary
+from chaos_dating.vocabulary import resolve
+
+
+class ProfileRow(NamedTuple):
+    username: str
+    age: int
+    gender_id: Optional[int]
+    pronoun_id: Optional[int]
+    wish_ids: FrozenSet[int]
+
+
+def create_profiles(rows: Iterable[ProfileRow]) -> Tuple[int, int]:
+    """
+    Creates one batch of users and profiles with their wishes and skips existing usernames.
+
+    Returns the numbers of created and skipped profiles. The users cannot log in until they
+    set a password.
+    """
+    rows = list(rows)
+    existing = set(User.objects.filter(username__in=[row.username for row in rows])
+                   .values_list('username', flat=True))
+    rows = [row for row in rows if row.username not in existing]
+    if not rows:
+        return 0, len(existing)
+
+    # hashing a password per user would take longer than everything else together
+    password = make_password(None)
+    with transaction.atomic():
+        users = User.objects.bulk_create([User(username=row.username, password=password) for row in rows])
+        user_ids = _ids(users, User, 'username', [row.username for row in rows])
+        profiles = models.Profile.objects.bulk_create([
+            models.Profile(user_id=user_id, username=row.username, age=row.age, gender_id=row.gender_id,
+                           pronoun_id=row.pronoun_id)
+            for user_id, row in zip(user_ids, rows)
+        ])
+        profile_ids = _ids(profiles, models.Profile, 'user_id', user_ids)
+        _insert(models.Profile.wishes.through, ('profile_id', 'wish_id'),
+                [(profile_id, wish_id) for profile_id, row in zip(profile_ids, rows) for wish_id in row.wish_ids])
+        search.refresh(profile_ids)
+        profile_index.log_changes(profile_ids)
+        facets.apply(Counter(chain.from_iterable(facets.profile_facets(row.gender_id, row.age, row.wish_ids)
+                                                 for row in rows)))
+
+    return len(rows), len(existing)
+
+
+def _ids(instances: List, model: type, field: str, values: List) -> List[int]:
+    # databases without RETURNING leave the primary keys of bulk created rows empty
+    if all(instance.pk is not None for instance in instances):
+        return [instance.pk for instance in instances]
+
+    ids = dict(model.objects.filter(**{f'{field}__in': values}).values_list(field, 'id'))
+    return [ids[value] for value in values]
+
+
+def _insert(model: type, columns: Tuple[str, ...], values: List[tuple]):
+    # the through table has several rows per profile, model instances would cost more than the insert itself
+    quote = connection.ops.quote_name
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(quote(model._meta.db_table), ', '.join(map(quote, columns)),
+                                                   ', '.join(['%s'] * len(columns)))
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, values)
+
+
+def invalidate():
+    """
+    Makes every process pick up profiles written in bulk.
+    """
+    # the profile indexes catch up with the logged changes, or rebuild if there are too many
+    listing.bump_data_version()
+
+
+class WishResolver:
+    """
+    Resolves wishes given by interest and gender names and creates the missing ones.
+    """
+
+    def __init__(self):
+        self._wishes: Dict[Tuple[int, Optional[int]], int] = {
+            (wish.interest_id, wish.gender_id): wish.pk for wish in get_vocabulary().all(models.Wish)
+        }
+
+    def resolve(self, interest: str, gender: Optional[str]) -> Optional[int]:
+        interest_id = resolve(models.Interest, interest)
+        if interest_id is None:
+            return None
+        gender_id = resolve(models.Gender, gender) if gender else None
+        key = (interest_id, gender_id)
+        if key not in self._wishes:
+            wish, created = models.Wish.objects.get_or_create(interest_id=interest_id, gender_id=gender_id)
+            self._wishes[key] = wish.pk
+
+        return self._wishes[key]
+
+
+def export_profiles(batch_size: int = 10000) -> Iterator[dict]:
+    """
+    Yields every profile as a dictionary of plain values ordered by id.
+
+    Genders, pronouns and interests are exported by name, so the records can be imported
+    into another database with ``import_profiles``.
+    """
+    last_id = 0
+    while True:
+        profiles = list(models.Profile.objects.order_by('id').filter(id__gt=last_id)
+                        .values_list('id', 'username', 'age', 'gender_id', 'pronoun_id')[:batch_size])
+        if not profiles:
+            return
+
+        # the translated name attributes are slow, the labels of the vocabulary are computed once
+        vocabulary = get_vocabulary()
+        genders = vocabulary.labels(models.Gender)
+        pronouns = vocabulary.labels(models.Pronoun)
+        interests = vocabulary.labels(models.Interest)
+        wishes = {}
+        through = models.Profile.wishes.through.objects.order_by('wish_id') \
+            .filter(profile_id__gt=last_id, profile_id__lte=profiles[-1][0])
+        for profile_id, wish_id in through.values_list('profile_id', 'wish_id'):
+            wish = vocabulary.get(models.Wish, wish_id)
+            if wish is not None:
+                wishes.setdefault(profile_id, []).append({
+                    'interest': interests.get(wish.interest_id),
+                    'gender':   genders.get(wish.gender_id),
+                })
+
+        for pk, username, age, gender_id, pronoun_id in profiles:
+            yield {
+                'username': username,
+                'age':      age,
+                'gender':   genders.get(gender_id),
+                'pronoun':  pronouns.get(pronoun_id),
+                'wishes':   wishes.get(pk, []),
+            }
+        last_id = profiles[-1][0]
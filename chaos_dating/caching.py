@@ -0,0 +1,141 @@
+# coding=utf-8
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+from typing import Dict
+from typing import Hashable
+from typing import Iterable
+from typing import List
+
+from asgiref.sync import sync_to_async
+from django.core.cache import DEFAULT_CACHE_ALIAS
+from django.core.cache import cache
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+
+def cache_key(*parts: Any) -> str:
+    """
+    Returns the cache key of this app made of the given parts.
+
+    The cache adds ``KEY_PREFIX`` and ``VERSION`` of ``settings.CACHES``; raising the version
+    drops every entry at once, e.g. when a release changes what is cached.
+    """
+    return ':'.join(map(str, ('chaos_dating', *parts)))
+
+
+def version(key: str) -> int:
+    """
+    Returns the current value of the version counter stored under the key.
+    """
+    return versions([key])[key]
+
+
+def versions(keys: Iterable[str]) -> Dict[str, int]:
+    """
+    Returns the current values of the version counters stored under the keys.
+    """
+    keys = list(keys)
+    values = cache.get_many(keys)
+    if len(values) < len(keys):
+        values.update(_start([key for key in keys if key not in values]))
+    return values
+
+
+async def aversions(keys: Iterable[str]) -> Dict[str, int]:
+    keys = list(keys)
+    values = await aget_many(keys)
+    if len(values) < len(keys):
+        missing = [key for key in keys if key not in values]
+        values.update(await sync_to_async(_start)(missing) if _blocks() else _start(missing))
+    return values
+
+
+def _start(keys: List[str]) -> Dict[str, int]:
+    # counters start at the clock in microseconds rather than zero, so a counter evicted by
+    # the cache never returns to a version whose entries may still be cached
+    start = time.time_ns() // 1000
+    for key in keys:
+        cache.add(key, start, timeout=None)
+    values = cache.get_many(keys)
+    return {key: values.get(key, start) for key in keys}
+
+
+def bump(key: str) -> int:
+    """
+    Increments the version counter stored under the key and returns the new value.
+    """
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # the counter is missing or was evicted between _start and incr
+        _start([key])
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # evicted right away again
+            value = time.time_ns() // 1000
+            cache.set(key, value, timeout=None)
+            return value
+
+
+def _blocks() -> bool:
+    # process-local caches never wait for I/O and can be used on the event loop
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], (LocMemCache, DummyCache))
+
+
+async def aget_many(keys: Iterable[str]) -> Dict[str, Any]:
+    """
+    Async ``cache.get_many()``; caches on other servers are read in one thread hop for all keys.
+    """
+    if _blocks():
+        return await sync_to_async(cache.get_many)(list(keys))
+    return cache.get_many(keys)
+
+
+async def aset_many(values: Dict[str, Any], timeout: float):
+    if _blocks():
+        await sync_to_async(cache.set_many)(values, timeout)
+    else:
+        cache.set_many(values, timeout)
+
+
+class LRUCache:
+    """
+    Process-local cache evicting the least recently used entries beyond max_size.
+
+    Entries additionally expire timeout seconds after they were set.
+    """
+    def __init__(self, max_size: int, timeout: float):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,92 @@
+# coding=utf-8
+"""
+Cache of the rendered profile cards shown in profile lists.
+
+Cards are cached per profile, language, profile version and vocabulary version. The
+signal handlers in ``chaos_dating.signals`` bump the profile version when a profile, its
+user or its wishes change and the vocabulary version when a gender, pronoun, interest or
+wish changes, so outdated cards are never looked up again and simply expire.
+"""
+from typing import Dict
+from typing import Iterable
+from typing import List
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import SafeString
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
+
+from chaos_dating import caching
+from chaos_dating.db_routing import primary
+from chaos_dating.listing import profile_listing
+
+VOCABULARY_VERSION_KEY = caching.cache_key('vocabulary', 'version')
+
+
+def profile_version_key(pk: int) -> str:
+    return caching.cache_key('profile', pk, 'version')
+
+
+def bump_profile_version(pk: int) -> int:
+    return caching.bump(profile_version_key(pk))
+
+
+def bump_vocabulary_version() -> int:
+    return caching.bump(VOCABULARY_VERSION_KEY)
+
+
+def render_cards(profile_ids: Iterable[int]) -> List[SafeString]:
+    """
+    Returns the rendered cards of the given profiles in the given order.
+
+    Only the profiles whose card is not cached are loaded from the database.
+    """
+    profile_ids = list(profile_ids)
+    keys = _card_keys(profile_ids, caching.versions(_version_keys(profile_ids)))
+    cards = cache.get_many(keys.values())
+
+    missing = [pk for pk in profile_ids if keys[pk] not in cards]
+    if missing:
+        rendered = _render_cards(missing, keys)
+        cache.set_many(rendered, settings.PROFILE_CARD_TIMEOUT)
+        cards.update(rendered)
+
+    return [mark_safe(cards[keys[pk]]) for pk in profile_ids if keys[pk] in cards]
+
+
+async def arender_cards(profile_ids: Iterable[int]) -> List[SafeString]:
+    """
+    Async version of ``render_cards()``; only cards missing from the cache are rendered in a thread.
+    """
+    profile_ids = list(profile_ids)
+    keys = _card_keys(profile_ids, await caching.aversions(_version_keys(profile_ids)))
+    cards = await caching.aget_many(keys.values())
+
+    missing = [pk for pk in profile_ids if keys[pk] not in cards]
+    if missing:
+        rendered = await sync_to_async(_render_cards)(missing, keys)
+        await caching.aset_many(rendered, settings.PROFILE_CARD_TIMEOUT)
+        cards.update(rendered)
+
+    return [mark_safe(cards[keys[pk]]) for pk in profile_ids if keys[pk] in cards]
+
+
+def _version_keys(profile_ids: List[int]) -> List[str]:
+    return [profile_version_key(pk) for pk in profile_ids] + [VOCABULARY_VERSION_KEY]
+
+
+def _card_keys(profile_ids: List[int], versions: dict) -> Dict[int, str]:
+    language = get_language()
+    vocabulary_version = versions[VOCABULARY_VERSION_KEY]
+    return {pk: caching.cache_key('card', pk, language, versions[profile_version_key(pk)], vocabulary_version)
+            for pk in profile_ids}
+
+
+def _render_cards(profile_ids: List[int], keys: Dict[int, str]) -> Dict[str, str]:
+    # a lagging replica would cache the previous state of a profile under its new version
+    with primary():
+        return {keys[profile.pk]: render_to_string('chaos_dating/profile_card.html', {'profile': profile})
+                for profile in profile_listing().filter(pk__in=profile_ids)}
@@ -0,0 +1,160 @@
+# coding=utf-8
+"""
+Routing of reads to the read replicas in ``settings.DATABASE_REPLICAS``.
+
+Only views decorated with ``use_replicas`` read from a replica, and only the models of this
+app; users and sessions always come from the primary, so logins never depend on replication
+lag. Each request sticks to one randomly chosen replica. Reads go to the primary once the
+request wrote anything, inside transactions and for ``settings.DATABASE_REPLICA_PIN_SECONDS``
+after a write of the same browser, which ``ReplicaPinningMiddleware`` remembers in a cookie.
+
+Caches and in-process indexes outlive the request and are loaded inside ``primary()``.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Iterator
+from typing import Optional
+
+from asgiref.sync import iscoroutinefunction
+from asgiref.sync import markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+
+PIN_COOKIE = 'chaos_dating_primary'
+
+
+class RoutingState:
+    def __init__(self, pinned: bool = False):
+        self.use_replicas = False
+        self.pinned = pinned
+        self.wrote = False
+        self.replica: Optional[str] = None
+
+
+_state: ContextVar[Optional[RoutingState]] = ContextVar('chaos_dating_routing', default=None)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints) -> Optional[str]:
+        state = _state.get()
+        if state is None or not state.use_replicas or state.pinned or state.wrote:
+            return None
+        if model._meta.app_label != 'chaos_dating' or not settings.DATABASE_REPLICAS:
+            return None
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+
+        if state.replica is None:
+            state.replica = random.choice(settings.DATABASE_REPLICAS)
+        return state.replica
+
+    def db_for_write(self, model, **hints) -> Optional[str]:
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints) -> Optional[bool]:
+        # replicas hold the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+@contextmanager
+def primary() -> Iterator[None]:
+    """
+    Reads from the primary within the block.
+    """
+    state = _state.get()
+    if state is None or state.pinned:
+        yield
+        return
+
+    state.pinned = True
+    try:
+        yield
+    finally:
+        state.pinned = False
+
+
+def use_replicas(view):
+    """
+    Lets the view read the models of this app from a replica.
+    """
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            state = _state.get()
+            if state is None:
+                return await view(request, *args, **kwargs)
+
+            state.use_replicas = True
+            try:
+                return await view(request, *args, **kwargs)
+            finally:
+                state.use_replicas = False
+
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        state = _state.get()
+        if state is None:
+            return view(request, *args, **kwargs)
+
+        state.use_replicas = True
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            state.use_replicas = False
+
+    return wrapper
+
+
+class ReplicaPinningMiddleware:
+    """
+    Tracks the writes of each request and pins the browser to the primary for a while after one.
+
+    The state is a context variable, so it is shared with the threads async views hand queries to.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self._acall(request)
+
+        token = _state.set(RoutingState(pinned=PIN_COOKIE in request.COOKIES))
+        try:
+            response = self.get_response(request)
+            wrote = _state.get().wrote
+        finally:
+            _state.reset(token)
+
+        return self._pin(response, wrote)
+
+    async def _acall(self, request):
+        token = _state.set(RoutingState(pinned=PIN_COOKIE in request.COOKIES))
+        try:
+            response = await self.get_response(request)
+            wrote = _state.get().wrote
+        finally:
+            _state.reset(token)
+
+        return self._pin(response, wrote)
+
+    def _pin(self, response, wrote: bool):
+        if wrote and settings.DATABASE_REPLICAS:
+            response.set_cookie(PIN_COOKIE, '1', max_age=settings.DATABASE_REPLICA_PIN_SECONDS,
+                                secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite='Lax')
+        return response
@@ -0,0 +1,240 @@
+# coding=utf-8
+"""
+Numbers of profiles per gender, wish and age bucket, shown next to the filter choices.
+
+The numbers of all profiles are kept in ``FacetCount`` rows, which the signal handlers in
+``chaos_dating.signals`` and the bulk imports adjust in the transaction of every change,
+so showing them costs one cached query instead of grouping all profiles. Writes bypassing
+the signals, e.g. ``QuerySet.update()`` or raw SQL, and concurrent edits of the same profile
+let them drift; ``manage.py recount_facets`` recounts them from scratch.
+
+The numbers for a filter selection are counted from the profile index: each facet counts the
+profiles matching the selection of the other facets, so every choice shows how many profiles
+selecting it in addition would find.
+"""
+import operator
+from collections import Counter
+from collections import defaultdict
+from functools import reduce
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import Case
+from django.db.models import Count
+from django.db.models import F
+from django.db.models import Q
+from django.db.models import Value
+from django.db.models import When
+
+from chaos_dating import caching
+from chaos_dating import models
+from chaos_dating.db_routing import primary
+from chaos_dating.listing import data_version
+from chaos_dating.listing import filter_key
+from chaos_dating.listing import filter_profiles
+from chaos_dating.profile_index import get_index
+
+# the lowest and highest age of every bucket
+AGE_BUCKETS = ((1, 17), (18, 24), (25, 34), (35, 44), (45, 54), (55, 64), (65, 100))
+# the value counting the profiles without gender
+NO_GENDER = 0
+BATCH_SIZE = 500
+
+Facet = Tuple[str, int]
+
+_counts = caching.LRUCache(settings.PROFILE_RESULTS_CACHE_SIZE, settings.PROFILE_RESULTS_CACHE_TIMEOUT)
+
+
+def age_bucket(age: int) -> int:
+    """
+    Returns the lowest age of the bucket of the age.
+    """
+    for lower, upper in AGE_BUCKETS:
+        if age <= upper:
+            return lower
+    return AGE_BUCKETS[-1][0]
+
+
+def profile_facets(gender_id: Optional[int], age: Optional[int], wish_ids: Iterable[int] = ()) -> List[Facet]:
+    """
+    Returns the facets a profile with the given gender, age and wishes is counted in.
+    """
+    facets = [(models.FacetCount.GENDER, gender_id or NO_GENDER)]
+    if age is not None:
+        facets.append((models.FacetCount.AGE, age_bucket(age)))
+    facets.extend((models.FacetCount.WISH, wish_id) for wish_id in wish_ids)
+    return facets
+
+
+def apply(deltas: Counter):
+    """
+    Adds the deltas to the counts of their facets in the current transaction.
+    """
+    # always in the same order, so concurrent transactions lock the rows without deadlocks
+    deltas = sorted((facet, delta) for facet, delta in deltas.items() if delta)
+    for start in range(0, len(deltas), BATCH_SIZE):
+        _apply(dict(deltas[start:start + BATCH_SIZE]))
+
+
+def _apply(deltas: Dict[Facet, int]):
+    values = defaultdict(list)
+    for facet, value in deltas:
+        values[facet].append(value)
+    rows = models.FacetCount.objects.filter(reduce(operator.or_, (Q(facet=facet, value__in=facet_values)
+                                                                  for facet, facet_values in values.items())))
+    # one update for all existing rows
+    change = Case(*(When(facet=facet, value=value, then=Value(delta)) for (facet, value), delta in deltas.items()),
+                  default=Value(0))
+    if rows.update(count=F('count') + change) == len(deltas):
+        return
+
+    existing = set(rows.values_list('facet', 'value'))
+    for (facet, value), delta in deltas.items():
+        if (facet, value) in existing:
+            continue
+        try:
+            with transaction.atomic():
+                models.FacetCount.objects.create(facet=facet, value=value, count=delta)
+        except IntegrityError:
+            # created by a concurrent transaction in the meantime
+            models.FacetCount.objects.filter(facet=facet, value=value).update(count=F('count') + delta)
+
+
+def add(facets: Iterable[Facet], sign: int = 1):
+    """
+    Counts a profile in the facets, or no longer with a negative sign.
+    """
+    apply(Counter({facet: sign for facet in facets}))
+
+
+def remove_gender(gender_id: int):
+    """
+    Counts the profiles of a deleted gender as profiles without gender.
+    """
+    rows = models.FacetCount.objects.filter(facet=models.FacetCount.GENDER, value=gender_id)
+    count = sum(rows.values_list('count', flat=True))
+    rows.delete()
+    apply(Counter({(models.FacetCount.GENDER, NO_GENDER): count}))
+
+
+def remove_wish(wish_id: int):
+    """
+    Drops the count of a deleted wish.
+    """
+    models.FacetCount.objects.filter(facet=models.FacetCount.WISH, value=wish_id).delete()
+
+
+def _facet_counts(rows: Iterable[Tuple[str, int, int]]) -> Dict[str, Dict[int, int]]:
+    counts = {'genders': {}, 'wishes': {}, 'ages': {lower: 0 for lower, upper in AGE_BUCKETS}}
+    names = {models.FacetCount.GENDER: 'genders', models.FacetCount.WISH: 'wishes', models.FacetCount.AGE: 'ages'}
+    for facet, value, count in rows:
+        # counts that drifted below zero are shown as none until they are recounted
+        if count > 0 and not (facet == models.FacetCount.GENDER and value == NO_GENDER):
+            counts[names[facet]][value] = counts[names[facet]].get(value, 0) + count
+    return counts
+
+
+def counts() -> Dict[str, Dict[int, int]]:
+    """
+    Returns the numbers of all profiles by gender id, wish id and lowest age of the age bucket.
+
+    Counts are cached until the data version changes.
+    """
+    version, _ = data_version()
+    key = (version, '')
+    result = _counts.get(key)
+    if result is None:
+        result = _facet_counts(models.FacetCount.objects.values_list('facet', 'value', 'count'))
+        _counts.set(key, result)
+
+    return result
+
+
+def filter_counts(cleaned_data: Optional[dict]) -> Dict[str, Dict[int, int]]:
+    """
+    Returns the numbers of the profiles matching the cleaned data of a ``FilterForm`` by gender,
+    wish and age bucket, each facet ignoring its own selection.
+    """
+    cleaned_data = cleaned_data or {}
+    if not any(cleaned_data.get(field) for field in ('gender', 'wishes', 'min_age', 'max_age')):
+        return counts()
+
+    version, _ = data_version()
+    key = (version, filter_key(cleaned_data))
+    result = _counts.get(key)
+    if result is None:
+        if settings.PROFILE_INDEX_ENABLED:
+            rows = _index_counts(cleaned_data)
+        else:
+            rows = _query_counts(cleaned_data)
+        result = _facet_counts(rows)
+        _counts.set(key, result)
+
+    return result
+
+
+def _index_counts(cleaned_data: dict) -> List[Tuple[str, int, int]]:
+    genders, wishes, ages = get_index().facet_counts(cleaned_data)
+    return ([(models.FacetCount.GENDER, gender_id or NO_GENDER, count) for gender_id, count in genders.items()]
+            + [(models.FacetCount.WISH, wish_id, count) for wish_id, count in wishes.items()]
+            + [(models.FacetCount.AGE, age_bucket(age), count) for age, count in ages.items()])
+
+
+def _query_counts(cleaned_data: dict) -> List[Tuple[str, int, int]]:
+    def selecting(*fields):
+        data = dict(cleaned_data, gender=None, wishes=None, min_age=None, max_age=None)
+        data.update((field, cleaned_data.get(field)) for field in fields)
+        return filter_profiles(data, models.Profile.objects.order_by())
+
+    rows = []
+    for facet, field, profiles in ((models.FacetCount.GENDER, 'gender', selecting('wishes', 'min_age', 'max_age')),
+                                   (models.FacetCount.WISH, 'wishes', selecting('gender', 'min_age', 'max_age')),
+                                   (models.FacetCount.AGE, 'age', selecting('gender', 'wishes'))):
+        for value, count in profiles.values_list(field).annotate(count=Count('id')):
+            if facet == models.FacetCount.AGE:
+                value = age_bucket(value)
+            elif value is None and facet == models.FacetCount.WISH:
+                # profiles without wishes
+                continue
+            rows.append((facet, value or NO_GENDER, count))
+
+    return rows
+
+
+def recount() -> Dict[Facet, Tuple[int, int]]:
+    """
+    Recounts every facet from the profiles and returns the counts that were wrong, as the
+    stored and the actual count by facet.
+    """
+    with primary(), transaction.atomic():
+        profiles = models.Profile.objects.order_by()
+        genders = profiles.values_list('gender_id').annotate(count=Count('id'))
+        ages = profiles.values_list('age').annotate(count=Count('id'))
+        wishes = models.Profile.wishes.through.objects.order_by().values_list('wish_id').annotate(count=Count('id'))
+
+        actual = Counter()
+        for gender_id, count in genders:
+            actual[models.FacetCount.GENDER, gender_id or NO_GENDER] += count
+        for age, count in ages:
+            actual[models.FacetCount.AGE, age_bucket(age)] += count
+        for wish_id, count in wishes:
+            actual[models.FacetCount.WISH, wish_id] += count
+
+        stored = {(facet, value): count for facet, value, count
+                  in models.FacetCount.objects.select_for_update().values_list('facet', 'value', 'count')}
+        wrong = {facet: (stored.get(facet, 0), actual.get(facet, 0)) for facet in set(stored) | set(actual)
+                 if stored.get(facet, 0) != actual.get(facet, 0)}
+        for (facet, value), (stored_count, count) in sorted(wrong.items()):
+            models.FacetCount.objects.update_or_create(facet=facet, value=value, defaults={'count': count})
+
+    return wrong
+
+
+def clear_counts():
+    _counts.clear()
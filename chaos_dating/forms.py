@@ -1,31 +1,253 @@
 # coding=utf-8
+from typing import List
+from typing import Optional
+from typing import Sequence
+
 from django import forms
 from django.contrib.auth.forms import ReadOnlyPasswordHashField
 from django.contrib.auth.forms import UsernameField
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from django.forms import FileField
+from django.core.validators import EMPTY_VALUES
+from django.forms.models import ModelChoiceIterator
 from django.urls import reverse
+from django.utils.datastructures import MultiValueDict
 from django.utils.translation import gettext as _
-from django_select2.forms import Select2MultipleWidget
-from django_select2.forms import Select2Widget
+from django_select2.forms import ModelSelect2MultipleWidget
+from django_select2.forms import ModelSelect2Widget
 
+from chaos_dating import facets
 from chaos_dating import models
+from chaos_dating.listing import MATCH_ORDER_BY
+from chaos_dating.listing import match_weights
+from chaos_dating.vocabulary import Vocabulary
+from chaos_dating.vocabulary import get_vocabulary
+from chaos_dating.vocabulary import resolve_instance
+
+
+class VocabularyChoiceIterator(ModelChoiceIterator):
+    """
+    Iterates over the choices of a vocabulary field from the vocabulary cache instead of its queryset.
+    """
+    
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield '', self.field.empty_label
+        vocabulary = get_vocabulary()
+        for instance in vocabulary.all(self.queryset.model):
+            yield self.choice(instance)
+        resolved = self.field.resolved
+        if resolved is not None and vocabulary.get(self.queryset.model, resolved[1].pk) is None:
+            # e.g. a new tag, which the vocabulary only contains after the transaction
+            yield self.choice(resolved[1])
+    
+    def __len__(self):
+        return len(get_vocabulary().all(self.queryset.model)) + (self.field.empty_label is not None)
+    
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(get_vocabulary().all(self.queryset.model))
+
+
+class VocabularyChoiceField(forms.ModelChoiceField):
+    """
+    Choice field over all instances of a vocabulary model, rendered and validated without queries.
+    
+    Values missing from the vocabulary cache are looked up in the database as usual.
+    """
+    iterator = VocabularyChoiceIterator
+    # the submitted value and the instance it was resolved to if the vocabulary does not contain it
+    resolved = None
+    
+    def label_from_instance(self, obj):
+        return get_vocabulary().label(type(obj), obj.pk) or str(obj)
+    
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        instance = get_vocabulary().get(self.queryset.model, value)
+        return instance if instance is not None else super().to_python(value)
+
+
+class VocabularyTagField(VocabularyChoiceField):
+    """
+    Vocabulary choice field that also accepts names, e.g. from select2 tags.
+    
+    Names are resolved by ``chaos_dating.vocabulary.resolve_instance()``, which creates new ones.
+    """
+    
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        model = self.queryset.model
+        max_length = model._meta.get_field('name').max_length
+        if len(' '.join(str(value).split())) > max_length:
+            raise ValidationError(_('Ensure this value has at most %(max_length)d characters.'),
+                                  code='max_length', params={'max_length': max_length})
+        
+        instance = resolve_instance(model, value)
+        if instance is None:
+            return None
+        if get_vocabulary().get(model, instance.pk) is None:
+            self.resolved = (value, instance)
+        return instance
+    
+    def bound_data(self, data, initial):
+        # a resolved name is shown as its instance when the form is rendered again
+        if self.resolved is not None and self.resolved[0] == data:
+            return self.resolved[1].pk
+        return super().bound_data(data, initial)
+
+
+class VocabularyMultipleChoiceField(forms.ModelMultipleChoiceField):
+    """
+    Multiple choice field over all instances of a vocabulary model, rendered and validated without queries.
+    """
+    iterator = VocabularyChoiceIterator
+    resolved = None
+    
+    def label_from_instance(self, obj):
+        return get_vocabulary().label(type(obj), obj.pk) or str(obj)
+    
+    def _check_values(self, value):
+        vocabulary = get_vocabulary()
+        instances = {}
+        for pk in value:
+            instance = vocabulary.get(self.queryset.model, pk)
+            if instance is None:
+                return super()._check_values(value)
+            instances[instance.pk] = instance
+        
+        return list(instances.values())
+
+
+class VocabularyResults(Sequence):
+    """
+    The instances of a vocabulary search, only looked up for the page being served.
+    """
+    
+    def __init__(self, vocabulary: Vocabulary, model: type, ids: List[int]):
+        self.vocabulary = vocabulary
+        self.model = model
+        self.ids = ids
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.vocabulary.get(self.model, pk) for pk in self.ids[index]]
+        return self.vocabulary.get(self.model, self.ids[index])
+
+
+class VocabularySelect2Mixin:
+    """
+    Mixin of django-select2's model widgets for vocabulary fields.
+    
+    Only the selected choices are rendered, from the vocabulary cache. The choices are searched by
+    the ``AutoResponseView`` of django-select2 in pages of ``max_results``, using the cached
+    ``Vocabulary.search()`` instead of the database.
+    """
+    
+    def build_attrs(self, base_attrs, extra_attrs=None):
+        # the first page of choices opens without typing
+        attrs = {'data-minimum-input-length': 0, 'data-dropdown-auto-width': 'true'}
+        attrs.update(base_attrs)
+        return super().build_attrs(attrs, extra_attrs)
+    
+    def filter_queryset(self, request, term, queryset=None, **dependent_fields):
+        model = (queryset if queryset is not None else self.get_queryset()).model
+        vocabulary = get_vocabulary()
+        return VocabularyResults(vocabulary, model, vocabulary.search(model, term))
+    
+    def label_from_instance(self, obj):
+        return get_vocabulary().label(type(obj), obj.pk) or str(obj)
+    
+    def optgroups(self, name, value, attrs=None):
+        model = self.get_queryset().model
+        vocabulary = get_vocabulary()
+        values = list(dict.fromkeys(str(v) for v in value if v not in EMPTY_VALUES))
+        instances = {v: vocabulary.get(model, v) for v in values}
+        missing = [v for v, instance in instances.items() if instance is None and v.isdigit()]
+        if missing:
+            # e.g. a new tag, which the vocabulary only contains after the transaction
+            instances.update((str(pk), instance) for pk, instance in model.objects.in_bulk(missing).items())
+        
+        options = []
+        if not self.is_required and not self.allow_multiple_selected:
+            options.append(self.create_option(name, '', '', False, 0))
+        for v in values:
+            instance = instances.get(v)
+            if instance is not None:
+                options.append(self.create_option(name, instance.pk, self.label_from_instance(instance), True,
+                                                  len(options)))
+            elif not v.isdigit():
+                # a typed tag that did not validate is shown again as typed
+                options.append(self.create_option(name, v, v, True, len(options)))
+        return [(None, options, 0)]
+
+
+class VocabularySelect2Widget(VocabularySelect2Mixin, ModelSelect2Widget):
+    pass
+
+
+class VocabularySelect2MultipleWidget(VocabularySelect2Mixin, ModelSelect2MultipleWidget):
+    pass
+
+
+class FacetSelect2MultipleWidget(VocabularySelect2MultipleWidget):
+    """
+    Filter widget showing the number of matching profiles next to every choice it looks up.
+    
+    select2 sends the other fields of the filter form along, the numbers are counted for their
+    selection by ``chaos_dating.facets.filter_counts()``.
+    """
+    FACETS = {models.Gender: 'genders', models.Wish: 'wishes'}
+    FILTER_FIELDS = ('gender', 'wishes', 'wish_match', 'wish_min_count', 'min_age', 'max_age')
+    # the numbers of the facet of the looked up choices by id
+    counts = None
+    
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('dependent_fields', {field: field for field in self.FILTER_FIELDS})
+        super().__init__(*args, **kwargs)
+    
+    def filter_queryset(self, request, term, queryset=None, **dependent_fields):
+        data = MultiValueDict()
+        for field, value in dependent_fields.items():
+            # the values of multiple choice fields arrive as lists, see AutoResponseView.get_queryset()
+            if field.endswith('__in'):
+                data.setlist(field[:-len('__in')], value)
+            else:
+                data[field] = value
+        form = FilterForm(data)
+        results = super().filter_queryset(request, term, queryset)
+        self.counts = facets.filter_counts(form.cleaned_data if form.is_valid() else None)[self.FACETS[results.model]]
+        return results
+    
+    def label_from_instance(self, obj):
+        label = super().label_from_instance(obj)
+        if self.counts is None:
+            return label
+        return f'{label} ({self.counts.get(obj.pk, 0)})'
 
 
 class FilterForm(forms.Form):
-    widget = Select2MultipleWidget(attrs={
-        'data-dropdown-auto-width': 'true',
-    })
     min_age = forms.IntegerField(label=_('Min age'), min_value=1, max_value=100, required=False)
     max_age = forms.IntegerField(label=_('Max age'), min_value=1, max_value=100, required=False)
-    wishes = forms.ModelMultipleChoiceField(queryset=models.Wish.objects.all(), required=False,
-                                            widget=widget)
-    gender = forms.ModelMultipleChoiceField(queryset=models.Gender.objects.all(), required=False,
-                                            widget=widget)
+    wishes = VocabularyMultipleChoiceField(queryset=models.Wish.objects.all(), required=False,
+                                           widget=FacetSelect2MultipleWidget())
+    WISH_MATCH_CHOICES = (
+        ('any', _('Any of the wishes')),
+        ('all', _('All of the wishes')),
+        ('at_least', _('At least')),
+    )
+    wish_match = forms.ChoiceField(choices=WISH_MATCH_CHOICES, required=False)
+    wish_min_count = forms.IntegerField(label=_('Wishes'), min_value=1, required=False)
+    gender = VocabularyMultipleChoiceField(queryset=models.Gender.objects.all(), required=False,
+                                           widget=FacetSelect2MultipleWidget())
     SORT_CHOICES = (
-        ('user__username', _('Username')),
+        ('username', _('Username')),
         ('age', _('Age')),
+        ('match', _('Best match')),
     )
     order_by = forms.ChoiceField(choices=SORT_CHOICES, required=False)
     SORT_ORDER = (
@@ -33,6 +255,36 @@ class FilterForm(forms.Form):
         ('-', _('Descending'))
     )
     order_direction = forms.ChoiceField(choices=SORT_ORDER, required=False)
+    
+    def __init__(self, *args, user: Optional[User] = None, **kwargs):
+        """
+        :param user: the viewing user, whose wishes the best match sort compares with
+        """
+        super().__init__(*args, **kwargs)
+        self.user = user
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        wishes = cleaned_data.get('wishes') or ()
+        if cleaned_data.get('wish_match') == 'at_least':
+            count = cleaned_data.get('wish_min_count')
+            if not count:
+                self.add_error('wish_min_count', _('How many of the wishes have to match?'))
+            elif count > len(wishes):
+                self.add_error('wish_min_count', _('Select at least as many wishes.'))
+        if cleaned_data.get('order_by') == MATCH_ORDER_BY:
+            cleaned_data['match_weights'] = match_weights(getattr(self.user, 'profile', None))
+        
+        return cleaned_data
+
+
+class SavedSearchForm(forms.ModelForm):
+    """
+    The name a ``FilterForm`` query is saved under, posted together with it.
+    """
+    class Meta:
+        model = models.SavedSearch
+        fields = ['name']
 
 
 class UserForm(forms.ModelForm):
@@ -66,52 +318,22 @@ class UserForm(forms.ModelForm):
 class ProfileForm(forms.ModelForm):
     class Meta:
         model = models.Profile
-        widget = Select2Widget(attrs={
-            'data-dropdown-auto-width': 'true',
-            'data-tags': 'true'
-        })
         fields = ['age', 'pronoun', 'gender', 'wishes']
         localized_fields = ['age', 'pronoun', 'gender', 'wishes']
+        # every field needs a widget of its own, django-select2 looks its queryset up by widget
         widgets = {
-            'pronoun': widget,
-            'gender': widget
+            'pronoun': VocabularySelect2Widget(attrs={'data-tags': 'true'}),
+            'gender':  VocabularySelect2Widget(attrs={'data-tags': 'true'}),
+            'wishes':  VocabularySelect2MultipleWidget(),
+        }
+        field_classes = {
+            'pronoun': VocabularyTagField,
+            'gender':  VocabularyTagField,
+            'wishes':  VocabularyMultipleChoiceField,
         }
     
-    def _clean_fields(self):
-        for name, field in self.fields.items():
-            # value_from_datadict() gets the data from the data dictionaries.
-            # Each widget type knows how to retrieve its own data, because some
-            # widgets split data over several HTML fields.
-            if field.disabled:
-                value = self.get_initial_for_field(field, name)
-            else:
-                value = field.widget.value_from_datadict(self.data, self.files, self.add_prefix(name))
-            try:
-                if isinstance(field, FileField):
-                    initial = self.get_initial_for_field(field, name)
-                    value = field.clean(value, initial)
-                else:
-                    value = field.clean(value)
-                self.cleaned_data[name] = value
-                if hasattr(self, 'clean_%s' % name):
-                    value = getattr(self, 'clean_%s' % name)()
-                    self.cleaned_data[name] = value
-            except ValidationError as e:
-                if name in ('pronoun', 'gender'):
-                    self._set_field(name, value)
-                    return
-                
-                self.add_error(name, e)
-    
-    def _set_field(self, name: str, value: str):
-        instance = None
-        if name == 'pronoun':
-            instance = models.Pronoun.objects.get(name=value)
-        elif name == 'gender':
-            instance = models.Gender.objects.get(name=value)
-
-        self.cleaned_data[name] = instance
-        self.initial[name] = instance.id
-        data = self.data.copy()
-        data[name] = str(instance.id)
-        self.data = data
+    def _get_validation_exclusions(self):
+        exclusions = super()._get_validation_exclusions()
+        # the vocabulary fields made sure their instances exist, the model need not query them again
+        exclusions.update(('pronoun', 'gender'))
+        return exclusions
@@ -0,0 +1,149 @@
+# coding=utf-8
+"""
+Profiles hidden from a user.
+
+A user hides profiles from their listings, or blocks them, which also hides the user from the
+owners of those profiles. The listings find their candidates shared by all users and drop the
+hidden ones afterwards. ``hidden_profiles()`` keeps the hidden ids of every user as a set in
+the memory of the process and checks only a version counter in the cache per request. Its
+cost does not depend on how many profiles a user hid. The signal handlers in
+``chaos_dating.signals`` bump the counters of both users concerned by a change.
+
+Queries answered by the database instead of the profile index exclude the hidden profiles with
+anti-joins on the indexes of ``HiddenProfile`` instead of lists of ids, see
+``HiddenProfiles.condition()`` and ``HiddenProfiles.sql()`` for raw queries; their cost does not
+grow with the number of hidden profiles.
+"""
+from typing import FrozenSet
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Exists
+from django.db.models import OuterRef
+from django.db.models import Q
+
+from chaos_dating import caching
+from chaos_dating import models
+from chaos_dating.db_routing import primary
+
+_hidden = caching.LRUCache(settings.PROFILE_RESULTS_CACHE_SIZE, settings.PROFILE_RESULTS_CACHE_TIMEOUT)
+
+
+class HiddenProfiles(NamedTuple):
+    user_id: Optional[int]
+    version: int
+    # the profiles the user hid or blocked and those of the users blocking the user
+    ids: FrozenSet[int]
+    # the profiles the user blocked and those of the users blocking the user
+    blocked: FrozenSet[int]
+
+    def visible(self, profile_ids: Iterable[int]) -> List[int]:
+        """
+        Returns the given profile ids without the hidden ones, in the given order.
+        """
+        return [pk for pk in profile_ids if pk not in self.ids]
+
+    def condition(self, profile_id: str = 'pk', user_id: str = 'user_id') -> Q:
+        """
+        Returns a condition for the profiles not hidden from the user, given by the fields of the
+        profile id and of the id of its owner.
+        """
+        if not self.ids:
+            return Q()
+        hidden = models.HiddenProfile.objects.filter(user_id=self.user_id, profile_id=OuterRef(profile_id))
+        blocking = models.HiddenProfile.objects.filter(user_id=OuterRef(user_id), profile__user_id=self.user_id,
+                                                       blocked=True)
+        return Q(~Exists(hidden), ~Exists(blocking))
+
+    def sql(self, profile_id: str) -> Tuple[str, List[int]]:
+        """
+        Returns the SQL and parameters of ``condition()`` for raw queries, given the column of the
+        profile id.
+        """
+        if not self.ids:
+            return '1 = 1', []
+        hidden = models.HiddenProfile._meta.db_table
+        profiles = models.Profile._meta.db_table
+        return (f'NOT EXISTS (SELECT 1 FROM {hidden} h WHERE h.user_id = %s AND h.profile_id = {profile_id}) '
+                f'AND NOT EXISTS (SELECT 1 FROM {profiles} owner '
+                f'JOIN {hidden} h ON h.user_id = owner.user_id AND h.blocked '
+                f'JOIN {profiles} viewer ON viewer.id = h.profile_id '
+                f'WHERE owner.id = {profile_id} AND viewer.user_id = %s)'), [self.user_id, self.user_id]
+
+
+NOTHING_HIDDEN = HiddenProfiles(None, 0, frozenset(), frozenset())
+
+
+def version_key(user_id: int) -> str:
+    return caching.cache_key('hidden', user_id, 'version')
+
+
+def bump_versions(user_ids: Iterable[int]):
+    for user_id in set(user_ids):
+        caching.bump(version_key(user_id))
+
+
+def hidden_profiles(user: User) -> HiddenProfiles:
+    """
+    Returns the profiles hidden from the user.
+    """
+    if not user.is_authenticated:
+        return NOTHING_HIDDEN
+
+    version = caching.version(version_key(user.pk))
+    hidden = _hidden.get((user.pk, version))
+    if hidden is None:
+        hidden = _load(user.pk, version)
+    return hidden
+
+
+async def ahidden_profiles(user: User) -> HiddenProfiles:
+    if not user.is_authenticated:
+        return NOTHING_HIDDEN
+
+    key = version_key(user.pk)
+    version = (await caching.aversions([key]))[key]
+    hidden = _hidden.get((user.pk, version))
+    if hidden is None:
+        hidden = await sync_to_async(_load)(user.pk, version)
+    return hidden
+
+
+def _load(user_id: int, version: int) -> HiddenProfiles:
+    # a lagging replica would cache the previous state under the new version
+    with primary():
+        own = models.HiddenProfile.objects.order_by().filter(user_id=user_id).values_list('profile_id', 'blocked')
+        blocking = models.HiddenProfile.objects.order_by().filter(profile__user_id=user_id, blocked=True) \
+            .values_list('user__profile__id', 'blocked')
+        rows = [(pk, blocked) for pk, blocked in own.union(blocking, all=True) if pk is not None]
+
+    hidden = HiddenProfiles(user_id, version, frozenset(pk for pk, _ in rows),
+                            frozenset(pk for pk, blocked in rows if blocked))
+    _hidden.set((user_id, version), hidden)
+    return hidden
+
+
+def hide(user: User, profile: models.Profile, blocked: bool = False) -> models.HiddenProfile:
+    """
+    Hides the profile from the user; blocking it also hides the user from its owner.
+    """
+    hidden, _ = models.HiddenProfile.objects.update_or_create(user=user, profile=profile,
+                                                              defaults={'blocked': blocked})
+    return hidden
+
+
+def unhide(user: User, profile: models.Profile):
+    """
+    Shows a hidden or blocked profile to the user again.
+    """
+    models.HiddenProfile.objects.filter(user=user, profile=profile).delete()
+
+
+def clear_hidden():
+    _hidden.clear()
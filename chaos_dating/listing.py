@@ -0,0 +1,329 @@
+# coding=utf-8
+import time
+from typing import AbstractSet
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case
+from django.db.models import Count
+from django.db.models import Exists
+from django.db.models import IntegerField
+from django.db.models import OuterRef
+from django.db.models import Prefetch
+from django.db.models import QuerySet
+from django.db.models import Sum
+from django.db.models import Value
+from django.db.models import When
+
+from chaos_dating import caching
+from chaos_dating import models
+from chaos_dating.hiding import NOTHING_HIDDEN
+from chaos_dating.hiding import HiddenProfiles
+from chaos_dating.pagination import Page
+from chaos_dating.pagination import after_key
+from chaos_dating.pagination import decode_cursor
+from chaos_dating.pagination import encode_cursor
+from chaos_dating.pagination import paginate
+from chaos_dating.pagination import sort_key
+from chaos_dating.profile_index import Key
+from chaos_dating.profile_index import current_index
+from chaos_dating.profile_index import get_index
+
+DEFAULT_ORDER_BY = 'username'
+# orders by the weighted number of wishes shared with the viewer, best matches first
+MATCH_ORDER_BY = 'match'
+DATA_VERSION_KEY = caching.cache_key('profiles', 'data_version')
+DATA_MODIFIED_KEY = caching.cache_key('profiles', 'modified')
+
+_results = caching.LRUCache(settings.PROFILE_RESULTS_CACHE_SIZE, settings.PROFILE_RESULTS_CACHE_TIMEOUT)
+
+
+def bump_data_version() -> int:
+    """
+    Invalidates every cached profile list; called whenever listed data changes.
+    """
+    cache.set(DATA_MODIFIED_KEY, time.time(), timeout=None)
+    return caching.bump(DATA_VERSION_KEY)
+
+
+def data_version() -> Tuple[int, Optional[float]]:
+    """
+    Returns the current data version and the timestamp of its last change, if known.
+    """
+    values = cache.get_many([DATA_VERSION_KEY, DATA_MODIFIED_KEY])
+    if DATA_VERSION_KEY not in values:
+        values.update(caching.versions([DATA_VERSION_KEY]))
+    return values[DATA_VERSION_KEY], values.get(DATA_MODIFIED_KEY)
+
+
+async def adata_version() -> Tuple[int, Optional[float]]:
+    values = await caching.aget_many([DATA_VERSION_KEY, DATA_MODIFIED_KEY])
+    if DATA_VERSION_KEY not in values:
+        values.update(await caching.aversions([DATA_VERSION_KEY]))
+    return values[DATA_VERSION_KEY], values.get(DATA_MODIFIED_KEY)
+
+
+def clear_results():
+    _results.clear()
+
+
+def profile_listing() -> QuerySet:
+    """
+    Returns the base queryset for every profile list.
+
+    It selects and prefetches exactly what ``chaos_dating/profile_card.html`` renders,
+    so the number of queries stays the same regardless of the number of profiles. Genders,
+    pronouns and the labels of wishes come from ``chaos_dating.vocabulary`` and the username
+    is copied onto the profile, so nothing has to be joined.
+    """
+    return models.Profile.objects \
+        .prefetch_related(Prefetch('wishes', queryset=models.Wish.objects.order_by('pk')))
+
+
+def filter_profiles(cleaned_data: dict, profiles: Optional[QuerySet] = None) -> QuerySet:
+    """
+    Returns the profiles, by default the profile listing, restricted by the cleaned data of a ``FilterForm``.
+    """
+    if profiles is None:
+        profiles = profile_listing()
+    if cleaned_data['gender']:
+        profiles = profiles.filter(gender__in=cleaned_data['gender'])
+    if cleaned_data['wishes']:
+        profiles = profiles.filter(wish_matches([wish.pk for wish in cleaned_data['wishes']],
+                                                wish_threshold(cleaned_data)))
+    if cleaned_data['min_age']:
+        profiles = profiles.filter(age__gte=cleaned_data['min_age'])
+    if cleaned_data['max_age']:
+        profiles = profiles.filter(age__lte=cleaned_data['max_age'])
+
+    return profiles
+
+
+def wish_threshold(cleaned_data: dict) -> int:
+    """
+    Returns how many of the selected wishes of a ``FilterForm`` a profile has to match.
+    """
+    wishes = cleaned_data.get('wishes') or ()
+    match = cleaned_data.get('wish_match') or 'any'
+    if match == 'all':
+        return len(wishes)
+    if match == 'at_least':
+        return min(cleaned_data.get('wish_min_count') or 1, len(wishes))
+    return 1
+
+
+def wish_matches(wish_ids: Iterable[int], threshold: int) -> Exists:
+    """
+    Returns a condition for profiles with at least threshold of the wishes with the given ids.
+
+    It is a correlated subquery on the wishes through table instead of a join, so every
+    profile is returned once however many of the wishes it matches.
+    """
+    through = models.Profile.wishes.through.objects.order_by() \
+        .filter(profile_id=OuterRef('pk'), wish_id__in=list(wish_ids))
+    if threshold > 1:
+        through = through.values('profile_id').annotate(matches=Count('wish_id')).filter(matches__gte=threshold)
+    return Exists(through)
+
+
+def sort_order(cleaned_data: Optional[dict]) -> Tuple[str, bool]:
+    """
+    Returns the sort field and whether it is descending for the cleaned data of a ``FilterForm``.
+    """
+    if not cleaned_data or not cleaned_data['order_by']:
+        return DEFAULT_ORDER_BY, False
+    if cleaned_data['order_by'] == MATCH_ORDER_BY:
+        return MATCH_ORDER_BY, True
+
+    return cleaned_data['order_by'], cleaned_data['order_direction'] == '-'
+
+
+def match_weights(profile: Optional[models.Profile]) -> Dict[int, int]:
+    """
+    Returns the weights of the wishes of the profile for the best match sort by wish id.
+
+    Every wish weighs as much as its interest; wishes of interests weighing nothing are left out.
+    """
+    from chaos_dating.vocabulary import get_vocabulary
+
+    if profile is None or profile.pk is None:
+        return {}
+
+    # the index is only used once it was built, but then caught up with other processes
+    index = get_index() if current_index() is not None else None
+    entry = index.entry(profile.pk) if index is not None else None
+    wish_ids = entry.wish_ids if entry is not None else profile.wishes.values_list('id', flat=True)
+    vocabulary = get_vocabulary()
+    weights = {}
+    for wish_id in wish_ids:
+        wish = vocabulary.get(models.Wish, wish_id)
+        interest = vocabulary.get(models.Interest, wish.interest_id) if wish is not None else None
+        if interest is not None and interest.weight > 0:
+            weights[wish_id] = interest.weight
+
+    return weights
+
+
+def filter_key(cleaned_data: Optional[dict]) -> str:
+    """
+    Returns a canonical representation of the cleaned data of a ``FilterForm``.
+
+    Equivalent filters, e.g. with the same wishes in another order, have the same key.
+    """
+    cleaned_data = cleaned_data or {}
+    order_by, descending = sort_order(cleaned_data)
+    genders = sorted(gender.pk for gender in cleaned_data.get('gender') or ())
+    wishes = sorted(wish.pk for wish in cleaned_data.get('wishes') or ())
+    parts = [
+        f"g={','.join(map(str, genders))}",
+        f"w={','.join(map(str, wishes))}",
+        f"m={wish_threshold(cleaned_data) if wishes else ''}",
+        f"age={cleaned_data.get('min_age') or ''}-{cleaned_data.get('max_age') or ''}",
+        f"sort={sort_key(order_by, descending)}",
+    ]
+    if order_by == MATCH_ORDER_BY:
+        # viewers with the same wishes share their results
+        weights = sorted((cleaned_data.get('match_weights') or {}).items())
+        parts.append(f"v={','.join(f'{wish_id}:{weight}' for wish_id, weight in weights)}")
+
+    return ';'.join(parts)
+
+
+def find_profiles(cleaned_data: Optional[dict] = None, cursor: Optional[str] = None,
+                  hidden: HiddenProfiles = NOTHING_HIDDEN) -> Page:
+    """
+    Returns the page of profile ids after the cursor matching the cleaned data of a ``FilterForm``.
+
+    Without cleaned data the first page of all profiles is returned. Pages are cached until
+    the data version changes. Pages are shared by all viewers; only a page with profiles hidden
+    from the viewer is searched again for the viewer without them.
+    """
+    version, _ = data_version()
+    key = (version, settings.PROFILES_PAGE_SIZE, filter_key(cleaned_data), cursor)
+    page = _results.get(key)
+    if page is None:
+        page = _find_profiles(cleaned_data, cursor)
+        _results.set(key, page)
+    if not hidden.ids.isdisjoint(page.items):
+        key += (hidden.user_id, hidden.version)
+        page = _results.get(key)
+        if page is None:
+            page = _find_profiles(cleaned_data, cursor, hidden)
+            _results.set(key, page)
+
+    return page
+
+
+async def afind_profiles(cleaned_data: Optional[dict] = None, cursor: Optional[str] = None,
+                         hidden: HiddenProfiles = NOTHING_HIDDEN) -> Page:
+    """
+    Async version of ``find_profiles()``; only pages missing from the result cache are searched in a thread.
+    """
+    version, _ = await adata_version()
+    key = (version, settings.PROFILES_PAGE_SIZE, filter_key(cleaned_data), cursor)
+    page = _results.get(key)
+    if page is None:
+        page = await sync_to_async(_find_profiles)(cleaned_data, cursor)
+        _results.set(key, page)
+    if not hidden.ids.isdisjoint(page.items):
+        key += (hidden.user_id, hidden.version)
+        page = _results.get(key)
+        if page is None:
+            page = await sync_to_async(_find_profiles)(cleaned_data, cursor, hidden)
+            _results.set(key, page)
+
+    return page
+
+
+def _find_profiles(cleaned_data: Optional[dict], cursor: Optional[str],
+                   hidden: HiddenProfiles = NOTHING_HIDDEN) -> Page:
+    order_by, descending = sort_order(cleaned_data)
+    if order_by == MATCH_ORDER_BY:
+        return _find_matching_profiles(cleaned_data, cursor, settings.PROFILES_PAGE_SIZE, hidden)
+    if settings.PROFILE_INDEX_ENABLED:
+        return _find_indexed_profiles(cleaned_data or {}, order_by, descending, cursor,
+                                      settings.PROFILES_PAGE_SIZE, hidden.ids)
+
+    profiles = profile_query(cleaned_data).filter(hidden.condition())
+    page = paginate(profiles, order_by, descending, cursor, settings.PROFILES_PAGE_SIZE)
+    return Page([profile.pk for profile in page.items], page.next_cursor)
+
+
+def profile_query(cleaned_data: Optional[dict]) -> QuerySet:
+    """
+    Returns the profiles matching the cleaned data of a ``FilterForm`` as searched in the database.
+
+    Only the columns covered by the indexes in ``Profile.Meta`` are read.
+    """
+    profiles = models.Profile.objects.only('id', 'age', 'username')
+    if cleaned_data:
+        profiles = filter_profiles(cleaned_data, profiles)
+    return profiles
+
+
+def _find_indexed_profiles(cleaned_data: dict, order_by: str, descending: bool,
+                           cursor: Optional[str], page_size: int, exclude: AbstractSet[int] = frozenset()) -> Page:
+    sort = sort_key(order_by, descending)
+    after = decode_cursor(cursor, sort) if cursor else None
+    keys = get_index().search(cleaned_data, order_by, descending, after, page_size + 1, exclude)
+    return _key_page(keys, sort, page_size)
+
+
+def _key_page(keys: List[Key], sort: str, page_size: int) -> Page:
+    next_cursor = None
+    if len(keys) > page_size:
+        keys = keys[:page_size]
+        next_cursor = encode_cursor(sort, *keys[-1])
+
+    return Page([pk for _, pk in keys], next_cursor)
+
+
+def _find_matching_profiles(cleaned_data: dict, cursor: Optional[str], page_size: int,
+                            hidden: HiddenProfiles = NOTHING_HIDDEN) -> Page:
+    # the cursor holds the score and id of the last profile, so no page scores more than the viewer's wishes
+    sort = sort_key(MATCH_ORDER_BY, True)
+    after = decode_cursor(cursor, sort) if cursor else None
+    weights = cleaned_data.get('match_weights') or {}
+    if settings.PROFILE_INDEX_ENABLED:
+        keys = get_index().search_matches(cleaned_data, weights, after, page_size + 1, hidden.ids)
+    else:
+        keys = match_keys(cleaned_data, weights, after, page_size + 1, hidden)
+
+    return _key_page(keys, sort, page_size)
+
+
+def match_keys(cleaned_data: dict, weights: Dict[int, int], after: Optional[Key], limit: int,
+               hidden: HiddenProfiles = NOTHING_HIDDEN) -> List[Key]:
+    """
+    Returns up to limit ``(score, id)`` keys of the profiles matching the cleaned data of a ``FilterForm``
+    following the key after, best first, as searched in the database.
+
+    The scores are one aggregate over the rows of the wishes through table of the weighted
+    wishes, served by its ``(wish_id, profile_id)`` index. Profiles sharing none of them score
+    zero and follow by descending id. Profiles hidden from the viewer are left out.
+    """
+    profiles = profile_query(cleaned_data).filter(hidden.condition())
+    keys = []
+    if weights and (after is None or after[0] > 0):
+        score = Sum(Case(*(When(wishes__id=wish_id, then=Value(weight)) for wish_id, weight in weights.items()),
+                         output_field=IntegerField()))
+        matched = profiles.filter(wishes__in=list(weights)).values('id').annotate(match=score) \
+            .order_by('-match', '-id')
+        if after is not None:
+            matched = after_key(matched, MATCH_ORDER_BY, True, *after)
+        keys = list(matched.values_list('match', 'id')[:limit])
+    if len(keys) == limit:
+        return keys
+
+    rest = profiles.order_by('-id')
+    if weights:
+        rest = rest.exclude(wish_matches(weights, 1))
+    if after is not None and after[0] == 0:
+        rest = rest.filter(id__lt=after[1])
+    return keys + [(0, pk) for pk in rest.values_list('id', flat=True)[:limit - len(keys)]]
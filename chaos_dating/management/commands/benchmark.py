@@ -0,0 +1,116 @@
+# coding=utf-8
+import json
+import platform
+import time
+
+import django
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+from django.utils import timezone
+
+from chaos_dating import benchmark
+from chaos_dating import listing
+from chaos_dating import profile_index
+from chaos_dating import vocabulary
+
+PREFIX = 'benchmark'
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the listing, filter and profile endpoints on seeded test databases of growing size.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000],
+                            help='Numbers of profiles to benchmark with.')
+        parser.add_argument('--repeat', type=int, default=30,
+                            help='Number of requests per scenario and cache state.')
+        parser.add_argument('--scenario', action='append', dest='scenarios',
+                            help='Only run the given scenario; may be repeated.')
+        parser.add_argument('--output', default='benchmark.json',
+                            help='File the results are written to as JSON.')
+        parser.add_argument('--baseline', default=None,
+                            help='Results to compare against; fails on regressions.')
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Tolerated relative slowdown against the baseline.')
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Keep the seeded test database for the next run.')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[],
+                            help='Also compare the throughput of the WSGI and the ASGI views with '
+                                 'these numbers of concurrent clients.')
+        parser.add_argument('--throughput-requests', type=int, default=50,
+                            help='Number of requests per concurrent client.')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                baseline = json.load(file)['results']
+
+        setup_test_environment()
+        # the profiles are seeded into the test database, never into the configured one
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            results, throughput = self._run(sorted(options['sizes']), options['repeat'], options['scenarios'],
+                                            options['concurrency'], options['throughput_requests'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        with open(options['output'], 'w') as file:
+            json.dump({
+                'meta':       {
+                    'created':  timezone.now().isoformat(),
+                    'python':   platform.python_version(),
+                    'django':   django.get_version(),
+                    'database': connection.vendor,
+                    'repeat':   options['repeat'],
+                },
+                'results':    results,
+                'throughput': throughput,
+            }, file, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+        if baseline is not None:
+            regressions = benchmark.compare(results, baseline, options['threshold'])
+            if regressions:
+                raise CommandError('Regressions against the baseline:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
+
+    def _run(self, sizes, repeat, scenarios, concurrencies, throughput_requests) -> tuple:
+        results = {}
+        throughput = {}
+        for size in sizes:
+            # each size tops up the profiles of the previous one
+            missing = size - User.objects.filter(username__startswith=PREFIX).count()
+            if missing > 0:
+                start = time.perf_counter()
+                call_command('generate_profiles', missing, prefix=PREFIX, seed=size, stdout=self.stderr)
+                self.stdout.write(f'Seeded {size} profiles in {time.perf_counter() - start:.1f}s')
+
+            profile_index.reset()
+            listing.clear_results()
+            vocabulary.reset()
+            user = User.objects.filter(username__startswith=PREFIX).order_by('pk').first()
+            client = Client()
+            client.force_login(user)
+            results[str(size)] = benchmark.run(client, repeat, scenarios)
+            for key, summary in results[str(size)].items():
+                self.stdout.write(f"{size:>8} {key:<24} p50 {summary['p50_ms']:>9.2f}ms "
+                                  f"p95 {summary['p95_ms']:>9.2f}ms queries {summary['queries']:>3} "
+                                  f"sql {summary['sql_ms']:>8.2f}ms render {summary['render_ms']:>8.2f}ms "
+                                  f"errors {summary['errors']}")
+
+            if concurrencies:
+                throughput[str(size)] = benchmark.run_throughput(client, user, concurrencies,
+                                                                 throughput_requests, scenarios)
+                for key, summary in throughput[str(size)].items():
+                    self.stdout.write(f"{size:>8} {key:<24} {summary['requests_per_s']:>9.1f} requests/s "
+                                      f"errors {summary['errors']}")
+
+        return results, throughput
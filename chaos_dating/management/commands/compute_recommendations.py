@@ -0,0 +1,94 @@
+# coding=utf-8
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from chaos_dating import models
+from chaos_dating.matching import MatchEngine
+from chaos_dating.matching import top_k_all
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the best matches of every profile and stores them as recommendations.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true',
+                            help='Only rescore profiles affected by changes since the last run.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of scoring processes.')
+        parser.add_argument('--chunk-size', type=int, default=256,
+                            help='Number of profiles scored at once by a process.')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Number of recommendations inserted per query.')
+        parser.add_argument('-k', type=int, default=settings.RECOMMENDATIONS_COUNT,
+                            help='Number of recommendations per profile.')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        started_at = timezone.now()
+        engine = MatchEngine.build()
+        k = options['k']
+        last_run = models.RecommendationRun.objects.filter(finished_at__isnull=False).order_by('-started_at').first()
+        incremental = options['incremental'] and last_run is not None
+        if incremental:
+            rows = self._affected_rows(engine, last_run.started_at, k, options['chunk_size'])
+        else:
+            rows = np.arange(len(engine))
+
+        for chunk, best, scores in top_k_all(engine, rows, k, options['workers'], options['chunk_size']):
+            self._store(engine, chunk, best, scores, options['batch_size'])
+
+        models.RecommendationRun.objects.create(started_at=started_at, finished_at=timezone.now(),
+                                                incremental=incremental, profiles=len(rows))
+        self.stdout.write(self.style.SUCCESS(
+            f'Computed recommendations for {len(rows)} of {len(engine)} profiles '
+            f'in {time.perf_counter() - start:.2f}s'
+        ))
+
+    @staticmethod
+    def _affected_rows(engine: MatchEngine, since: datetime, k: int, chunk_size: int) -> np.ndarray:
+        """
+        Returns the rows whose recommendations may differ because of profiles changed since the given time.
+
+        Scores are symmetric, so the scores of the changed profiles against everybody tell
+        which profiles would now rank a changed profile among their k best matches.
+        """
+        changed_ids = models.Profile.objects.filter(updated_at__gt=since).values_list('id', flat=True)
+        changed = [row for row in map(engine.row, changed_ids) if row is not None]
+        thresholds = np.zeros(len(engine), dtype=np.float32)
+        lowest = models.Recommendation.objects.filter(rank=k - 1).values_list('profile_id', 'score')
+        for profile_id, score in lowest.iterator():
+            row = engine.row(profile_id)
+            if row is not None:
+                thresholds[row] = score
+
+        affected = set(changed)
+        for start in range(0, len(changed), chunk_size):
+            scores = engine.scores(changed[start:start + chunk_size])
+            gains = (scores >= thresholds) & (scores > 0)
+            affected.update(np.flatnonzero(gains.any(axis=0)).tolist())
+
+        # profiles that recommend a changed profile may have to drop it
+        holders = models.Recommendation.objects.filter(recommended__updated_at__gt=since) \
+            .values_list('profile_id', flat=True).distinct()
+        affected.update(row for row in map(engine.row, holders) if row is not None)
+        return np.array(sorted(affected), dtype=np.int64)
+
+    @staticmethod
+    def _store(engine: MatchEngine, rows: np.ndarray, best: np.ndarray, scores: np.ndarray, batch_size: int):
+        profile_ids = engine.profile_ids[rows].tolist()
+        recommendations = [
+            models.Recommendation(profile_id=profile_id, recommended_id=int(engine.profile_ids[index]),
+                                  score=float(score), rank=rank)
+            for profile_id, indices, row_scores in zip(profile_ids, best, scores)
+            for rank, (index, score) in enumerate(zip(indices, row_scores)) if index >= 0
+        ]
+        with transaction.atomic():
+            models.Recommendation.objects.filter(profile_id__in=profile_ids).delete()
+            models.Recommendation.objects.bulk_create(recommendations, batch_size=batch_size)
@@ -0,0 +1,23 @@
+# coding=utf-8
+import time
+
+from django.core.management.base import BaseCommand
+
+from chaos_dating import saved_searches
+
+
+class Command(BaseCommand):
+    help = ('Matches the profiles changed since the last run against the saved searches, periodically in one '
+            'process at a time.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=saved_searches.BATCH_SIZE,
+                            help='Changed profiles loaded per query.')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        searches, profiles, matches = saved_searches.evaluate(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Evaluated {searches} saved searches against {profiles} changed profiles in '
+            f'{time.perf_counter() - start:.2f}s, found {matches} matches'
+        ))
@@ -0,0 +1,47 @@
+# coding=utf-8
+import csv
+import json
+
+from django.core.management.base import BaseCommand
+
+from chaos_dating import bulk
+
+CSV_FIELDS = ('username', 'age', 'gender', 'pronoun', 'wishes')
+
+
+class Command(BaseCommand):
+    help = 'Streams all profiles with their wishes as JSON lines or CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl',
+                            help='Output format; CSV stores the wishes as a JSON list.')
+        parser.add_argument('--output', default='-',
+                            help='File to write to, by default standard output.')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='Number of profiles read per query.')
+
+    def handle(self, *args, **options):
+        output = self.stdout if options['output'] == '-' else open(options['output'], 'w', newline='')
+        try:
+            count = self._write(output, options['format'], options['batch_size'])
+        finally:
+            if output is not self.stdout:
+                output.close()
+
+        self.stderr.write(self.style.SUCCESS(f'Exported {count} profiles'))
+
+    @staticmethod
+    def _write(output, format: str, batch_size: int) -> int:
+        count = 0
+        writer = None
+        if format == 'csv':
+            writer = csv.DictWriter(output, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+        for record in bulk.export_profiles(batch_size):
+            if writer is not None:
+                writer.writerow(dict(record, wishes=json.dumps(record['wishes'], ensure_ascii=False)))
+            else:
+                output.write(json.dumps(record, ensure_ascii=False) + '\n')
+            count += 1
+
+        return count
@@ -0,0 +1,93 @@
+# coding=utf-8
+import time
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from chaos_dating import bulk
+from chaos_dating import models
+from chaos_dating.vocabulary import resolve
+
+# names and relative frequencies of the vocabulary created if it is missing
+GENDERS = (('Woman', 44), ('Man', 44), ('Nonbinary', 5), ('Genderfluid', 2), ('Agender', 2), ('Genderqueer', 2),
+           ('Demigirl', 1))
+PRONOUNS = {'Woman': 'she/her', 'Man': 'he/him'}
+OTHER_PRONOUNS = ('they/them', 'she/they', 'he/they', 'xe/xem')
+INTERESTS = ('Friendship', 'Dating', 'Relationship', 'Chess', 'Hiking', 'Gaming', 'Cooking', 'Concerts')
+
+
+class Command(BaseCommand):
+    help = 'Generates users and profiles with random ages, genders, pronouns and wishes for load tests.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('count', type=int, help='Number of profiles to generate.')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='Number of profiles inserted per transaction.')
+        parser.add_argument('--prefix', default='generated',
+                            help='Prefix of the generated usernames.')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Seed of the random generator for reproducible data.')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        rng = np.random.default_rng(options['seed'])
+        genders, gender_weights = self._genders()
+        pronouns, pronoun_counts = self._pronouns()
+        wishes, wish_weights = self._wishes()
+        prefix = options['prefix']
+        offset = User.objects.filter(username__startswith=prefix).count()
+        created = 0
+        for batch_start in range(0, options['count'], options['batch_size']):
+            size = min(options['batch_size'], options['count'] - batch_start)
+            # most people on dating sites are in their twenties and thirties
+            ages = np.clip(np.rint(18 + rng.gamma(2.0, 6.5, size)), 18, 100).astype(int)
+            gender_rows = rng.choice(len(genders), size=size, p=gender_weights)
+            # the first pronoun of a gender is the common one, the others share the rest evenly
+            choices = rng.integers(1, np.maximum(pronoun_counts[gender_rows], 2))
+            choices[rng.random(size) < 0.85] = 0
+            pronoun_ids = pronouns[gender_rows, choices]
+            # weighted sampling without replacement of all wishes at once: the largest perturbed log weights win
+            wish_counts = np.minimum(rng.poisson(3.0, size), len(wishes))
+            keys = np.log(wish_weights) + rng.gumbel(size=(size, len(wishes)))
+            chosen = np.argsort(-keys, axis=1)
+            rows = [bulk.ProfileRow(f'{prefix}{offset + batch_start + i:07d}', int(ages[i]),
+                                    genders[gender_rows[i]], int(pronoun_ids[i]),
+                                    frozenset(wishes[column] for column in chosen[i, :wish_counts[i]]))
+                    for i in range(size)]
+            created += bulk.create_profiles(rows)[0]
+            self.stdout.write(f'{created} profiles generated')
+
+        bulk.invalidate()
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated {created} profiles in {time.perf_counter() - start:.2f}s'
+        ))
+
+    @staticmethod
+    def _genders():
+        ids = [resolve(models.Gender, name) for name, _ in GENDERS]
+        weights = np.array([weight for _, weight in GENDERS], dtype=float)
+        return ids, weights / weights.sum()
+
+    @staticmethod
+    def _pronouns():
+        # one row of pronoun ids per gender, padded to the same length
+        others = [resolve(models.Pronoun, name) for name in OTHER_PRONOUNS]
+        rows = [[resolve(models.Pronoun, PRONOUNS[name]), others[0]] if name in PRONOUNS else others
+                for name, _ in GENDERS]
+        counts = np.array([len(row) for row in rows])
+        pronouns = np.array([row + [row[0]] * (counts.max() - len(row)) for row in rows])
+        return pronouns, counts
+
+    @staticmethod
+    def _wishes():
+        resolver = bulk.WishResolver()
+        for interest in INTERESTS:
+            resolver.resolve(interest, None)
+            for gender, _ in GENDERS:
+                resolver.resolve(interest, gender)
+
+        # wishes follow a long tail: a few are very popular, most are rare
+        wishes = list(models.Wish.objects.order_by('pk').values_list('pk', flat=True))
+        weights = 1.0 / np.arange(1, len(wishes) + 1)
+        return wishes, weights / weights.sum()
@@ -0,0 +1,83 @@
+# coding=utf-8
+import csv
+import json
+import sys
+import time
+from itertools import islice
+from typing import Iterator
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from chaos_dating import bulk
+from chaos_dating import models
+from chaos_dating.vocabulary import resolve
+
+
+class Command(BaseCommand):
+    help = 'Streams profiles with their wishes from JSON lines or CSV as written by export_profiles.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='File to read from, or - for standard input.')
+        parser.add_argument('--format', choices=('jsonl', 'csv'), default=None,
+                            help='Input format; guessed from the file extension by default.')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='Number of profiles inserted per transaction.')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        format = options['format'] or ('csv' if options['input'].endswith('.csv') else 'jsonl')
+        source = sys.stdin if options['input'] == '-' else open(options['input'], newline='')
+        created = skipped = 0
+        try:
+            records = self._read(source, format)
+            wishes = bulk.WishResolver()
+            while True:
+                batch = list(islice(records, options['batch_size']))
+                if not batch:
+                    break
+                rows = [self._row(record, wishes) for record in batch]
+                batch_created, batch_skipped = bulk.create_profiles(rows)
+                created += batch_created
+                skipped += batch_skipped
+        finally:
+            if source is not sys.stdin:
+                source.close()
+
+        bulk.invalidate()
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {created} profiles, skipped {skipped} existing usernames '
+            f'in {time.perf_counter() - start:.2f}s'
+        ))
+
+    @staticmethod
+    def _read(source, format: str) -> Iterator[dict]:
+        if format == 'csv':
+            for record in csv.DictReader(source):
+                yield dict(record, wishes=json.loads(record['wishes'] or '[]'))
+            return
+
+        for number, line in enumerate(source, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                raise CommandError(f'Line {number} is no valid JSON: {e}')
+
+    @staticmethod
+    def _row(record: dict, wishes: bulk.WishResolver) -> bulk.ProfileRow:
+        try:
+            wish_ids = (wishes.resolve(wish['interest'], wish.get('gender')) for wish in record.get('wishes') or ())
+            age = int(record['age'])
+            if not 1 <= age <= 100:
+                raise ValueError(f'age {age} is out of range')
+            return bulk.ProfileRow(
+                username=record['username'],
+                age=age,
+                gender_id=resolve(models.Gender, record['gender']) if record.get('gender') else None,
+                pronoun_id=resolve(models.Pronoun, record['pronoun']) if record.get('pronoun') else None,
+                wish_ids=frozenset(pk for pk in wish_ids if pk is not None),
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            raise CommandError(f'Invalid profile {record!r}: {e}')
@@ -0,0 +1,19 @@
+# coding=utf-8
+import time
+
+from django.core.management.base import BaseCommand
+
+from chaos_dating import profile_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the in-process profile index from scratch in every process sharing the cache.'
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        generation = profile_index.bump_generation()
+        index = profile_index.get_index()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt profile index generation {generation} with {len(index)} profiles '
+            f'in {time.perf_counter() - start:.2f}s'
+        ))
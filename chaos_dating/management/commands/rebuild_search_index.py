@@ -0,0 +1,19 @@
+# coding=utf-8
+import time
+
+from django.core.management.base import BaseCommand
+
+from chaos_dating import listing
+from chaos_dating import search
+
+
+class Command(BaseCommand):
+    help = 'Rewrites the searched text of every profile, e.g. after migrating an existing database.'
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        count = search.rebuild()
+        listing.bump_data_version()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt the search index with {count} profiles in {time.perf_counter() - start:.2f}s'
+        ))
@@ -0,0 +1,22 @@
+# coding=utf-8
+import time
+
+from django.core.management.base import BaseCommand
+
+from chaos_dating import facets
+from chaos_dating import listing
+
+
+class Command(BaseCommand):
+    help = 'Recounts the profiles by gender, wish and age bucket and corrects the stored counts, e.g. periodically.'
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        wrong = facets.recount()
+        for (facet, value), (stored, actual) in sorted(wrong.items()):
+            self.stdout.write(f'{facet} {value}: stored {stored}, counted {actual}')
+        if wrong:
+            listing.bump_data_version()
+        self.stdout.write(self.style.SUCCESS(
+            f'Recounted the facets in {time.perf_counter() - start:.2f}s, corrected {len(wrong)} counts'
+        ))
@@ -0,0 +1,35 @@
+# coding=utf-8
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+
+
+class Command(BaseCommand):
+    help = 'Copies the SQLite database into the SQLite files standing in for the read replicas.'
+
+    def handle(self, *args, **options):
+        source = connections[DEFAULT_DB_ALIAS]
+        if source.vendor != 'sqlite':
+            raise CommandError(f'Replicas of {source.vendor} databases are kept current by their replication.')
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError('No replicas configured, set DJANGO_DB_REPLICAS.')
+
+        source.ensure_connection()
+        for alias in settings.DATABASE_REPLICAS:
+            start = time.perf_counter()
+            connections[alias].close()
+            target = sqlite3.connect(settings.DATABASES[alias]['NAME'])
+            try:
+                # the backup API copies a consistent snapshot even while the primary is written
+                source.connection.backup(target)
+            finally:
+                target.close()
+            self.stdout.write(self.style.SUCCESS(
+                f"Copied the database to {alias} ({settings.DATABASES[alias]['NAME']}) "
+                f"in {time.perf_counter() - start:.2f}s"
+            ))
@@ -0,0 +1,207 @@
+# coding=utf-8
+"""
+Compatibility scoring between profiles.
+
+Two profiles score one point per wish they share, and one point for every
+gender-qualified wish of one side whose gender is the gender of the other side.
+All scores are computed with sparse matrix products over the profile×wish matrix
+instead of looping over pairs of profiles in Python.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db import connections
+from django.db.models import QuerySet
+from scipy import sparse
+
+from chaos_dating import models
+from chaos_dating.hiding import NOTHING_HIDDEN
+from chaos_dating.hiding import HiddenProfiles
+
+
+class MatchEngine:
+    def __init__(self, profile_ids: np.ndarray, wishes: sparse.csr_matrix,
+                 wanted_genders: sparse.csr_matrix, genders: np.ndarray):
+        """
+        :param profile_ids: the profile ids
+        :param wishes: profile×wish matrix with a one for every wish of a profile
+        :param wanted_genders: profile×gender matrix counting the wishes qualified with each gender
+        :param genders: the gender column of each profile or -1 if it has none
+        """
+        # rows are ordered by gender, so that the profiles of each gender form a block
+        order = np.lexsort((profile_ids, genders))
+        self.profile_ids = profile_ids[order]
+        self.wishes = wishes[order]
+        self.wishes_t = self.wishes.T.tocsr()
+        self.wanted_genders = wanted_genders[order]
+        self.wanted_genders_t = self.wanted_genders.T.tocsr()
+        self.genders = genders[order]
+        present = np.unique(self.genders[self.genders >= 0])
+        bounds = zip(present.tolist(),
+                     np.searchsorted(self.genders, present, side='left').tolist(),
+                     np.searchsorted(self.genders, present, side='right').tolist())
+        self._blocks = list(bounds)
+        # ties are broken in favour of the lower profile id
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[np.argsort(self.profile_ids)] = np.arange(len(order))
+        self._tiebreak = len(order) - 1 - ranks
+        self._rows = {pk: row for row, pk in enumerate(self.profile_ids.tolist())}
+
+    @classmethod
+    def build(cls) -> 'MatchEngine':
+        """
+        Returns an engine for all profiles in the database.
+        """
+        profiles = list(models.Profile.objects.order_by('id').values_list('id', 'gender_id'))
+        profile_ids, gender_ids = zip(*profiles) if profiles else ((), ())
+        profile_ids = np.array(profile_ids, dtype=np.int64)
+        rows = {pk: row for row, pk in enumerate(profile_ids.tolist())}
+
+        wish_genders = dict(models.Wish.objects.values_list('id', 'gender_id'))
+        wish_columns = {pk: column for column, pk in enumerate(sorted(wish_genders))}
+        gender_columns = {pk: column for column, pk in enumerate(models.Gender.objects.order_by('id')
+                                                                 .values_list('id', flat=True))}
+
+        through = models.Profile.wishes.through.objects.values_list('profile_id', 'wish_id')
+        pairs = np.array([(rows[profile_id], wish_columns[wish_id])
+                          for profile_id, wish_id in through.iterator(chunk_size=10000)],
+                         dtype=np.int64).reshape(-1, 2)
+        wishes = _one_hot(pairs, (len(profile_ids), len(wish_columns)))
+
+        qualified = [(wish_columns[wish_id], gender_columns[gender_id])
+                     for wish_id, gender_id in wish_genders.items() if gender_id is not None]
+        wish_gender = _one_hot(qualified, (len(wish_columns), len(gender_columns)))
+        genders = np.array([gender_columns.get(gender_id, -1) for gender_id in gender_ids], dtype=np.int64)
+
+        return cls(profile_ids, wishes, (wishes @ wish_gender).tocsr(), genders)
+
+    def __len__(self) -> int:
+        return len(self.profile_ids)
+
+    def row(self, profile_id: int) -> Optional[int]:
+        return self._rows.get(profile_id)
+
+    def scores(self, rows: Sequence[int]) -> np.ndarray:
+        """
+        Returns the dense len(rows)×profiles matrix of scores between the given rows and all profiles.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        scores = (self.wishes[rows] @ self.wishes_t).toarray()
+
+        # the wishes of the rows qualified with the gender of each block of profiles
+        wanted = self.wanted_genders[rows].toarray()
+        for gender, start, end in self._blocks:
+            scores[:, start:end] += wanted[:, gender:gender + 1]
+
+        # the wishes of all profiles qualified with the gender of each row
+        own = self.genders[rows]
+        needed = np.unique(own[own >= 0])
+        if len(needed):
+            fitted = dict(zip(needed.tolist(), self.wanted_genders_t[needed].toarray()))
+            for index, gender in enumerate(own.tolist()):
+                if gender >= 0:
+                    scores[index] += fitted[gender]
+
+        # nobody is their own match
+        scores[np.arange(len(rows)), rows] = 0
+        return scores
+
+    def top_k_rows(self, rows: Sequence[int], k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the row indices and scores of the k best matches of each given row, best first.
+
+        Matches with a score of zero are reported with index -1.
+        """
+        scores = self.scores(rows)
+        count = scores.shape[1]
+        k = min(k, count)
+        # scores are small integers with lots of ties, which makes argpartition slow;
+        # unique keys ordering by score and then by profile id avoid that
+        keys = scores.astype(np.int64) * count + self._tiebreak
+        best = np.argpartition(keys, count - k, axis=1)[:, count - k:]
+        order = np.argsort(-np.take_along_axis(keys, best, axis=1), axis=1)
+        best = np.take_along_axis(best, order, axis=1)
+        best_scores = np.take_along_axis(scores, best, axis=1)
+        best[best_scores <= 0] = -1
+        return best, best_scores
+
+    def top_k(self, profile_id: int, k: int) -> List[Tuple[int, float]]:
+        """
+        Returns the ids and scores of the k best matches of the profile.
+        """
+        row = self.row(profile_id)
+        if row is None:
+            return []
+        best, best_scores = self.top_k_rows([row], k)
+        return [(int(self.profile_ids[index]), float(score))
+                for index, score in zip(best[0], best_scores[0]) if index >= 0]
+
+
+def _one_hot(pairs: Sequence[Tuple[int, int]], shape: Tuple[int, int]) -> sparse.csr_matrix:
+    pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+    return sparse.csr_matrix((np.ones(len(pairs), dtype=np.float32), (pairs[:, 0], pairs[:, 1])), shape=shape)
+
+
+# the engine of a pool worker, handed over by top_k_all()
+_engine: Optional[MatchEngine] = None
+
+
+def _init_worker(engine: MatchEngine):
+    global _engine
+    _engine = engine
+
+
+def _top_k_chunk(rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    return (rows,) + _engine.top_k_rows(rows, k)
+
+
+def top_k_all(engine: MatchEngine, rows: Sequence[int], k: int, workers: int = 1,
+              chunk_size: int = 256) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Yields the rows, best matches and scores of the given rows in chunks.
+
+    With more than one worker the chunks are scored in parallel by a process pool;
+    every worker receives the engine once when it starts.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    chunks = [rows[start:start + chunk_size] for start in range(0, len(rows), chunk_size)]
+    if workers <= 1:
+        for chunk in chunks:
+            yield (chunk,) + engine.top_k_rows(chunk, k)
+        return
+
+    # forked workers must not share the database connections of this process
+    connections.close_all()
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker, initargs=(engine,)) as executor:
+        yield from executor.map(_top_k_chunk, chunks, [k] * len(chunks))
+
+
+def recommendations(profile_id: int, k: Optional[int] = None, hidden: HiddenProfiles = NOTHING_HIDDEN) -> List[int]:
+    """
+    Returns the ids of the precomputed best matches of the profile, best first, without the
+    profiles hidden from the viewer.
+
+    They are computed offline by ``manage.py compute_recommendations``; with a higher ``-k``
+    than ``RECOMMENDATIONS_COUNT`` hidden profiles are replaced by the next best ones.
+    """
+    return list(_recommendations(profile_id, k or settings.RECOMMENDATIONS_COUNT, hidden))
+
+
+async def arecommendations(profile_id: int, k: Optional[int] = None,
+                           hidden: HiddenProfiles = NOTHING_HIDDEN) -> List[int]:
+    return [pk async for pk in _recommendations(profile_id, k or settings.RECOMMENDATIONS_COUNT, hidden)]
+
+
+def _recommendations(profile_id: int, k: int, hidden: HiddenProfiles) -> QuerySet:
+    return models.Recommendation.objects.filter(profile_id=profile_id) \
+        .filter(hidden.condition('recommended_id', 'recommended__user_id')) \
+        .order_by('rank').values_list('recommended_id', flat=True)[:k]
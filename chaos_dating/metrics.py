@@ -0,0 +1,278 @@
+# coding=utf-8
+"""
+Per-request timings of SQL queries and template rendering.
+
+``MetricsMiddleware`` times a sample of ``settings.METRICS_SAMPLE_RATE`` of the requests. The
+queries of every connection are timed by a wrapper installed when the connection is opened,
+templates by the ``DjangoTemplates`` backend; both only record while a sampled request is
+active, so the other requests cost one context variable lookup per query and template.
+
+The timings of a request are added to histograms per view, which the ``metrics`` view serves
+in the Prometheus text format, and sent in a ``Server-Timing`` header to the clients allowed to
+read them, see ``authorized()``. The histograms are kept per process.
+"""
+import heapq
+import hmac
+import logging
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from asgiref.sync import iscoroutinefunction
+from asgiref.sync import markcoroutinefunction
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.template.backends import django as django_backend
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERIES_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class Timings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+        self.render_depth = 0
+        # the slowest queries as a heap of (seconds, sql)
+        self.slowest: List[Tuple[float, str]] = []
+
+    def add_query(self, sql: str, duration: float):
+        self.queries += 1
+        self.sql_time += duration
+        if len(self.slowest) < settings.METRICS_SLOWEST_QUERIES:
+            heapq.heappush(self.slowest, (duration, sql))
+        elif self.slowest and duration > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (duration, sql))
+
+    def slowest_queries(self) -> List[Tuple[float, str]]:
+        return sorted(self.slowest, reverse=True)
+
+
+_timings: ContextVar[Optional[Timings]] = ContextVar('chaos_dating_timings', default=None)
+
+
+def _time_query(execute, sql, params, many, context):
+    timings = _timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add_query(sql, time.perf_counter() - start)
+
+
+def install(connection):
+    """
+    Times the queries of the connection during sampled requests.
+    """
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+class _Template(django_backend.Template):
+    def render(self, context=None, request=None):
+        timings = _timings.get()
+        if timings is None:
+            return super().render(context, request)
+
+        # templates rendered by template tags render inside their parents, only the outermost ones count
+        timings.render_depth += 1
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            timings.render_depth -= 1
+            if timings.render_depth == 0:
+                timings.render_time += time.perf_counter() - start
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    """
+    The Django template backend timing the rendering during sampled requests.
+    """
+    def from_string(self, template_code):
+        return _Template(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return _Template(super().get_template(template_name).template, self)
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        # the last count is the one of the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+HISTOGRAMS = {
+    'chaos_dating_request_duration_seconds':  ('Time spent on the request.', SECONDS_BUCKETS),
+    'chaos_dating_sql_duration_seconds':      ('Time spent on SQL queries.', SECONDS_BUCKETS),
+    'chaos_dating_sql_queries':               ('Number of SQL queries.', QUERIES_BUCKETS),
+    'chaos_dating_template_duration_seconds': ('Time spent rendering templates.', SECONDS_BUCKETS),
+}
+
+_histograms: Dict[Tuple[str, str], Histogram] = {}
+_lock = threading.Lock()
+
+
+def observe(view: str, timings: Timings, total: float):
+    values = {
+        'chaos_dating_request_duration_seconds':  total,
+        'chaos_dating_sql_duration_seconds':      timings.sql_time,
+        'chaos_dating_sql_queries':               timings.queries,
+        'chaos_dating_template_duration_seconds': timings.render_time,
+    }
+    with _lock:
+        for name, value in values.items():
+            histogram = _histograms.get((name, view))
+            if histogram is None:
+                histogram = _histograms[name, view] = Histogram(HISTOGRAMS[name][1])
+            histogram.observe(value)
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+def _label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def exposition() -> str:
+    """
+    Returns the histograms in the Prometheus text format.
+    """
+    with _lock:
+        histograms = {key: (list(histogram.counts), histogram.sum) for key, histogram in _histograms.items()}
+
+    lines = [
+        '# HELP chaos_dating_metrics_sample_rate Share of the requests that are measured.',
+        '# TYPE chaos_dating_metrics_sample_rate gauge',
+        f'chaos_dating_metrics_sample_rate {_number(float(settings.METRICS_SAMPLE_RATE))}',
+    ]
+    for name, (description, buckets) in HISTOGRAMS.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} histogram')
+        for (metric, view), (counts, total) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            view = _label(view)
+            cumulative = 0
+            for bound, count in zip([*map(_number, buckets), '+Inf'], counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{view="{view}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{view="{view}"}} {_number(total)}')
+            lines.append(f'{name}_count{{view="{view}"}} {cumulative}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def _milliseconds(seconds: float) -> str:
+    return f'{seconds * 1000:.1f}'
+
+
+def authorized(request) -> bool:
+    """
+    Returns whether the request may read the timings: by ``settings.METRICS_TOKEN`` as bearer
+    token, or as an active staff user.
+    """
+    scheme, _separator, token = request.headers.get('Authorization', '').partition(' ')
+    if settings.METRICS_TOKEN and scheme.lower() == 'bearer':
+        return hmac.compare_digest(token.encode(), settings.METRICS_TOKEN.encode())
+    user = getattr(request, 'user', None)
+    return user is not None and user.is_active and user.is_staff
+
+
+def server_timing(timings: Timings, total: float) -> str:
+    """
+    Returns the value of the ``Server-Timing`` header; SQL statements are not exposed to the client.
+    """
+    entries = [
+        f'sql;dur={_milliseconds(timings.sql_time)};desc="{timings.queries} queries"',
+        f'tpl;dur={_milliseconds(timings.render_time)}',
+    ]
+    entries.extend(f'sql-{rank};dur={_milliseconds(duration)}'
+                   for rank, (duration, sql) in enumerate(timings.slowest_queries(), 1))
+    entries.append(f'total;dur={_milliseconds(total)}')
+    return ', '.join(entries)
+
+
+class MetricsMiddleware:
+    """
+    Times a sample of the requests; belongs at the top of ``settings.MIDDLEWARE``.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self._acall(request)
+        if random.random() >= settings.METRICS_SAMPLE_RATE:
+            return self.get_response(request)
+
+        timings = Timings()
+        token = _timings.set(timings)
+        try:
+            response = self.get_response(request)
+        finally:
+            _timings.reset(token)
+
+        show = settings.METRICS_SERVER_TIMING and authorized(request)
+        return self._record(request, response, timings, show)
+
+    async def _acall(self, request):
+        if random.random() >= settings.METRICS_SAMPLE_RATE:
+            return await self.get_response(request)
+
+        # the threads running the queries of async views share the timings through the context
+        timings = Timings()
+        token = _timings.set(timings)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _timings.reset(token)
+
+        # the user is loaded from the session by a query
+        show = settings.METRICS_SERVER_TIMING and await sync_to_async(authorized)(request)
+        return self._record(request, response, timings, show)
+
+    def _record(self, request, response, timings: Timings, show: bool):
+        total = time.perf_counter() - timings.start
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unresolved'
+        observe(view, timings, total)
+        if show:
+            response['Server-Timing'] = server_timing(timings, total)
+        if total >= settings.METRICS_SLOW_REQUEST_SECONDS:
+            logger.warning('Slow request to %s took %.3fs, %d queries in %.3fs, templates %.3fs; slowest queries:%s',
+                           view, total, timings.queries, timings.sql_time, timings.render_time,
+                           ''.join(f'\n  {duration:.4f}s {sql}' for duration, sql in timings.slowest_queries()))
+        return response
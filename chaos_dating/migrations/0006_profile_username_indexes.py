@@ -0,0 +1,53 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:10
+
+from django.db import migrations, models
+from django.db.models import OuterRef
+from django.db.models import Subquery
+
+
+def copy_usernames(apps, schema_editor):
+    Profile = apps.get_model('chaos_dating', 'Profile')
+    User = apps.get_model('auth', 'User')
+    Profile.objects.update(username=Subquery(User.objects.filter(pk=OuterRef('user_id')).values('username')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chaos_dating', '0005_recommendations'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='profile',
+            options={'ordering': ['username']},
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='username',
+            field=models.CharField(default='', editable=False, max_length=150),
+        ),
+        migrations.RunPython(copy_usernames, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(fields=['username', 'id'], name='profile_username_id'),
+        ),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(fields=['age', 'id'], name='profile_age_id'),
+        ),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(fields=['gender', 'age', 'id'], name='profile_gender_age_id'),
+        ),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(fields=['gender', 'username', 'id'], name='profile_gender_username_id'),
+        ),
+        # the implicit through table only has a single column index on wish_id; this one also
+        # covers the profile ids, so wish filters never have to read the table itself
+        migrations.RunSQL(
+            'CREATE INDEX profile_wishes_wish_profile ON chaos_dating_profile_wishes (wish_id, profile_id)',
+            'DROP INDEX profile_wishes_wish_profile',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chaos_dating', '0006_profile_username_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='interest',
+            name='weight',
+            field=models.PositiveSmallIntegerField(default=1, verbose_name='Match weight'),
+        ),
+    ]
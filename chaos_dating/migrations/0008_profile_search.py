@@ -0,0 +1,104 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:38
+
+from collections import defaultdict
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+SQLITE = [
+    # external content table, the triggers keep it in sync with chaos_dating_profilesearch
+    """CREATE VIRTUAL TABLE chaos_dating_profilesearch_fts USING fts5(
+        username, terms, content='chaos_dating_profilesearch', content_rowid='profile_id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER chaos_dating_profilesearch_insert AFTER INSERT ON chaos_dating_profilesearch BEGIN
+        INSERT INTO chaos_dating_profilesearch_fts (rowid, username, terms)
+        VALUES (new.profile_id, new.username, new.terms);
+    END""",
+    """CREATE TRIGGER chaos_dating_profilesearch_delete AFTER DELETE ON chaos_dating_profilesearch BEGIN
+        INSERT INTO chaos_dating_profilesearch_fts (chaos_dating_profilesearch_fts, rowid, username, terms)
+        VALUES ('delete', old.profile_id, old.username, old.terms);
+    END""",
+    """CREATE TRIGGER chaos_dating_profilesearch_update AFTER UPDATE ON chaos_dating_profilesearch BEGIN
+        INSERT INTO chaos_dating_profilesearch_fts (chaos_dating_profilesearch_fts, rowid, username, terms)
+        VALUES ('delete', old.profile_id, old.username, old.terms);
+        INSERT INTO chaos_dating_profilesearch_fts (rowid, username, terms)
+        VALUES (new.profile_id, new.username, new.terms);
+    END""",
+]
+SQLITE_REVERSE = [
+    'DROP TRIGGER chaos_dating_profilesearch_update',
+    'DROP TRIGGER chaos_dating_profilesearch_delete',
+    'DROP TRIGGER chaos_dating_profilesearch_insert',
+    'DROP TABLE chaos_dating_profilesearch_fts',
+]
+POSTGRESQL = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX profilesearch_username_trgm ON chaos_dating_profilesearch USING gin (username gin_trgm_ops)',
+    'CREATE INDEX profilesearch_terms_trgm ON chaos_dating_profilesearch USING gin (terms gin_trgm_ops)',
+    "CREATE INDEX profilesearch_terms_tsv ON chaos_dating_profilesearch USING gin (to_tsvector('simple', terms))",
+]
+POSTGRESQL_REVERSE = [
+    'DROP INDEX profilesearch_terms_tsv',
+    'DROP INDEX profilesearch_terms_trgm',
+    'DROP INDEX profilesearch_username_trgm',
+]
+
+
+def _execute(statements):
+    def execute(apps, schema_editor):
+        # other databases are searched without an index, see chaos_dating.search
+        for statement in statements.get(schema_editor.connection.vendor, ()):
+            schema_editor.execute(statement)
+
+    return execute
+
+
+def _names(model, alias):
+    # the names of every instance in every language, like chaos_dating.vocabulary.all_names()
+    fields = [field.attname for field in model._meta.fields if field.name == 'name' or field.name.startswith('name_')]
+    return {row[0]: [name or '' for name in row[1:]] for row in model.objects.using(alias).values_list('id', *fields)}
+
+
+def fill_profile_search(apps, schema_editor):
+    # the rows chaos_dating.search.documents() writes for every existing profile
+    alias = schema_editor.connection.alias
+    Profile = apps.get_model('chaos_dating', 'Profile')
+    ProfileSearch = apps.get_model('chaos_dating', 'ProfileSearch')
+    genders = _names(apps.get_model('chaos_dating', 'Gender'), alias)
+    pronouns = _names(apps.get_model('chaos_dating', 'Pronoun'), alias)
+    interests = _names(apps.get_model('chaos_dating', 'Interest'), alias)
+
+    wishes = defaultdict(list)
+    through = Profile.wishes.through.objects.using(alias).order_by()
+    for profile_id, interest_id, gender_id in through.values_list('profile_id', 'wish__interest_id', 'wish__gender_id'):
+        wishes[profile_id] += interests.get(interest_id, []) + genders.get(gender_id, [])
+
+    rows = []
+    profiles = Profile.objects.using(alias).order_by('id').values_list('id', 'username', 'gender_id', 'pronoun_id')
+    for pk, username, gender_id, pronoun_id in profiles.iterator():
+        names = genders.get(gender_id, []) + pronouns.get(pronoun_id, []) + wishes[pk]
+        terms = ' '.join(dict.fromkeys(' '.join(name.split()) for name in names if name.strip()))
+        rows.append(ProfileSearch(profile_id=pk, username=username, terms=terms))
+    ProfileSearch.objects.using(alias).bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chaos_dating', '0007_interest_weight'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfileSearch',
+            fields=[
+                ('profile', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search', serialize=False, to='chaos_dating.profile')),
+                ('username', models.CharField(max_length=150)),
+                ('terms', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.RunPython(_execute({'sqlite': SQLITE, 'postgresql': POSTGRESQL}),
+                             _execute({'sqlite': SQLITE_REVERSE, 'postgresql': POSTGRESQL_REVERSE})),
+        # after the triggers, which copy the rows into the FTS table
+        migrations.RunPython(fill_profile_search, migrations.RunPython.noop),
+    ]
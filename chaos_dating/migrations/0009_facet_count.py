@@ -0,0 +1,52 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:45
+
+from collections import Counter
+
+from django.db import migrations, models
+from django.db.models import Count
+
+# the lowest ages of the buckets of chaos_dating.facets, whose rows every profile is counted in
+AGE_BUCKETS = (1, 18, 25, 35, 45, 55, 65)
+
+
+def count_facets(apps, schema_editor):
+    FacetCount = apps.get_model('chaos_dating', 'FacetCount')
+    Profile = apps.get_model('chaos_dating', 'Profile')
+    alias = schema_editor.connection.alias
+    profiles = Profile.objects.using(alias).order_by()
+
+    counts = Counter({('age', lower): 0 for lower in AGE_BUCKETS})
+    for gender_id, count in profiles.values_list('gender_id').annotate(count=Count('id')):
+        counts['gender', gender_id or 0] += count
+    for age, count in profiles.values_list('age').annotate(count=Count('id')):
+        counts['age', max([lower for lower in AGE_BUCKETS if lower <= age] or AGE_BUCKETS[:1])] += count
+    wishes = Profile.wishes.through.objects.using(alias).order_by().values_list('wish_id').annotate(count=Count('id'))
+    for wish_id, count in wishes:
+        counts['wish', wish_id] += count
+
+    FacetCount.objects.using(alias).bulk_create(
+        [FacetCount(facet=facet, value=value, count=count) for (facet, value), count in sorted(counts.items())]
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chaos_dating', '0008_profile_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacetCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facet', models.CharField(choices=[('gender', 'Gender'), ('wish', 'Wish'), ('age', 'Age')], max_length=8)),
+                ('value', models.PositiveIntegerField()),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('facet', 'value')},
+            },
+        ),
+        migrations.RunPython(count_facets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:50
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def number_existing_profiles(apps, schema_editor):
+    # existing profiles are no news to the searches saved from now on
+    Profile = apps.get_model('chaos_dating', 'Profile')
+    Profile.objects.using(schema_editor.connection.alias).update(change_seq=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chaos_dating', '0009_facet_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SavedSearch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, verbose_name='Name')),
+                ('query', models.TextField(blank=True)),
+                ('last_seq', models.BigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('evaluated_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='saved_searches', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['user', 'name', 'id'],
+            },
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='change_seq',
+            field=models.BigIntegerField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='SavedSearchMatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('found_at', models.DateTimeField(auto_now_add=True)),
+                ('seen', models.BooleanField(default=False)),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chaos_dating.profile')),
+                ('search', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='matches', to='chaos_dating.savedsearch')),
+            ],
+            options={
+                'ordering': ['search', '-found_at', 'id'],
+                'indexes': [models.Index(fields=['search', 'seen'], name='savedsearchmatch_search_seen')],
+                'unique_together': {('search', 'profile')},
+            },
+        ),
+        migrations.RunPython(number_existing_profiles, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:54
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chaos_dating', '0010_saved_searches'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HiddenProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('blocked', models.BooleanField(default=False, verbose_name='Blocked')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chaos_dating.profile')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hidden_profiles', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['user', '-created_at', 'id'],
+                'unique_together': {('user', 'profile')},
+            },
+        ),
+    ]
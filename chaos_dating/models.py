@@ -14,6 +14,8 @@ class Gender(models.Model):
 
 class Interest(models.Model):
     name = models.CharField(max_length=32, unique=True)
+    # how much sharing a wish of this interest counts in the best match sort, see chaos_dating.listing
+    weight = models.PositiveSmallIntegerField(_('Match weight'), default=1)
     
     def __str__(self):
         return self.name
@@ -34,23 +36,186 @@ class Wish(models.Model):
         unique_together = ["interest", "gender"]
     
     def __str__(self):
-        if self.gender is not None:
-            return f"{self.interest} {_('with')} {self.gender} {_('humans')}"
-        else:
-            return f"{self.interest}"
+        from chaos_dating.vocabulary import get_vocabulary
+        
+        return get_vocabulary().wish_label(self)
 
 
 class Profile(models.Model):
     user = models.OneToOneField(User, models.CASCADE)
+    # copy of the username, so that profile lists can be sorted without a join; kept current by the signals
+    username = models.CharField(max_length=150, default='', editable=False)
     
     age = models.PositiveIntegerField(_('Age'), validators=[validators.MinValueValidator(1),
                                                             validators.MaxValueValidator(100)])
     gender = models.ForeignKey(Gender, models.SET_NULL, null=True)
     pronoun = models.ForeignKey(Pronoun, models.SET_NULL, null=True)
     wishes = models.ManyToManyField(Wish, blank=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # the run of chaos_dating.saved_searches that saw the last change, None until the next run
+    change_seq = models.BigIntegerField(null=True, blank=True, db_index=True, editable=False)
     
     def __str__(self):
-        return self.user.username
+        return self.username
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'gender_id' in instance.__dict__ and 'age' in instance.__dict__:
+            # the stored values the facet counts are moved away from on save, see chaos_dating.signals
+            instance._stored_facets = (instance.gender_id, instance.age)
+        return instance
+    
+    def save(self, *args, **kwargs):
+        if not self.username:
+            self.username = self.user.username
+        self.change_seq = None
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'change_seq'}
+        super().save(*args, **kwargs)
+    
+    class Meta:
+        ordering = ['username']
+        indexes = [
+            # keyset pagination by each sort order, see chaos_dating.pagination
+            models.Index(fields=['username', 'id'], name='profile_username_id'),
+            models.Index(fields=['age', 'id'], name='profile_age_id'),
+            # gender filters with age ranges or either sort order
+            models.Index(fields=['gender', 'age', 'id'], name='profile_gender_age_id'),
+            models.Index(fields=['gender', 'username', 'id'], name='profile_gender_username_id'),
+        ]
+
+
+class ProfileSearch(models.Model):
+    """
+    The searched text of a profile, indexed by chaos_dating.search; kept current by the signals.
+    """
+    profile = models.OneToOneField(Profile, models.CASCADE, primary_key=True, related_name='search')
+    username = models.CharField(max_length=150)
+    # the names of the gender, pronoun and wishes in every language
+    terms = models.TextField(blank=True)
+    
+    def __str__(self):
+        return self.username
+
+
+class ProfileChange(models.Model):
+    """
+    A write of a profile, followed by the profile indexes of other processes, see
+    chaos_dating.profile_index; written by the signals and by bulk creation.
+    """
+    id = models.BigAutoField(primary_key=True)
+    # no foreign key, deleted profiles are logged as well
+    profile_id = models.IntegerField()
+    changed_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    
+    def __str__(self):
+        return f'{self.profile_id} at {self.changed_at}'
+
+
+class FacetCount(models.Model):
+    """
+    The number of profiles with a gender, wish or in an age bucket, see chaos_dating.facets; kept current by
+    the signals.
+    """
+    GENDER = 'gender'
+    WISH = 'wish'
+    AGE = 'age'
+    FACETS = (
+        (GENDER, _('Gender')),
+        (WISH, _('Wish')),
+        (AGE, _('Age')),
+    )
+    facet = models.CharField(max_length=8, choices=FACETS)
+    # the id of the gender or wish, 0 for profiles without gender, or the lowest age of the bucket
+    value = models.PositiveIntegerField()
+    count = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = ['facet', 'value']
+    
+    def __str__(self):
+        return f'{self.facet} {self.value}: {self.count}'
+
+
+class SavedSearch(models.Model):
+    """
+    A ``FilterForm`` query of a user, evaluated for new matches by chaos_dating.saved_searches.
+    """
+    user = models.ForeignKey(User, models.CASCADE, related_name='saved_searches')
+    name = models.CharField(_('Name'), max_length=64)
+    # the url encoded filter fields
+    query = models.TextField(blank=True)
+    # the highest change sequence of the profiles evaluated so far
+    last_seq = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    evaluated_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['user', 'name', 'id']
+    
+    def __str__(self):
+        return f"{self.user}: {self.name}"
+
+
+class SavedSearchMatch(models.Model):
+    search = models.ForeignKey(SavedSearch, models.CASCADE, related_name='matches')
+    profile = models.ForeignKey(Profile, models.CASCADE, related_name='+')
+    found_at = models.DateTimeField(auto_now_add=True)
+    seen = models.BooleanField(default=False)
+    
+    class Meta:
+        ordering = ['search', '-found_at', 'id']
+        unique_together = ['search', 'profile']
+        indexes = [
+            # the unseen matches of a search
+            models.Index(fields=['search', 'seen'], name='savedsearchmatch_search_seen'),
+        ]
+    
+    def __str__(self):
+        return f"{self.search} -> {self.profile}"
+
+
+class HiddenProfile(models.Model):
+    """
+    A profile a user does not want to see; blocking also hides the user from the profile, see
+    chaos_dating.hiding.
+    """
+    user = models.ForeignKey(User, models.CASCADE, related_name='hidden_profiles')
+    profile = models.ForeignKey(Profile, models.CASCADE, related_name='+')
+    blocked = models.BooleanField(_('Blocked'), default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
-        ordering = ['user__username']
+        ordering = ['user', '-created_at', 'id']
+        unique_together = ['user', 'profile']
+    
+    def __str__(self):
+        return f"{self.user} {'blocks' if self.blocked else 'hides'} {self.profile}"
+
+
+class Recommendation(models.Model):
+    profile = models.ForeignKey(Profile, models.CASCADE, related_name='recommendations')
+    recommended = models.ForeignKey(Profile, models.CASCADE, related_name='+')
+    score = models.FloatField()
+    rank = models.PositiveSmallIntegerField()
+    
+    class Meta:
+        ordering = ['profile', 'rank']
+        unique_together = ['profile', 'rank']
+    
+    def __str__(self):
+        return f"{self.profile} -> {self.recommended} ({self.score})"
+
+
+class RecommendationRun(models.Model):
+    started_at = models.DateTimeField()
+    finished_at = models.DateTimeField(null=True, blank=True)
+    incremental = models.BooleanField(default=False)
+    profiles = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        get_latest_by = 'started_at'
+    
+    def __str__(self):
+        return f"{self.started_at} ({self.profiles})"
@@ -0,0 +1,93 @@
+# coding=utf-8
+from typing import Any
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+from django.core import signing
+from django.db.models import Q
+from django.db.models import QuerySet
+
+CURSOR_SALT = 'chaos_dating.pagination.cursor'
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class Page(NamedTuple):
+    items: List[Any]
+    next_cursor: Optional[str]
+
+
+def encode_cursor(sort: str, value: Any, pk: int) -> str:
+    """
+    Returns an opaque, signed cursor pointing after the row with the given sort value and id.
+    """
+    return signing.dumps([sort, value, pk], salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(cursor: str, sort: str) -> Tuple[Any, int]:
+    """
+    Returns the sort value and id stored in the cursor.
+
+    Raises InvalidCursor if the cursor was tampered with or belongs to another sort order.
+    """
+    try:
+        cursor_sort, value, pk = signing.loads(cursor, salt=CURSOR_SALT)
+    except (signing.BadSignature, TypeError, ValueError) as e:
+        raise InvalidCursor(cursor) from e
+    if cursor_sort != sort:
+        raise InvalidCursor(cursor)
+
+    return value, pk
+
+
+def sort_key(field: str, descending: bool) -> str:
+    return f"{'-' if descending else ''}{field}"
+
+
+def _sort_value(instance, field: str) -> Any:
+    value = instance
+    for attribute in field.split('__'):
+        value = getattr(value, attribute)
+
+    return value
+
+
+def page_queryset(queryset: QuerySet, field: str, descending: bool, cursor: Optional[str]) -> QuerySet:
+    """
+    Returns the queryset ordered by the field and the id as tiebreaker, starting right after the cursor.
+    """
+    sort = sort_key(field, descending)
+    queryset = queryset.order_by(sort, '-id' if descending else 'id')
+    if cursor:
+        queryset = after_key(queryset, field, descending, *decode_cursor(cursor, sort))
+
+    return queryset
+
+
+def after_key(queryset: QuerySet, field: str, descending: bool, value: Any, pk: int) -> QuerySet:
+    """
+    Returns the rows of the queryset following the row with the given sort value and id in the sort order.
+    """
+    lookup = 'lt' if descending else 'gt'
+    return queryset.filter(Q(**{f'{field}__{lookup}': value}) | Q(**{field: value, f'id__{lookup}': pk}))
+
+
+def paginate(queryset: QuerySet, field: str, descending: bool, cursor: Optional[str], page_size: int) -> Page:
+    """
+    Returns one page of the queryset ordered by the field and the id as tiebreaker.
+
+    Instead of an OFFSET the page starts right after the cursor, so deep pages are as cheap
+    as the first one.
+    """
+    items = list(page_queryset(queryset, field, descending, cursor)[:page_size + 1])
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        last = items[-1]
+        next_cursor = encode_cursor(sort_key(field, descending), _sort_value(last, field), last.id)
+
+    return Page(items, next_cursor)
@@ -0,0 +1,504 @@
+# coding=utf-8
+"""
+In-process inverted index over the profile attributes ``FilterForm`` filters on.
+
+Every wish, gender and age maps to the set of matching profile ids, and for each sort
+order a sorted list of ``(sort value, id)`` keys is kept. Filter queries are answered by
+intersecting and uniting those sets, so only the ids of the requested page have to be
+fetched from the database. The best match sort scores only the profiles in the sets of the
+wishes of the viewer.
+
+The index lives in the memory of each process. It is built lazily on first use. The signal
+handlers in ``chaos_dating.signals`` refresh it right away for writes made by this process.
+Every write, including deletions and bulk creation, also logs the profile in ``ProfileChange``
+within its transaction. Writes of other processes move the shared data version, and
+``get_index()`` then reloads the profiles logged after the last change the index has seen. Ids
+missing below that change belong to transactions still running and are looked up again until
+they appear or ``GAP_TIMEOUT`` passes. An index more than ``CATCH_UP_LIMIT`` changes behind, or
+behind changes that were pruned from the log, is rebuilt instead. ``manage.py
+rebuild_profile_index`` bumps a generation counter in the cache, which makes every process
+sharing that cache rebuild its index on next use.
+"""
+import bisect
+import heapq
+import threading
+from collections import Counter
+from collections import defaultdict
+from datetime import datetime
+from datetime import timedelta
+from itertools import chain
+from typing import AbstractSet
+from typing import Any
+from typing import Dict
+from typing import FrozenSet
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from django.db.models import Max
+from django.db.models import Min
+from django.db.models import Q
+from django.utils import timezone
+
+from chaos_dating import caching
+from chaos_dating.db_routing import primary
+
+GENERATION_KEY = caching.cache_key('profile_index', 'generation')
+# more logged changes than this are caught up with by rebuilding the index
+CATCH_UP_LIMIT = 1000
+# seconds after which an id missing below logged changes counts as rolled back
+GAP_TIMEOUT = 60
+# seconds logged changes are kept for processes that have not caught up yet
+CHANGE_LOG_KEEP = 60 * 60
+# logged changes between two prunings of the log
+PRUNE_EVERY = 1000
+
+Key = Tuple[Any, int]
+
+
+class IndexEntry(NamedTuple):
+    username: str
+    age: int
+    gender_id: Optional[int]
+    wish_ids: FrozenSet[int]
+
+    def sort_value(self, field: str) -> Any:
+        return self.username if field == 'username' else self.age
+
+
+class ProfileIndex:
+    SORT_FIELDS = ('username', 'age')
+
+    def __init__(self, generation: int = 0, data_version: Optional[int] = None, change_id: int = 0):
+        self.generation = generation
+        # the shared data version and the last logged change the index reflects
+        self.data_version = data_version
+        self.change_id = change_id
+        # the ids missing below change_id, with the time of the change logged after them
+        self._gaps: Dict[int, datetime] = {}
+        self._lock = threading.RLock()
+        self._catch_up_lock = threading.Lock()
+        self._entries: Dict[int, IndexEntry] = {}
+        self._wishes: Dict[int, Set[int]] = defaultdict(set)
+        self._genders: Dict[Optional[int], Set[int]] = defaultdict(set)
+        self._ages: Dict[int, Set[int]] = defaultdict(set)
+        self._order: Dict[str, List[Key]] = {field: [] for field in self.SORT_FIELDS}
+        self._ids: List[int] = []
+
+    @classmethod
+    def build(cls, generation: int = 0, data_version: Optional[int] = None) -> 'ProfileIndex':
+        """
+        Returns a new index containing every profile in the database.
+        """
+        from chaos_dating import models
+
+        # before loading the profiles, so changes logged meanwhile are caught up with later
+        cutoff = timezone.now() - timedelta(seconds=GAP_TIMEOUT)
+        settled = models.ProfileChange.objects.filter(changed_at__lt=cutoff).aggregate(id=Max('id'))['id'] or 0
+        index = cls(generation, data_version, settled)
+        index._advance(models.ProfileChange.objects.order_by('id').filter(id__gt=settled)
+                       .values_list('id', 'changed_at'))
+        wishes = defaultdict(set)
+        through = models.Profile.wishes.through.objects.values_list('profile_id', 'wish_id')
+        for profile_id, wish_id in through.iterator(chunk_size=10000):
+            wishes[profile_id].add(wish_id)
+
+        profiles = models.Profile.objects.order_by().values_list('id', 'username', 'age', 'gender_id')
+        for pk, username, age, gender_id in profiles.iterator(chunk_size=10000):
+            index._add(pk, IndexEntry(username, age, gender_id, frozenset(wishes.pop(pk, ()))), sort=False)
+
+        for keys in index._order.values():
+            keys.sort()
+        index._ids.sort()
+
+        return index
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, pk: int) -> bool:
+        return pk in self._entries
+
+    def entry(self, pk: int) -> Optional[IndexEntry]:
+        return self._entries.get(pk)
+
+    def refresh(self, profile_ids: Iterable[int]):
+        """
+        Reloads the given profiles from the database and removes the ones that no longer exist.
+        """
+        from chaos_dating import models
+
+        profile_ids = set(profile_ids)
+        if not profile_ids:
+            return
+
+        wishes = defaultdict(set)
+        through = models.Profile.wishes.through.objects.filter(profile_id__in=profile_ids)
+        for profile_id, wish_id in through.values_list('profile_id', 'wish_id'):
+            wishes[profile_id].add(wish_id)
+
+        profiles = models.Profile.objects.order_by().filter(id__in=profile_ids) \
+            .values_list('id', 'username', 'age', 'gender_id')
+        entries = {pk: IndexEntry(username, age, gender_id, frozenset(wishes[pk]))
+                   for pk, username, age, gender_id in profiles}
+
+        with self._lock:
+            for pk in profile_ids:
+                self._remove(pk)
+                if pk in entries:
+                    self._add(pk, entries[pk])
+
+    def catch_up(self, data_version: int) -> bool:
+        """
+        Reloads the profiles changed by any process since the index last caught up and marks it
+        as current for the data version. Returns False if the index is too far behind and has to
+        be rebuilt instead.
+        """
+        from chaos_dating import models
+
+        with self._catch_up_lock:
+            if self.data_version == data_version:
+                return True
+
+            changes = models.ProfileChange.objects.order_by('id') \
+                .filter(Q(id__gt=self.change_id) | Q(id__in=list(self._gaps)))
+            rows = list(changes.values_list('id', 'profile_id', 'changed_at')[:CATCH_UP_LIMIT + 1])
+            new = [row for row in rows if row[0] > self.change_id]
+            if len(rows) > CATCH_UP_LIMIT or (new and new[-1][0] - self.change_id > 2 * CATCH_UP_LIMIT):
+                return False
+            if new and new[0][0] > self.change_id + 1 \
+                    and models.ProfileChange.objects.aggregate(id=Min('id'))['id'] > self.change_id + 1:
+                # the changes after the last one seen were pruned
+                return False
+
+            self.refresh(profile_id for _, profile_id, _ in rows)
+            self._advance((pk, changed_at) for pk, _, changed_at in rows)
+            self.data_version = data_version
+            return True
+
+    def _advance(self, changes: Iterable[Tuple[int, datetime]]):
+        # marks the logged changes as seen, in ascending order of their ids
+        for pk, changed_at in changes:
+            if pk > self.change_id:
+                self._gaps.update(dict.fromkeys(range(self.change_id + 1, pk), changed_at))
+                self.change_id = pk
+            else:
+                self._gaps.pop(pk, None)
+        cutoff = timezone.now() - timedelta(seconds=GAP_TIMEOUT)
+        self._gaps = {pk: since for pk, since in self._gaps.items() if since >= cutoff}
+
+    def _add(self, pk: int, entry: IndexEntry, sort: bool = True):
+        self._entries[pk] = entry
+        self._genders[entry.gender_id].add(pk)
+        self._ages[entry.age].add(pk)
+        for wish_id in entry.wish_ids:
+            self._wishes[wish_id].add(pk)
+        for field, keys in self._order.items():
+            key = (entry.sort_value(field), pk)
+            if sort:
+                bisect.insort(keys, key)
+            else:
+                keys.append(key)
+        if sort:
+            bisect.insort(self._ids, pk)
+        else:
+            self._ids.append(pk)
+
+    def _remove(self, pk: int):
+        entry = self._entries.pop(pk, None)
+        if entry is None:
+            return
+
+        self._genders[entry.gender_id].discard(pk)
+        self._ages[entry.age].discard(pk)
+        for wish_id in entry.wish_ids:
+            self._wishes[wish_id].discard(pk)
+        for field, keys in self._order.items():
+            key = (entry.sort_value(field), pk)
+            position = bisect.bisect_left(keys, key)
+            if position < len(keys) and keys[position] == key:
+                del keys[position]
+        position = bisect.bisect_left(self._ids, pk)
+        if position < len(self._ids) and self._ids[position] == pk:
+            del self._ids[position]
+
+    def _union(self, sets: Dict[Any, Set[int]], keys: Iterable[Any]) -> Set[int]:
+        matches = [sets[key] for key in keys if key in sets]
+        return set().union(*matches) if matches else set()
+
+    def _matching(self, sets: Dict[Any, Set[int]], keys: Iterable[Any], threshold: int) -> Set[int]:
+        # the ids contained in at least threshold of the sets of the keys
+        matches = sorted((sets[key] for key in keys if key in sets), key=len)
+        if threshold <= 1:
+            return set().union(*matches)
+        if threshold > len(matches):
+            return set()
+        if threshold == len(matches):
+            return matches[0].intersection(*matches[1:])
+
+        counts = Counter(chain.from_iterable(matches))
+        return {pk for pk, count in counts.items() if count >= threshold}
+
+    def candidates(self, cleaned_data: dict) -> Optional[Set[int]]:
+        """
+        Returns the ids matching the gender and wish criteria, or None if there are none.
+
+        The age range is only used to narrow the result if it is more selective than the
+        other criteria; callers still have to check the age of each candidate.
+        """
+        sets = []
+        if cleaned_data.get('gender'):
+            sets.append(self._union(self._genders, (gender.pk for gender in cleaned_data['gender'])))
+        if cleaned_data.get('wishes'):
+            from chaos_dating.listing import wish_threshold
+
+            sets.append(self._matching(self._wishes, (wish.pk for wish in cleaned_data['wishes']),
+                                       wish_threshold(cleaned_data)))
+        if not sets:
+            return None
+
+        sets.sort(key=len)
+        min_age = cleaned_data.get('min_age') or 1
+        max_age = cleaned_data.get('max_age') or 100
+        ages = [self._ages[age] for age in range(min_age, max_age + 1) if age in self._ages]
+        if sum(len(profiles) for profiles in ages) < len(sets[0]):
+            # a narrow age range is the most selective criterion
+            sets.insert(0, set().union(*ages))
+
+        return sets[0].intersection(*sets[1:])
+
+    def facet_counts(self, cleaned_data: dict) -> Tuple[Counter, Counter, Counter]:
+        """
+        Returns the numbers of matching profiles by gender id, wish id and age, each counting
+        the profiles matching the criteria of the other two.
+        """
+        with self._lock:
+            genders = wishes = ages = None
+            if cleaned_data.get('gender'):
+                genders = self._union(self._genders, (gender.pk for gender in cleaned_data['gender']))
+            if cleaned_data.get('wishes'):
+                from chaos_dating.listing import wish_threshold
+
+                wishes = self._matching(self._wishes, (wish.pk for wish in cleaned_data['wishes']),
+                                        wish_threshold(cleaned_data))
+            if cleaned_data.get('min_age') or cleaned_data.get('max_age'):
+                min_age = cleaned_data.get('min_age') or 1
+                max_age = cleaned_data.get('max_age') or 100
+                ages = set().union(*(self._ages[age] for age in range(min_age, max_age + 1) if age in self._ages))
+
+            return (self._count(self._genders, lambda entry: (entry.gender_id,), wishes, ages),
+                    self._count(self._wishes, lambda entry: entry.wish_ids, genders, ages),
+                    self._count(self._ages, lambda entry: (entry.age,), genders, wishes))
+
+    def _count(self, sets: Dict[Any, Set[int]], values, *criteria: Optional[Set[int]]) -> Counter:
+        criteria = sorted((ids for ids in criteria if ids is not None), key=len)
+        if not criteria:
+            return Counter({key: len(ids) for key, ids in sets.items() if ids})
+
+        counts = Counter()
+        for pk in criteria[0].intersection(*criteria[1:]):
+            counts.update(values(self._entries[pk]))
+        return counts
+
+    def _row_filter(self, cleaned_data: dict, exclude: AbstractSet[int]):
+        # the age range and the excluded ids, checked per candidate
+        min_age = cleaned_data.get('min_age') or None
+        max_age = cleaned_data.get('max_age') or None
+
+        def row_matches(pk: int) -> bool:
+            age = self._entries[pk].age
+            return ((min_age is None or age >= min_age) and (max_age is None or age <= max_age)
+                    and pk not in exclude)
+
+        return row_matches
+
+    def search(self, cleaned_data: dict, field: str, descending: bool,
+               after: Optional[Key], limit: int, exclude: AbstractSet[int] = frozenset()) -> List[Key]:
+        """
+        Returns up to limit ``(sort value, id)`` keys of matching profiles following the key after,
+        leaving out the excluded ids.
+        """
+        min_age = cleaned_data.get('min_age') or None
+        max_age = cleaned_data.get('max_age') or None
+        row_matches = self._row_filter(cleaned_data, exclude)
+
+        with self._lock:
+            candidates = self.candidates(cleaned_data)
+            keys = self._order[field]
+            if candidates is not None and len(candidates) * 8 < len(keys):
+                return self._select(candidates, field, descending, after, limit, row_matches)
+
+            lower, upper = 0, len(keys)
+            if field == 'age':
+                # the keys are sorted by age first, so the age range is a slice of them
+                if min_age is not None:
+                    lower = bisect.bisect_left(keys, (min_age,))
+                if max_age is not None:
+                    upper = bisect.bisect_left(keys, (max_age + 1,))
+
+            return self._scan(keys, lower, upper, candidates, descending, after, limit, row_matches)
+
+    def match_scores(self, weights: Dict[int, int]) -> Counter:
+        """
+        Returns the sum of the weights of the shared wishes by profile id for every profile sharing any.
+        """
+        scores = Counter()
+        with self._lock:
+            for wish_id, weight in weights.items():
+                for pk in self._wishes.get(wish_id, ()):
+                    scores[pk] += weight
+
+        return scores
+
+    def search_matches(self, cleaned_data: dict, weights: Dict[int, int],
+                       after: Optional[Key], limit: int, exclude: AbstractSet[int] = frozenset()) -> List[Key]:
+        """
+        Returns up to limit ``(score, id)`` keys of matching profiles following the key after, best first.
+
+        Profiles sharing none of the weighted wishes score zero and follow by descending id. The
+        excluded ids are left out.
+        """
+        row_matches = self._row_filter(cleaned_data, exclude)
+        after = tuple(after) if after is not None else None
+        with self._lock:
+            candidates = self.candidates(cleaned_data)
+
+            def matches(pk: int) -> bool:
+                return (candidates is None or pk in candidates) and row_matches(pk)
+
+            scores = self.match_scores(weights)
+            keys = ((score, pk) for pk, score in scores.items() if matches(pk))
+            if after is not None:
+                keys = (key for key in keys if key < after)
+            result = heapq.nlargest(limit, keys)
+            if len(result) == limit:
+                return result
+
+            # the cursor is within the profiles without shared wishes if its score is zero
+            below = after[1] if after is not None and after[0] == 0 else None
+            rest = limit - len(result)
+            if candidates is not None and len(candidates) * 8 < len(self._ids):
+                ids = heapq.nlargest(rest, (pk for pk in candidates
+                                            if pk not in scores and row_matches(pk) and (below is None or pk < below)))
+            else:
+                ids = []
+                upper = bisect.bisect_left(self._ids, below) if below is not None else len(self._ids)
+                for position in range(upper - 1, -1, -1):
+                    pk = self._ids[position]
+                    if pk not in scores and matches(pk):
+                        ids.append(pk)
+                        if len(ids) == rest:
+                            break
+
+            return result + [(0, pk) for pk in ids]
+
+    def _select(self, candidates, field, descending, after, limit, row_matches) -> List[Key]:
+        # few candidates: pick the smallest keys directly instead of walking the whole order
+        keys = ((self._entries[pk].sort_value(field), pk) for pk in candidates if row_matches(pk))
+        if after is not None:
+            after = tuple(after)
+            keys = (key for key in keys if (key < after if descending else key > after))
+
+        if descending:
+            return heapq.nlargest(limit, keys)
+
+        return heapq.nsmallest(limit, keys)
+
+    def _scan(self, keys, lower, upper, candidates, descending, after, limit, row_matches) -> List[Key]:
+        # many candidates: walk the sorted keys from the cursor until the page is full
+        if descending:
+            if after is not None:
+                upper = min(upper, bisect.bisect_left(keys, tuple(after)))
+            positions = range(upper - 1, lower - 1, -1)
+        else:
+            if after is not None:
+                lower = max(lower, bisect.bisect_right(keys, tuple(after)))
+            positions = range(lower, upper)
+
+        result = []
+        for position in positions:
+            key = keys[position]
+            if (candidates is None or key[1] in candidates) and row_matches(key[1]):
+                result.append(key)
+                if len(result) == limit:
+                    break
+
+        return result
+
+
+_index: Optional[ProfileIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> ProfileIndex:
+    """
+    Returns the index of this process, built if it is missing or outdated and caught up with
+    the changes of other processes if the data version moved.
+    """
+    from chaos_dating.listing import DATA_VERSION_KEY
+
+    global _index
+    versions = caching.versions([GENERATION_KEY, DATA_VERSION_KEY])
+    generation, data_version = versions[GENERATION_KEY], versions[DATA_VERSION_KEY]
+    index = _index
+    if index is None or index.generation != generation:
+        with _index_lock:
+            if _index is None or _index.generation != generation:
+                with primary():
+                    _index = ProfileIndex.build(generation, data_version)
+            index = _index
+
+    if index.data_version != data_version:
+        # a lagging replica would mark the index current with the previous state
+        with primary():
+            if not index.catch_up(data_version):
+                with _index_lock:
+                    if _index is index:
+                        _index = ProfileIndex.build(generation, data_version)
+                    index = _index
+
+    return index
+
+
+def current_index() -> Optional[ProfileIndex]:
+    """
+    Returns the index of this process if it was built already.
+    """
+    return _index
+
+
+def reset():
+    """
+    Drops the index of this process; it is rebuilt on next use.
+    """
+    global _index
+    _index = None
+
+
+def log_changes(profile_ids: Iterable[int]):
+    """
+    Logs writes of the given profiles for the indexes of all processes, in the transaction of
+    the writes.
+    """
+    from chaos_dating import models
+
+    changes = models.ProfileChange.objects.bulk_create(
+        [models.ProfileChange(profile_id=pk) for pk in sorted(set(profile_ids))]
+    )
+    if changes and changes[-1].pk is not None and changes[-1].pk % PRUNE_EVERY < len(changes):
+        # by id, so an index behind the pruned changes finds the oldest one left above its last one
+        cutoff = timezone.now() - timedelta(seconds=CHANGE_LOG_KEEP)
+        old = models.ProfileChange.objects.filter(changed_at__lt=cutoff, id__lt=changes[-1].pk)
+        pruned = old.aggregate(id=Max('id'))['id']
+        if pruned is not None:
+            models.ProfileChange.objects.filter(id__lte=pruned).delete()
+
+
+def bump_generation() -> int:
+    """
+    Invalidates the indexes of all processes sharing the cache.
+    """
+    return caching.bump(GENERATION_KEY)
@@ -0,0 +1,65 @@
+# coding=utf-8
+"""
+Compact records for the JSON profile API.
+
+Profiles are serialized as rows of ids and plain values; the labels of genders,
+pronouns and wishes are shipped separately in the vocabulary tables, which clients
+cache until the vocabulary version changes.
+"""
+from collections import defaultdict
+from typing import Iterable
+from typing import List
+from typing import Sequence
+
+from chaos_dating import models
+from chaos_dating.vocabulary import get_vocabulary
+
+PROFILE_FIELDS = ('id', 'username', 'age', 'gender', 'pronoun', 'wishes')
+
+_COLUMNS = {
+    'id':       'id',
+    'username': 'username',
+    'age':      'age',
+    'gender':   'gender_id',
+    'pronoun':  'pronoun_id',
+}
+
+
+def profile_records(profile_ids: Iterable[int], fields: Sequence[str]) -> List[list]:
+    """
+    Returns one row per existing profile in the given order with the values of the given fields.
+    """
+    profile_ids = list(profile_ids)
+    columns = ['id'] + [_COLUMNS[field] for field in fields if field in _COLUMNS]
+    rows = {row[0]: row[1:] for row in models.Profile.objects.order_by()
+            .filter(id__in=profile_ids).values_list(*columns)}
+    wishes = defaultdict(list)
+    if 'wishes' in fields:
+        through = models.Profile.wishes.through.objects.filter(profile_id__in=rows.keys()).order_by('wish_id')
+        for profile_id, wish_id in through.values_list('profile_id', 'wish_id'):
+            wishes[profile_id].append(wish_id)
+
+    records = []
+    for pk in profile_ids:
+        if pk not in rows:
+            continue
+        values = iter(rows[pk])
+        records.append([wishes[pk] if field == 'wishes' else next(values) for field in fields])
+
+    return records
+
+
+def vocabulary_tables() -> dict:
+    """
+    Returns the translated labels of all genders, pronouns and wishes by id.
+
+    Their version is the shared one the profile API sends, not a snapshot of this process lagging
+    behind it.
+    """
+    vocabulary = get_vocabulary(current=True)
+    return {
+        'version':  vocabulary.version,
+        'genders':  vocabulary.labels(models.Gender),
+        'pronouns': vocabulary.labels(models.Pronoun),
+        'wishes':   vocabulary.labels(models.Wish),
+    }
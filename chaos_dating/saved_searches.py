@@ -0,0 +1,232 @@
+# coding=utf-8
+"""
+Saved ``FilterForm`` queries and their new matches.
+
+Every change of a profile resets its ``change_seq`` to None: ``Profile.save()`` does it, and so
+do the updates of the signal handlers for wishes and usernames. The periodic job in
+``evaluate()`` first numbers all of those profiles with the next change sequence. A profile
+committed after that step keeps None until the next run, so the sequence increases in commit
+order and no change is missed.
+
+Every saved search remembers the highest change sequence evaluated for it. A run loads only the
+profiles changed since the oldest of these marks, in batches, and matches each of them against
+the searches for its gender and the searches without a gender. The cost grows with the number
+of changes, not with the number of searches times the number of profiles. Matches are stored
+in ``SavedSearchMatch`` until the user marks them as seen.
+
+The job is meant to run in one process at a time, e.g. ``manage.py evaluate_saved_searches``
+from cron.
+"""
+from collections import defaultdict
+from typing import Dict
+from typing import FrozenSet
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+from django.contrib.auth.models import User
+from django.db import connections
+from django.db import router
+from django.db import transaction
+from django.db.models import Max
+from django.http import QueryDict
+from django.utils import timezone
+
+from chaos_dating import models
+from chaos_dating.db_routing import primary
+from chaos_dating.forms import FilterForm
+from chaos_dating.listing import wish_threshold
+
+BATCH_SIZE = 1000
+
+# the key of the PostgreSQL advisory lock numbering the changes
+STAMP_LOCK = 0x5ea4c4
+
+# the id, user id, gender id, age, change sequence and wish ids of a changed profile
+ChangedProfile = Tuple[int, int, Optional[int], int, int, FrozenSet[int]]
+
+
+class Criteria(NamedTuple):
+    gender_ids: FrozenSet[int]
+    wish_ids: FrozenSet[int]
+    threshold: int
+    min_age: Optional[int]
+    max_age: Optional[int]
+
+    @classmethod
+    def from_cleaned_data(cls, cleaned_data: dict) -> 'Criteria':
+        return cls(frozenset(gender.pk for gender in cleaned_data.get('gender') or ()),
+                   frozenset(wish.pk for wish in cleaned_data.get('wishes') or ()),
+                   wish_threshold(cleaned_data), cleaned_data.get('min_age'), cleaned_data.get('max_age'))
+
+    def matches(self, gender_id: Optional[int], age: int, wish_ids: FrozenSet[int]) -> bool:
+        """
+        Returns whether a profile with the given gender, age and wishes matches, like ``filter_profiles()``.
+        """
+        if self.gender_ids and gender_id not in self.gender_ids:
+            return False
+        if self.min_age and age < self.min_age:
+            return False
+        if self.max_age and age > self.max_age:
+            return False
+        return not self.wish_ids or len(self.wish_ids & wish_ids) >= self.threshold
+
+
+def query_string(cleaned_data: dict) -> str:
+    """
+    Returns the url encoded query of the cleaned data of a ``FilterForm`` to save, without the sort fields.
+    """
+    query = QueryDict(mutable=True)
+    query.setlist('gender', sorted(str(gender.pk) for gender in cleaned_data.get('gender') or ()))
+    query.setlist('wishes', sorted(str(wish.pk) for wish in cleaned_data.get('wishes') or ()))
+    for field in ('wish_match', 'wish_min_count', 'min_age', 'max_age'):
+        if cleaned_data.get(field):
+            query[field] = str(cleaned_data[field])
+    return query.urlencode()
+
+
+def cleaned_query(search: models.SavedSearch) -> Optional[dict]:
+    """
+    Returns the cleaned data of the query of a saved search, or None if it is no longer valid,
+    e.g. because a selected wish was deleted.
+    """
+    form = FilterForm(QueryDict(search.query))
+    return form.cleaned_data if form.is_valid() else None
+
+
+def current_seq() -> int:
+    """
+    Returns the highest change sequence numbered so far.
+
+    The profiles numbered last may have changed again since, so the marks of the saved searches
+    count as well; otherwise their next number could be one the searches have already evaluated.
+    """
+    with primary():
+        profiles = models.Profile.objects.aggregate(seq=Max('change_seq'))['seq'] or 0
+        searches = models.SavedSearch.objects.aggregate(seq=Max('last_seq'))['seq'] or 0
+    return max(profiles, searches)
+
+
+def save_search(user: User, name: str, cleaned_data: dict) -> models.SavedSearch:
+    """
+    Saves the query of a ``FilterForm``; profiles changed from now on are evaluated for it.
+
+    The changes made so far are numbered first, so they do not count as new matches later.
+    """
+    return models.SavedSearch.objects.create(user=user, name=name, query=query_string(cleaned_data),
+                                             last_seq=stamp_changes())
+
+
+def stamp_changes() -> int:
+    """
+    Numbers the profiles changed since the last call with the next change sequence and returns
+    the highest change sequence.
+    """
+    with primary(), transaction.atomic():
+        connection = connections[router.db_for_write(models.Profile)]
+        if connection.vendor == 'postgresql':
+            # two callers, e.g. evaluate() and save_search(), must not number with the same sequence
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', [STAMP_LOCK])
+        seq = current_seq()
+        if models.Profile.objects.filter(change_seq__isnull=True).update(change_seq=seq + 1):
+            seq += 1
+
+    return seq
+
+
+def _profiles(low: int, high: int, batch_size: int) -> Iterable[List[ChangedProfile]]:
+    # the changed profiles with their wishes in batches of ascending ids
+    profiles = models.Profile.objects.order_by('id').filter(change_seq__gt=low, change_seq__lte=high)
+    last_id = 0
+    while True:
+        batch = list(profiles.filter(id__gt=last_id)
+                     .values_list('id', 'user_id', 'gender_id', 'age', 'change_seq')[:batch_size])
+        if not batch:
+            return
+        wishes = defaultdict(set)
+        through = models.Profile.wishes.through.objects.filter(profile_id__in=[row[0] for row in batch])
+        for profile_id, wish_id in through.values_list('profile_id', 'wish_id'):
+            wishes[profile_id].add(wish_id)
+        yield [row + (frozenset(wishes[row[0]]),) for row in batch]
+        if len(batch) < batch_size:
+            return
+        last_id = batch[-1][0]
+
+
+def evaluate(batch_size: int = BATCH_SIZE) -> Tuple[int, int, int]:
+    """
+    Matches the profiles changed since their last evaluation against all saved searches.
+
+    Returns the numbers of evaluated searches, changed profiles and new matches.
+    """
+    with primary():
+        seq = stamp_changes()
+        searches = list(models.SavedSearch.objects.filter(last_seq__lt=seq).order_by('id'))
+        if not searches:
+            return 0, 0, 0
+
+        # searches without a gender under None
+        by_gender: Dict[Optional[int], List[Tuple[models.SavedSearch, Criteria]]] = defaultdict(list)
+        for search in searches:
+            cleaned_data = cleaned_query(search)
+            if cleaned_data is None:
+                # matches nothing until the user saves it again
+                continue
+            criteria = Criteria.from_cleaned_data(cleaned_data)
+            for gender_id in criteria.gender_ids or (None,):
+                by_gender[gender_id].append((search, criteria))
+
+        profiles = matches = 0
+        for batch in _profiles(min(search.last_seq for search in searches), seq, batch_size):
+            found = []
+            for profile_id, user_id, gender_id, age, change_seq, wish_ids in batch:
+                candidates = by_gender.get(None, [])
+                if gender_id is not None:
+                    candidates = candidates + by_gender.get(gender_id, [])
+                for search, criteria in candidates:
+                    if (change_seq > search.last_seq and search.user_id != user_id
+                            and criteria.matches(gender_id, age, wish_ids)):
+                        found.append(models.SavedSearchMatch(search=search, profile_id=profile_id))
+            # a profile changed again before it was seen stays one unseen match
+            models.SavedSearchMatch.objects.bulk_create(found, ignore_conflicts=True)
+            profiles += len(batch)
+            matches += len(found)
+
+        models.SavedSearch.objects.filter(pk__in=[search.pk for search in searches], last_seq__lt=seq) \
+            .update(last_seq=seq, evaluated_at=timezone.now())
+
+    return len(searches), profiles, matches
+
+
+def new_match_count(user: User) -> int:
+    """
+    Returns the number of unseen matches of the saved searches of the user.
+    """
+    return models.SavedSearchMatch.objects.filter(search__user=user, seen=False).count()
+
+
+def new_matches(user: User) -> Tuple[int, Dict[int, List[int]]]:
+    """
+    Returns the highest id of the unseen matches of the saved searches of the user, or 0, and the
+    ids of their profiles by saved search, newest first.
+    """
+    unseen = models.SavedSearchMatch.objects.filter(search__user=user, seen=False)
+    rows = list(unseen.order_by('search', '-found_at', '-id').values_list('id', 'search_id', 'profile_id'))
+
+    matches = defaultdict(list)
+    for pk, search_id, profile_id in rows:
+        matches[search_id].append(profile_id)
+    return max((row[0] for row in rows), default=0), matches
+
+
+def mark_seen(user: User, last_id: int) -> int:
+    """
+    Marks the unseen matches of the saved searches of the user up to the given id as seen, but not
+    the ones found after they were shown, and returns their number.
+    """
+    with primary():
+        return models.SavedSearchMatch.objects.filter(search__user=user, seen=False, pk__lte=last_id) \
+            .update(seen=True)
@@ -0,0 +1,277 @@
+# coding=utf-8
+"""
+Full-text and fuzzy search over the usernames of the profiles and the names of their gender,
+pronoun and wishes in every language.
+
+The searched text of every profile is stored in ``ProfileSearch`` and refreshed by the signal
+handlers in ``chaos_dating.signals`` once a change is committed. On SQLite it is indexed by an
+FTS5 table with the trigram tokenizer, which finds any part of a word with three or more
+characters; on PostgreSQL by pg_trgm and a tsvector index. Words without a match in the text
+are looked up by their trigrams, which finds names with typos.
+
+The vocabulary itself, e.g. interests to filter by, is searched in the process-local vocabulary.
+"""
+from itertools import chain
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from django.conf import settings
+from django.db import connections
+from django.db import router
+from django.db import transaction
+from django.db.models import Model
+from django.db.models import Q
+from django.utils.translation import get_language
+
+from chaos_dating import caching
+from chaos_dating import models
+from chaos_dating.db_routing import primary
+from chaos_dating.hiding import NOTHING_HIDDEN
+from chaos_dating.hiding import HiddenProfiles
+from chaos_dating.listing import data_version
+from chaos_dating.vocabulary import Vocabulary
+from chaos_dating.vocabulary import all_names
+from chaos_dating.vocabulary import get_vocabulary
+from chaos_dating.vocabulary import normalize
+
+FTS_TABLE = 'chaos_dating_profilesearch_fts'
+# the trigram index cannot find shorter parts of words
+MIN_WORD_LENGTH = 3
+# usernames rank above the names of genders, pronouns and wishes
+USERNAME_WEIGHT = 10.0
+BATCH_SIZE = 1000
+
+_suggestions = caching.LRUCache(settings.PROFILE_RESULTS_CACHE_SIZE, settings.PROFILE_RESULTS_CACHE_TIMEOUT)
+
+
+class _Instances:
+    # the instances of the vocabulary, loading those newer than the vocabulary of this process
+    def __init__(self, vocabulary: Vocabulary):
+        self.vocabulary = vocabulary
+        self.missing: Dict[tuple, Model] = {}
+
+    def load(self, model: type, ids: Iterable[Optional[int]]):
+        ids = {pk for pk in ids if pk is not None and self.vocabulary.get(model, pk) is None}
+        if ids:
+            self.missing.update(((model, pk), instance) for pk, instance in model.objects.in_bulk(ids).items())
+
+    def get(self, model: type, pk: Optional[int]) -> Optional[Model]:
+        if pk is None:
+            return None
+        return self.vocabulary.get(model, pk) or self.missing.get((model, pk))
+
+
+def documents(profile_ids: Iterable[int]) -> List[models.ProfileSearch]:
+    """
+    Returns the unsaved search rows of the existing profiles among the given ones.
+    """
+    profiles = list(models.Profile.objects.order_by().filter(pk__in=list(profile_ids))
+                    .values_list('id', 'username', 'gender_id', 'pronoun_id'))
+    wishes = {}
+    through = models.Profile.wishes.through.objects.filter(profile_id__in=[row[0] for row in profiles])
+    for profile_id, interest_id, gender_id in through.values_list('profile_id', 'wish__interest_id',
+                                                                   'wish__gender_id'):
+        wishes.setdefault(profile_id, []).append((interest_id, gender_id))
+
+    instances = _Instances(get_vocabulary())
+    all_wishes = list(chain.from_iterable(wishes.values()))
+    instances.load(models.Gender, chain((row[2] for row in profiles), (gender_id for _, gender_id in all_wishes)))
+    instances.load(models.Pronoun, (row[3] for row in profiles))
+    instances.load(models.Interest, (interest_id for interest_id, _ in all_wishes))
+
+    rows = []
+    for pk, username, gender_id, pronoun_id in profiles:
+        names = all_names(instances.get(models.Gender, gender_id))
+        names += all_names(instances.get(models.Pronoun, pronoun_id))
+        for interest_id, wish_gender_id in wishes.get(pk, ()):
+            names += all_names(instances.get(models.Interest, interest_id))
+            names += all_names(instances.get(models.Gender, wish_gender_id))
+        terms = ' '.join(dict.fromkeys(' '.join(name.split()) for name in names if name.strip()))
+        rows.append(models.ProfileSearch(profile_id=pk, username=username, terms=terms))
+
+    return rows
+
+
+def refresh(profile_ids: Iterable[int]):
+    """
+    Rewrites the search rows of the given profiles, dropping those of deleted profiles.
+    """
+    profile_ids = sorted(set(profile_ids))
+    with primary(), transaction.atomic():
+        for start in range(0, len(profile_ids), BATCH_SIZE):
+            batch = profile_ids[start:start + BATCH_SIZE]
+            models.ProfileSearch.objects.filter(profile_id__in=batch).delete()
+            models.ProfileSearch.objects.bulk_create(documents(batch))
+
+
+def rebuild() -> int:
+    """
+    Rewrites the search rows of all profiles and returns their number.
+    """
+    with primary():
+        profile_ids = list(models.Profile.objects.order_by('id').values_list('id', flat=True))
+        with transaction.atomic():
+            models.ProfileSearch.objects.all().delete()
+            refresh(profile_ids)
+
+    return len(profile_ids)
+
+
+def affected_profiles(instance: Model) -> List[int]:
+    """
+    Returns the ids of the profiles whose search rows contain the name of the vocabulary instance.
+    """
+    conditions = {
+        models.Gender:   Q(gender=instance) | Q(wishes__gender=instance),
+        models.Pronoun:  Q(pronoun=instance),
+        models.Interest: Q(wishes__interest=instance),
+        models.Wish:     Q(wishes=instance),
+    }
+    return list(models.Profile.objects.order_by().filter(conditions[type(instance)])
+                .values_list('id', flat=True).distinct())
+
+
+def _words(query: str) -> List[str]:
+    return list(dict.fromkeys(normalize(query).split()))
+
+
+def _phrase(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _trigrams(words: List[str]) -> List[str]:
+    return list(dict.fromkeys(word[i:i + MIN_WORD_LENGTH] for word in words
+                              for i in range(len(word) - MIN_WORD_LENGTH + 1)))
+
+
+def _search_sqlite(cursor, words: List[str], with_terms: bool, limit: int,
+                   hidden: HiddenProfiles) -> List[Tuple[int, str]]:
+    columns = '' if with_terms else '{username} : '
+    weights = f'{USERNAME_WEIGHT}, 1.0'
+    visible, params = hidden.sql(f'{FTS_TABLE}.rowid')
+    sql = (f'SELECT rowid, username FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s AND {visible} '
+           f'ORDER BY bm25({FTS_TABLE}, {weights}), rowid LIMIT %s')
+    # every word as part of a name, otherwise any of their trigrams for names with typos
+    cursor.execute(sql, [columns + '(' + ' AND '.join(map(_phrase, words)) + ')'] + params + [limit])
+    rows = cursor.fetchall()
+    if not rows:
+        cursor.execute(sql, [columns + '(' + ' OR '.join(map(_phrase, _trigrams(words))) + ')'] + params + [limit])
+        rows = cursor.fetchall()
+
+    return rows
+
+
+def _search_postgresql(cursor, words: List[str], with_terms: bool, limit: int,
+                       hidden: HiddenProfiles) -> List[Tuple[int, str]]:
+    text = ' '.join(words)
+    # word_similarity finds the words also as part of longer ones and with typos
+    if with_terms:
+        condition = ("%s <%% username OR %s <%% terms "
+                     "OR to_tsvector('simple', terms) @@ plainto_tsquery('simple', %s)")
+        rank = f'greatest({USERNAME_WEIGHT} * word_similarity(%s, username), word_similarity(%s, terms))'
+        condition_params, rank_params = [text, text, text], [text, text]
+    else:
+        condition = '%s <%% username'
+        rank = 'word_similarity(%s, username)'
+        condition_params, rank_params = [text], [text]
+    table = models.ProfileSearch._meta.db_table
+    visible, visible_params = hidden.sql(f'{table}.profile_id')
+    cursor.execute(f'SELECT profile_id, username FROM {table} '
+                   f'WHERE ({condition}) AND {visible} ORDER BY {rank} DESC, profile_id LIMIT %s',
+                   condition_params + visible_params + rank_params + [limit])
+    return cursor.fetchall()
+
+
+def _search(words: List[str], with_terms: bool, limit: int,
+            hidden: HiddenProfiles = NOTHING_HIDDEN) -> List[Tuple[int, str]]:
+    connection = connections[router.db_for_read(models.ProfileSearch)]
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            return _search_sqlite(cursor, words, with_terms, limit, hidden)
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            return _search_postgresql(cursor, words, with_terms, limit, hidden)
+
+    condition = Q()
+    for word in words:
+        if with_terms:
+            condition &= Q(username__icontains=word) | Q(terms__icontains=word)
+        else:
+            condition &= Q(username__icontains=word)
+    return list(models.ProfileSearch.objects.filter(condition, hidden.condition('profile_id', 'profile__user_id'))
+                .order_by('username', 'profile_id').values_list('profile_id', 'username')[:limit])
+
+
+def _username_prefix(prefix: str, limit: int, hidden: HiddenProfiles = NOTHING_HIDDEN) -> List[Tuple[int, str]]:
+    # words too short for the trigrams, by the username index
+    return list(models.Profile.objects.filter(username__gte=prefix, username__lt=prefix + '\U0010ffff')
+                .filter(hidden.condition()).order_by('username', 'id').values_list('id', 'username')[:limit])
+
+
+def search_profiles(query: str, limit: int, hidden: HiddenProfiles = NOTHING_HIDDEN) -> List[Tuple[int, str]]:
+    """
+    Returns the ids and usernames of the profiles best matching the query by username or by
+    the names of their gender, pronoun and wishes, without those hidden from the viewer.
+    """
+    words = [word for word in _words(query) if len(word) >= MIN_WORD_LENGTH]
+    if not words:
+        return _username_prefix(query.strip(), limit, hidden) if query.strip() else []
+    return _search(words, True, limit, hidden)
+
+
+def search_vocabulary(query: str, limit: int) -> Dict[str, List[Tuple[int, str]]]:
+    """
+    Returns the ids and labels of the genders, interests and pronouns with words of their names
+    starting with the words of the query, see ``Vocabulary.search()``.
+    """
+    vocabulary = get_vocabulary()
+    results = {}
+    for key, model in (('genders', models.Gender), ('interests', models.Interest), ('pronouns', models.Pronoun)):
+        labels = vocabulary.labels(model)
+        results[key] = [(pk, labels[pk]) for pk in vocabulary.search(model, query)[:limit]] if query else []
+
+    return results
+
+
+def _profile_suggestions(query: str, hidden: HiddenProfiles) -> List[List]:
+    limit = settings.AUTOCOMPLETE_COUNT
+    words = [word for word in _words(query) if len(word) >= MIN_WORD_LENGTH]
+    # usernames starting with the query first, then those containing it
+    profiles = _username_prefix(query, limit, hidden) if query else []
+    if len(profiles) < limit and words:
+        found = {pk for pk, username in profiles}
+        profiles += [row for row in _search(words, False, limit, hidden) if row[0] not in found][:limit - len(profiles)]
+    return [list(row) for row in profiles]
+
+
+def autocomplete(query: str, hidden: HiddenProfiles = NOTHING_HIDDEN) -> dict:
+    """
+    Returns the suggestions for a partially typed query: profiles by username and vocabulary
+    by name. Suggestions are cached until the data version changes; only those with profiles
+    hidden from the viewer are looked up and cached per viewer.
+    """
+    query = ' '.join(query.split())[:100]
+    version, _ = data_version()
+    key = (version, get_language(), query)
+    suggestions = _suggestions.get(key)
+    if suggestions is None:
+        suggestions = {'profiles': _profile_suggestions(query, NOTHING_HIDDEN)}
+        for name, rows in search_vocabulary(query, settings.AUTOCOMPLETE_COUNT).items():
+            suggestions[name] = [list(row) for row in rows]
+        _suggestions.set(key, suggestions)
+
+    if not hidden.ids.isdisjoint(row[0] for row in suggestions['profiles']):
+        key += (hidden.user_id, hidden.version)
+        shared, suggestions = suggestions, _suggestions.get(key)
+        if suggestions is None:
+            suggestions = dict(shared, profiles=_profile_suggestions(query, hidden))
+            _suggestions.set(key, suggestions)
+
+    return suggestions
+
+
+def clear_suggestions():
+    _suggestions.clear()
@@ -0,0 +1,189 @@
+# coding=utf-8
+from collections import Counter
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from chaos_dating import cards
+from chaos_dating import facets
+from chaos_dating import hiding
+from chaos_dating import listing
+from chaos_dating import metrics
+from chaos_dating import models
+from chaos_dating import profile_index
+from chaos_dating import search
+from chaos_dating import vocabulary
+
+
+def _refresh_index(profile_ids):
+    index = profile_index.current_index()
+    if index is not None:
+        profile_ids = set(profile_ids)
+        transaction.on_commit(lambda: index.refresh(profile_ids))
+
+
+def _bump_profile_versions(profile_ids):
+    for pk in profile_ids:
+        cards.bump_profile_version(pk)
+    listing.bump_data_version()
+
+
+def _profiles_changed(profile_ids):
+    profile_ids = set(profile_ids)
+    profile_index.log_changes(profile_ids)
+    # before the data version changes, so no search result is cached for it too early
+    transaction.on_commit(lambda: search.refresh(profile_ids))
+    transaction.on_commit(lambda: _bump_profile_versions(profile_ids))
+    _refresh_index(profile_ids)
+
+
+def _wishes_changed(profile_ids):
+    # wishes are no profile field, so auto_now and Profile.save() do not notice them
+    models.Profile.objects.filter(pk__in=profile_ids).update(updated_at=timezone.now(), change_seq=None)
+    _profiles_changed(profile_ids)
+
+
+@receiver(post_save, sender=models.Profile)
+@receiver(post_delete, sender=models.Profile)
+def profile_changed(sender, instance: models.Profile, **kwargs):
+    _profiles_changed([instance.pk])
+
+
+@receiver(pre_save, sender=models.Profile)
+def profile_saving(sender, instance: models.Profile, **kwargs):
+    if instance._state.adding:
+        instance._stored_facets = None
+    elif getattr(instance, '_stored_facets', None) is None:
+        # deferred by the query that loaded the profile
+        instance._stored_facets = models.Profile.objects.filter(pk=instance.pk).values_list('gender_id', 'age').first()
+
+
+@receiver(post_save, sender=models.Profile)
+def profile_counted(sender, instance: models.Profile, created: bool, **kwargs):
+    stored = getattr(instance, '_stored_facets', None)
+    current = (instance.gender_id, instance.age)
+    if created:
+        facets.add(facets.profile_facets(*current))
+    elif stored is not None and stored != current:
+        deltas = Counter(facets.profile_facets(*current))
+        deltas.subtract(facets.profile_facets(*stored))
+        facets.apply(deltas)
+    instance._stored_facets = current
+
+
+@receiver(pre_delete, sender=models.Profile)
+def profile_deleting(sender, instance: models.Profile, **kwargs):
+    # the wishes of the profile are deleted with it without m2m_changed signals
+    stored = models.Profile.objects.filter(pk=instance.pk).values_list('gender_id', 'age').first()
+    if stored is not None:
+        through = models.Profile.wishes.through.objects.filter(profile_id=instance.pk)
+        facets.add(facets.profile_facets(*stored, through.values_list('wish_id', flat=True)), -1)
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance: User, created: bool, update_fields=None, **kwargs):
+    if created or (update_fields is not None and 'username' not in update_fields):
+        return
+
+    profiles = models.Profile.objects.filter(user=instance).exclude(username=instance.username)
+    profile_ids = list(profiles.values_list('id', flat=True))
+    if profile_ids:
+        # keeps the copied username current
+        models.Profile.objects.filter(pk__in=profile_ids).update(username=instance.username,
+                                                                 updated_at=timezone.now(), change_seq=None)
+        _profiles_changed(profile_ids)
+
+
+@receiver(post_save, sender=models.HiddenProfile)
+@receiver(post_delete, sender=models.HiddenProfile)
+def hidden_profile_changed(sender, instance: models.HiddenProfile, **kwargs):
+    # the owner of a blocked profile no longer sees the blocking user either
+    user_ids = [instance.user_id]
+    user_ids += models.Profile.objects.filter(pk=instance.profile_id).values_list('user_id', flat=True)
+    transaction.on_commit(lambda: hiding.bump_versions(user_ids))
+
+
+@receiver(m2m_changed, sender=models.Profile.wishes.through)
+def profile_wishes_changed(sender, instance, action: str, reverse: bool, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # the profiles of a cleared wish are unknown after the clear
+        instance._cleared_profile_ids = list(instance.profile_set.values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove') and reverse:
+        _wishes_changed(pk_set)
+    elif action in ('post_add', 'post_remove', 'post_clear') and not reverse:
+        _wishes_changed([instance.pk])
+    elif action == 'post_clear':
+        _wishes_changed(getattr(instance, '_cleared_profile_ids', ()))
+
+
+@receiver(m2m_changed, sender=models.Profile.wishes.through)
+def profile_wishes_counted(sender, instance, action: str, reverse: bool, pk_set, **kwargs):
+    if action == 'pre_clear' and not reverse:
+        instance._cleared_wish_ids = list(instance.wishes.values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        sign = 1 if action == 'post_add' else -1
+        if reverse:
+            facets.apply(Counter({(models.FacetCount.WISH, instance.pk): sign * len(pk_set)}))
+        else:
+            facets.add(((models.FacetCount.WISH, wish_id) for wish_id in pk_set), sign)
+    elif action == 'post_clear' and reverse:
+        cleared = getattr(instance, '_cleared_profile_ids', ())
+        facets.apply(Counter({(models.FacetCount.WISH, instance.pk): -len(cleared)}))
+    elif action == 'post_clear':
+        facets.add(((models.FacetCount.WISH, wish_id) for wish_id in getattr(instance, '_cleared_wish_ids', ())), -1)
+
+
+@receiver(post_delete, sender=models.Wish)
+def wish_deleted(sender, instance: models.Wish, **kwargs):
+    facets.remove_wish(instance.pk)
+    # the cascade changes the wishes of the profiles without a trace other processes could follow
+    transaction.on_commit(profile_index.bump_generation)
+
+
+@receiver(post_delete, sender=models.Gender)
+def gender_deleted(sender, instance: models.Gender, **kwargs):
+    facets.remove_gender(instance.pk)
+    # profiles lose the gender by SET NULL without a trace other processes could follow
+    transaction.on_commit(profile_index.bump_generation)
+
+
+@receiver(post_save, sender=models.Gender)
+@receiver(post_delete, sender=models.Gender)
+@receiver(post_save, sender=models.Interest)
+@receiver(post_delete, sender=models.Interest)
+@receiver(post_save, sender=models.Pronoun)
+@receiver(post_delete, sender=models.Pronoun)
+@receiver(post_save, sender=models.Wish)
+@receiver(post_delete, sender=models.Wish)
+def vocabulary_changed(sender, instance, created: bool = False, **kwargs):
+    # covers the translated name columns as well, modeltranslation saves them with the instance
+    transaction.on_commit(cards.bump_vocabulary_version)
+    transaction.on_commit(vocabulary.reset)
+    if not created:
+        profile_ids = getattr(instance, '_search_profile_ids', None)
+        if profile_ids is None:
+            profile_ids = search.affected_profiles(instance)
+        transaction.on_commit(lambda: search.refresh(profile_ids))
+    transaction.on_commit(listing.bump_data_version)
+
+
+@receiver(pre_delete, sender=models.Gender)
+@receiver(pre_delete, sender=models.Interest)
+@receiver(pre_delete, sender=models.Pronoun)
+@receiver(pre_delete, sender=models.Wish)
+def vocabulary_deleting(sender, instance, **kwargs):
+    # the profiles of a deleted wish are unknown after the delete
+    instance._search_profile_ids = search.affected_profiles(instance)
+
+
+@receiver(connection_created)
+def connection_opened(sender, connection, **kwargs):
+    metrics.install(connection)
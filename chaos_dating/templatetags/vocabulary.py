@@ -0,0 +1,25 @@
+# coding=utf-8
+from typing import Optional
+
+from django import template
+
+from chaos_dating import models
+from chaos_dating.vocabulary import get_vocabulary
+
+register = template.Library()
+
+
+@register.filter
+def gender_label(gender_id: Optional[int]) -> Optional[str]:
+    """
+    Returns the translated name of the gender with the id from the vocabulary cache.
+    """
+    return get_vocabulary().label(models.Gender, gender_id)
+
+
+@register.filter
+def pronoun_label(pronoun_id: Optional[int]) -> Optional[str]:
+    """
+    Returns the translated name of the pronoun with the id from the vocabulary cache.
+    """
+    return get_vocabulary().label(models.Pronoun, pronoun_id)
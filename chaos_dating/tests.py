@@ -1,5 +1,1489 @@
 # coding=utf-8
+import gzip
+import os
+import re
+import tempfile
+from datetime import timedelta
+from io import StringIO
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.test import RequestFactory
+from django.test import SimpleTestCase
 from django.test import TestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils import translation
+
+from chaos_dating import assets
+from chaos_dating import benchmark
+from chaos_dating import bulk
+from chaos_dating import caching
+from chaos_dating import cards
+from chaos_dating import db_routing
+from chaos_dating import facets
+from chaos_dating import hiding
+from chaos_dating import listing
+from chaos_dating import matching
+from chaos_dating import metrics
+from chaos_dating import models
+from chaos_dating import profile_index
+from chaos_dating import saved_searches
+from chaos_dating import search
+from chaos_dating import vocabulary
+from chaos_dating.cards import render_cards
+from chaos_dating.forms import FilterForm
+from chaos_dating.forms import ProfileForm
+from chaos_dating.listing import find_profiles
+from chaos_dating.pagination import page_queryset
+
+
+def create_profiles(count: int, start: int = 0):
+    interest = models.Interest.objects.get_or_create(name='Friendship')[0]
+    gender = models.Gender.objects.get_or_create(name='Agender')[0]
+    pronoun = models.Pronoun.objects.get_or_create(name='they')[0]
+    wishes = [models.Wish.objects.get_or_create(interest=interest, gender=None)[0],
+              models.Wish.objects.get_or_create(interest=interest, gender=gender)[0]]
+    profiles = []
+    for i in range(start, start + count):
+        user = User.objects.create_user(f'user{i:04d}')
+        profile = models.Profile.objects.create(user=user, age=18 + i % 50, gender=gender, pronoun=pronoun)
+        profile.wishes.set(wishes)
+        profiles.append(profile)
+
+    return profiles
+
+
+class ChaosDatingTestCase(TestCase):
+    def setUp(self):
+        # the index and the cache of this process outlive the rolled back test transactions
+        profile_index.reset()
+        listing.clear_results()
+        vocabulary.reset()
+        search.clear_suggestions()
+        facets.clear_counts()
+        hiding.clear_hidden()
+        cache.clear()
+
+
+class ProfileListingQueryTests(ChaosDatingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.viewer = create_profiles(1, start=9999)[0].user
+        self.client.force_login(self.viewer)
+
+    def _count_queries(self, func) -> int:
+        with CaptureQueriesContext(connection) as context:
+            func()
+        return len(context.captured_queries)
+
+    def _render_listing(self):
+        return render_to_string('chaos_dating/profiles.html', context={'cards': render_cards(find_profiles().items)})
+
+    def _filter_rest(self):
+        response = self.client.post(reverse('chaos_dating:filterREST'), data={
+            'min_age': 1,
+            'order_by': 'age',
+            'order_direction': '-',
+        })
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_listing_queries_do_not_grow_with_profiles(self):
+        create_profiles(2)
+        profile_index.get_index()
+        vocabulary.get_vocabulary()
+        few = self._count_queries(self._render_listing)
+        with self.captureOnCommitCallbacks(execute=True):
+            create_profiles(20, start=2)
+        cache.clear()
+        # the cleared version counters start over, which rebuilds the index
+        profile_index.get_index()
+        many = self._count_queries(self._render_listing)
+        self.assertEqual(few, many)
+
+    def test_filter_rest_queries_do_not_grow_with_profiles(self):
+        create_profiles(2)
+        profile_index.get_index()
+        vocabulary.get_vocabulary()
+        few = self._count_queries(self._filter_rest)
+        with self.captureOnCommitCallbacks(execute=True):
+            create_profiles(20, start=2)
+        cache.clear()
+        # the session was cleared from the cache as well
+        profile_index.get_index()
+        self.client.force_login(self.viewer)
+        many = self._count_queries(self._filter_rest)
+        self.assertEqual(few, many)
+
+    def test_listing_renders_wishes(self):
+        create_profiles(1)
+        html = self._render_listing()
+        self.assertIn('user0000', html)
+        self.assertIn('Friendship with Agender humans', html)
+
+
+@override_settings(PROFILES_PAGE_SIZE=3)
+class ProfilePaginationTests(ChaosDatingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.profiles = create_profiles(8)
+        self.client.force_login(self.profiles[0].user)
+
+    def _fetch_all(self, data: dict) -> list:
+        usernames = []
+        cursor = None
+        while True:
+            response = self.client.post(reverse('chaos_dating:filterREST'), data=dict(data, cursor=cursor or ''))
+            self.assertEqual(response.status_code, 200)
+            result = response.json()
+            usernames.extend(re.findall(r'>(user\d+)</a>', result['profiles']))
+            cursor = result['next_cursor']
+            if cursor is None:
+                return usernames
+
+    def test_pages_by_username(self):
+        usernames = self._fetch_all({})
+        self.assertEqual(usernames, sorted(profile.user.username for profile in self.profiles))
+
+    def test_pages_by_age_descending(self):
+        usernames = self._fetch_all({'order_by': 'age', 'order_direction': '-'})
+        expected = sorted(self.profiles, key=lambda profile: (-profile.age, -profile.id))
+        self.assertEqual(usernames, [profile.user.username for profile in expected])
+
+    def test_cursor_of_other_sort_is_rejected(self):
+        response = self.client.post(reverse('chaos_dating:filterREST'), data={})
+        cursor = response.json()['next_cursor']
+        response = self.client.post(reverse('chaos_dating:filterREST'),
+                                    data={'order_by': 'age', 'order_direction': '+', 'cursor': cursor})
+        self.assertEqual(response.status_code, 400)
+
+
+class ProfileIndexTests(ChaosDatingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.profiles = create_profiles(30)
+        self.interest = models.Interest.objects.create(name='Games')
+        self.games = models.Wish.objects.create(interest=self.interest)
+        for profile in self.profiles[::3]:
+            profile.wishes.add(self.games)
+
+    def _usernames(self, data: dict) -> list:
+        form = FilterForm(data)
+        self.assertTrue(form.is_valid(), form.errors)
+        usernames = []
+        cursor = None
+        while True:
+            page = find_profiles(form.cleaned_data, cursor)
+            names = dict(models.Profile.objects.filter(pk__in=page.items).values_list('pk', 'user__username'))
+            usernames.extend(names[pk] for pk in page.items)
+            cursor = page.next_cursor
+            if cursor is None:
+                return usernames
+
+    def _assert_same_as_database(self, data: dict):
+        indexed = self._usernames(data)
+        with self.settings(PROFILE_INDEX_ENABLED=False):
+            self.assertEqual(indexed, self._usernames(data))
+
+    def test_filters_match_database(self):
+        gender = models.Gender.objects.get(name='Agender')
+        for data in ({},
+                     {'min_age': 20, 'max_age': 30},
+                     {'min_age': 40, 'order_by': 'age', 'order_direction': '-'},
+                     {'wishes': [self.games.pk], 'order_by': 'age', 'order_direction': '+'},
+                     {'wishes': [self.games.pk], 'gender': [gender.pk], 'max_age': 25}):
+            with self.subTest(data=data):
+                self._assert_same_as_database(data)
+
+    def test_signals_keep_index_current(self):
+        self._usernames({})
+        profile = self.profiles[1]
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.wishes.add(self.games)
+            profile.age = 99
+            profile.save()
+            profile.user.username = 'renamed'
+            profile.user.save()
+        self._assert_same_as_database({'wishes': [self.games.pk], 'min_age': 99})
+        self.assertEqual(self._usernames({'min_age': 99}), ['renamed'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.games.delete()
+        self.assertEqual(self._usernames({'min_age': 99}), ['renamed'])
+
+    def test_index_catches_up_with_other_processes(self):
+        index = profile_index.get_index()
+        self._usernames({'wishes': [self.games.pk]})
+        # the index of another process receives the writes
+        profile_index._index = profile_index.ProfileIndex.build(index.generation)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profiles[1].wishes.add(self.games)
+            self.profiles[2].age = 99
+            self.profiles[2].save()
+            self.profiles[3].user.delete()
+        profile_index._index = index
+
+        self.assertIs(profile_index.get_index(), index)
+        self._assert_same_as_database({'wishes': [self.games.pk]})
+        self._assert_same_as_database({'min_age': 99})
+        self.assertEqual(len(index), len(self.profiles) - 1)
+        form = FilterForm({'wishes': [self.games.pk]})
+        self.assertTrue(form.is_valid())
+        with self.settings(PROFILE_INDEX_ENABLED=False):
+            expected = facets.filter_counts(form.cleaned_data)
+        facets.clear_counts()
+        self.assertEqual(facets.filter_counts(form.cleaned_data), expected)
+
+        # the best match sort scores the viewer's wishes, which the games wish of profiles[1] now adds to
+        form = FilterForm({'order_by': 'match'}, user=self.profiles[0].user)
+        self.assertTrue(form.is_valid())
+        indexed = find_profiles(form.cleaned_data).items
+        self.assertIn(self.profiles[1].pk, indexed[:len(self.profiles) // 3 + 1])
+        listing.clear_results()
+        with self.settings(PROFILE_INDEX_ENABLED=False):
+            self.assertEqual(find_profiles(form.cleaned_data).items, indexed)
+
+    def test_catch_up_reads_the_logged_changes_only(self):
+        index = profile_index.get_index()
+        profile = self.profiles[4]
+        profile_index._index = profile_index.ProfileIndex.build(index.generation)
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.age = 98
+            profile.save()
+        profile_index._index = index
+
+        # the changes, the wishes and the profiles, however many profiles await saved searches
+        self.assertTrue(models.Profile.objects.filter(change_seq__isnull=True).count() > 1)
+        with self.assertNumQueries(3):
+            self.assertIs(profile_index.get_index(), index)
+        self.assertEqual(index.entry(profile.pk).age, 98)
+
+    def test_catch_up_waits_for_changes_committed_late(self):
+        index = profile_index.get_index()
+        first, second = self.profiles[5], self.profiles[6]
+        last = index.change_id
+        models.Profile.objects.filter(pk=second.pk).update(age=97)
+        models.ProfileChange.objects.create(id=last + 2, profile_id=second.pk)
+        listing.bump_data_version()
+        self.assertIs(profile_index.get_index(), index)
+        self.assertEqual(index.entry(second.pk).age, 97)
+
+        models.Profile.objects.filter(pk=first.pk).update(age=96)
+        models.ProfileChange.objects.create(id=last + 1, profile_id=first.pk)
+        listing.bump_data_version()
+        self.assertIs(profile_index.get_index(), index)
+        self.assertEqual(index.entry(first.pk).age, 96)
+
+    def test_index_far_behind_is_rebuilt(self):
+        index = profile_index.get_index()
+        models.ProfileChange.objects.bulk_create([models.ProfileChange(profile_id=self.profiles[0].pk)
+                                                  for _ in range(profile_index.CATCH_UP_LIMIT + 1)])
+        listing.bump_data_version()
+        rebuilt = profile_index.get_index()
+        self.assertIsNot(rebuilt, index)
+        self.assertEqual(len(rebuilt), len(self.profiles))
+
+        # behind changes pruned from the log
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profiles[1].save()
+            self.profiles[2].save()
+        models.ProfileChange.objects.filter(id__lte=rebuilt.change_id + 1).delete()
+        listing.bump_data_version()
+        self.assertIsNot(profile_index.get_index(), rebuilt)
+
+    def test_rebuild_command(self):
+        index = profile_index.get_index()
+        call_command('rebuild_profile_index', stdout=StringIO())
+        self.assertIsNot(profile_index.get_index(), index)
+        self.assertEqual(len(profile_index.get_index()), len(self.profiles))
+
+
+class ProfileCardCacheTests(ChaosDatingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.profile = create_profiles(1)[0]
+
+    def _render(self) -> str:
+        return render_cards([self.profile.pk])[0]
+
+    def test_cached_cards_need_no_queries(self):
+        self._render()
+        with self.assertNumQueries(0):
+            self.assertIn('user0000', self._render())
+
+    def test_profile_changes_invalidate_card(self):
+        self._render()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profile.age = 77
+            self.profile.save()
+        self.assertIn('77', self._render())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profile.wishes.clear()
+        self.assertIn('No wishes available', self._render())
+
+    def test_vocabulary_changes_invalidate_card(self):
+        self._render()
+        with self.captureOnCommitCallbacks(execute=True):
+            gender = self.profile.gender
+            gender.name = 'Nonbinary'
+            gender.save()
+        self.assertIn('Nonbinary', self._render())
+
+    def test_cards_are_cached_per_language(self):
+        with translation.override('de-de'):
+            self._render()
+        with CaptureQueriesContext(connection) as context:
+            self._render()
+        self.assertTrue(context.captured_queries)
+
+
+class FilterResultCacheTests(ChaosDatingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.profiles = create_profiles(5)
+        self.client.force_login(self.profiles[0].user)
+        self.url = reverse('chaos_dating:filterREST')
+
+    def test_filter_key_is_canonical(self):
+        wishes = list(models.Wish.objects.all())
+        first = FilterForm({'wishes': [wish.pk for wish in wishes], 'min_age': 20})
+        second = FilterForm({'wishes': [wish.pk for wish in reversed(wishes)], 'min_age': '20'})
+        self.assertTrue(first.is_valid() and second.is_valid())
+        self.assertEqual(listing.filter_key(first.cleaned_data), listing.filter_key(second.cleaned_data))
+
+    def test_results_are_cached_until_data_changes(self):
+        form = FilterForm({'max_age': 20})
+        self.assertTrue(form.is_valid())
+        first = find_profiles(form.cleaned_data)
+        with self.assertNumQueries(0):
+            self.assertEqual(find_profiles(form.cleaned_data), first)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profiles[4].age = 19
+            self.profiles[4].save()
+        self.assertEqual(len(find_profiles(form.cleaned_data).items), len(first.items) + 1)
+
+    def test_conditional_get(self):
+        response = self.client.get(self.url, {'min_age': 18})
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.client.get(self.url, {'min_age': 18}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profiles[0].save()
+        response = self.client.get(self.url, {'min_age': 18}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class ProfileApiTests(ChaosDatingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.profiles = create_profiles(3)
+        self.client.force_login(self.profiles[0].user)
+
+    def test_profile_records(self):
+        response = self.client.get(reverse('chaos_dating:profilesAPI'), {'fields': 'username,age,wishes'})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        wishes = sorted(self.profiles[0].wishes.values_list('id', flat=True))
+        self.assertEqual(data['fields'], ['username', 'age', 'wishes'])
+        self.assertEqual(data['profiles'][0], ['user0000', 18, wishes])
+        self.assertEqual(len(data['profiles']), 3)
+
+    def test_unknown_fields_are_rejected(self):
+        response = self.client.get(reverse('chaos_dating:profilesAPI'), {'fields': 'id,password'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_vocabulary(self):
+        response = self.client.get(reverse('chaos_dating:vocabularyAPI'))
+        data = response.json()
+        gender = self.profiles[0].gender
+        self.assertEqual(data['genders'][str(gender.pk)], 'Agender')
+        self.assertIn('Friendship with Agender humans', data['wishes'].values())
+
+        response = self.client.get(reverse('chaos_dating:vocabularyAPI'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_vocabulary_version_matches_profile_records(self):
+        vocabulary.get_vocabulary()
+        cards.bump_vocabulary_version()
+        profiles = self.client.get(reverse('chaos_dating:profilesAPI'), {'fields': 'username'}).json()
+        tables = self.client.get(reverse('chaos_dating:vocabularyAPI')).json()
+        self.assertEqual(tables['version'], profiles['vocabulary_version'])
+
+
+class VocabularyTests(ChaosDatingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.profile = create_profiles(1)[0]
+        vocabulary.get_vocabulary()
+
+    def test_forms_render_without_queries(self):
+        profile = listing.profile_listing().get(pk=self.profile.pk)
+        with self.assertNumQueries(0):
+            html = FilterForm().as_div()
+            html += ProfileForm(instance=profile).as_div()
+        self.assertIn('Friendship with Agender humans', html)
+        self.assertIn('they', html)
+
+    def test_forms_validate_without_queries(self):
+        wish = self.profile.wishes.first()
+        with self.assertNumQueries(0):
+            form = FilterForm({'gender': [self.profile.gender_id], 'wishes': [wish.pk, wish.pk]})
+            self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['wishes'], [wish])
+        self.assertFalse(FilterForm({'gender': [0]}).is_valid())
+
+    def _lookup(self, html: str, field: str, **params) -> dict:
+        field_id = re.search(f'name="{field}"[^>]* data-field_id="([^"]+)"', html).group(1)
+        response = self.client.get(reverse('django_select2:auto-json'), dict(params, field_id=field_id), secure=True)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+    
+    def test_changes_reload_vocabulary(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            gender = models.Gender.objects.create(name='Demigirl')
+        results = self._lookup(FilterForm().as_div(), 'gender', term='demi')['results']
+        self.assertEqual(results, [{'id': gender.pk, 'text': 'Demigirl (0)'}])
+        self.assertTrue(FilterForm({'gender': [gender.pk]}).is_valid())
+    
+    def test_forms_render_selected_choices_only(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(30):
+                models.Wish.objects.create(interest=models.Interest.objects.create(name=f'Interest {i:02d}'))
+        wish = self.profile.wishes.first()
+        html = FilterForm({'wishes': [wish.pk]}).as_div()
+        select = re.search('<select name="wishes".*?</select>', html, re.DOTALL).group(0)
+        self.assertEqual(re.findall('<option.*?</option>', select),
+                         [f'<option value="{wish.pk}" selected>Friendship</option>'])
+    
+    def test_select2_is_a_static_file(self):
+        urls = re.findall(r'(?:src|href)="([^"]+)"', str(FilterForm().media))
+        self.assertIn('/static/admin/js/vendor/select2/select2.full.min.js', urls)
+        self.assertTrue(all(url.startswith(settings.STATIC_URL) for url in urls), urls)
+    
+    def test_widgets_look_choices_up_by_ajax(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(30):
+                models.Gender.objects.create(name=f'Gender {i:02d}')
+        html = FilterForm().as_div() + ProfileForm(instance=self.profile).as_div()
+        vocabulary.get_vocabulary()
+        facets.counts()
+        with self.assertNumQueries(0):
+            first = self._lookup(html, 'gender', term='gender')
+            second = self._lookup(html, 'gender', term='gender', page=2)
+        self.assertEqual([result['text'] for result in first['results']],
+                         [f'Gender {i:02d} (0)' for i in range(25)])
+        self.assertTrue(first['more'])
+        self.assertEqual([result['text'] for result in second['results']],
+                         [f'Gender {i:02d} (0)' for i in range(25, 30)])
+        self.assertFalse(second['more'])
+        
+        self.assertEqual(self._lookup(html, 'wishes', term='agen')['results'],
+                         [{'id': self.profile.wishes.get(gender__isnull=False).pk,
+                           'text': 'Friendship with Agender humans (1)'}])
+        self.assertEqual(self._lookup(html, 'pronoun', term='')['results'],
+                         [{'id': self.profile.pronoun_id, 'text': 'they'}])
+
+    def test_labels_are_translated(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            gender = self.profile.gender
+            gender.name_de_de = 'Agender (de)'
+            gender.save()
+        labels = vocabulary.get_vocabulary().labels(models.Gender)
+        with translation.override('de-de'):
+            german = vocabulary.get_vocabulary().labels(models.Gender)
+        self.assertEqual(labels[gender.pk], 'Agender')
+        self.assertEqual(german[gender.pk], 'Agender (de)')
+
+
+class VocabularyResolutionTests(ChaosDatingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.profile = create_profiles(1)[0]
+        self.wishes = list(self.profile.wishes.values_list('id', flat=True))
+
+    def _form(self, **data) -> ProfileForm:
+        data = dict({'age': 30, 'pronoun': self.profile.pronoun_id, 'gender': self.profile.gender_id,
+                     'wishes': self.wishes}, **data)
+        return ProfileForm(data=data, instance=self.profile)
+
+    def test_names_are_normalized(self):
+        self.assertEqual(vocabulary.resolve(models.Gender, '  aGENDER '), self.profile.gender_id)
+        self.assertEqual(vocabulary.resolve(models.Gender, str(self.profile.gender_id)), self.profile.gender_id)
+        self.assertIsNone(vocabulary.resolve(models.Gender, '   '))
+
+    def test_new_names_are_created_once(self):
+        pk = vocabulary.resolve(models.Pronoun, ' xe  xem ')
+        self.assertEqual(models.Pronoun.objects.get(pk=pk).name, 'xe xem')
+        self.assertEqual(vocabulary.resolve(models.Pronoun, 'Xe Xem'), pk)
+        self.assertEqual(models.Pronoun.objects.filter(name__iexact='xe xem').count(), 1)
+
+    def test_profile_form_resolves_typed_names(self):
+        form = self._form(pronoun='xe', gender='agender')
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.cleaned_data['gender'], self.profile.gender)
+        self.assertEqual(form.cleaned_data['pronoun'].name, 'xe')
+        self.assertEqual(list(form.cleaned_data['wishes']), list(self.profile.wishes.all()))
+        self.assertIn(f'value="{form.cleaned_data["pronoun"].pk}" selected', str(form['pronoun']))
+
+    def test_profile_form_rejects_long_names(self):
+        form = self._form(gender='x' * 17)
+        self.assertFalse(form.is_valid())
+        self.assertIn('gender', form.errors)
+        self.assertFalse(models.Gender.objects.filter(name='x' * 17).exists())
+
+    def test_saving_known_values_needs_few_queries(self):
+        vocabulary.get_vocabulary()
+        form = self._form(pronoun='THEY', age=40)
+        with self.assertNumQueries(0):
+            self.assertTrue(form.is_valid())
+        with CaptureQueriesContext(connection) as context:
+            form.save()
+        # including the one moving the profile to the facet count of its new age bucket
+        self.assertLessEqual(len(context.captured_queries), 6)
+
+
+class MatchTestCase(ChaosDatingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.woman = models.Gender.objects.create(name='Woman')
+        self.man = models.Gender.objects.create(name='Man')
+        chess = models.Interest.objects.create(name='Chess')
+        dating = models.Interest.objects.create(name='Dating')
+        self.chess = models.Wish.objects.create(interest=chess)
+        self.dating_women = models.Wish.objects.create(interest=dating, gender=self.woman)
+        self.dating_men = models.Wish.objects.create(interest=dating, gender=self.man)
+
+    def _profile(self, name: str, gender, *wishes) -> models.Profile:
+        profile = models.Profile.objects.create(user=User.objects.create_user(name), age=30, gender=gender)
+        profile.wishes.set(wishes)
+        return profile
+
+
+class MatchEngineTests(MatchTestCase):
+    def test_scores_overlap_and_gender_fit(self):
+        alice = self._profile('alice', self.woman, self.chess, self.dating_men)
+        bob = self._profile('bob', self.man, self.chess, self.dating_women)
+        carol = self._profile('carol', self.woman, self.chess, self.dating_men)
+        dave = self._profile('dave', self.man)
+
+        engine = matching.MatchEngine.build()
+        # one shared wish plus both gender-qualified wishes fit
+        self.assertEqual(engine.top_k(alice.pk, 3), [(bob.pk, 3.0), (carol.pk, 2.0), (dave.pk, 1.0)])
+        # carol and alice share both wishes, but neither's gender fits the other's wishes
+        self.assertEqual(engine.top_k(carol.pk, 2), [(bob.pk, 3.0), (alice.pk, 2.0)])
+        # only the wishes of others fit dave, who has none
+        self.assertEqual(engine.top_k(dave.pk, 5), [(alice.pk, 1.0), (carol.pk, 1.0)])
+
+    def test_batched_scores_match_single_rows(self):
+        profiles = [self._profile(f'user{i}', (self.woman, self.man, None)[i % 3],
+                                  *[self.chess, self.dating_women, self.dating_men][:i % 4])
+                    for i in range(12)]
+        engine = matching.MatchEngine.build()
+        rows = [engine.row(profile.pk) for profile in profiles]
+        batched = engine.scores(rows)
+        for index, row in enumerate(rows):
+            self.assertTrue((batched[index] == engine.scores([row])[0]).all())
+
+
+class ComputeRecommendationsTests(MatchTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = self._profile('alice', self.woman, self.chess, self.dating_men)
+        self.bob = self._profile('bob', self.man, self.chess, self.dating_women)
+        self.carol = self._profile('carol', self.woman)
+
+    def _compute(self, *args):
+        call_command('compute_recommendations', '--workers=1', *args, stdout=StringIO())
+
+    def test_full_run(self):
+        self._compute()
+        self.assertEqual(matching.recommendations(self.alice.pk), [self.bob.pk])
+        self.assertEqual(matching.recommendations(self.bob.pk), [self.alice.pk, self.carol.pk])
+        self.assertEqual(models.RecommendationRun.objects.get().profiles, 3)
+
+    def test_process_pool_matches_inline_run(self):
+        self._compute()
+        inline = list(models.Recommendation.objects.values_list('profile_id', 'recommended_id', 'score', 'rank'))
+        call_command('compute_recommendations', '--workers=2', '--chunk-size=1', stdout=StringIO())
+        pooled = list(models.Recommendation.objects.values_list('profile_id', 'recommended_id', 'score', 'rank'))
+        self.assertEqual(sorted(inline), sorted(pooled))
+
+    def test_incremental_run_rescores_affected_profiles(self):
+        self._compute()
+        models.Profile.objects.update(updated_at=timezone.now() - timedelta(days=1))
+        models.RecommendationRun.objects.update(started_at=timezone.now() - timedelta(hours=1))
+        self.carol.wishes.add(self.chess)
+
+        self._compute('--incremental')
+        run = models.RecommendationRun.objects.latest()
+        self.assertTrue(run.incremental)
+        # alice now shares a wish with carol, bob's recommendation of carol changes its score
+        self.assertEqual(run.profiles, 3)
+        self.assertEqual(matching.recommendations(self.alice.pk), [self.bob.pk, self.carol.pk])
+
+        self._compute('--incremental')
+        self.assertEqual(models.RecommendationRun.objects.latest().profiles, 0)
+
+
+class BulkCommandTests(ChaosDatingTestCase):
+    def test_generate_profiles(self):
+        call_command('generate_profiles', 300, batch_size=128, seed=1, stdout=StringIO())
+        profiles = models.Profile.objects.filter(user__username__startswith='generated')
+        self.assertEqual(profiles.count(), 300)
+        self.assertFalse(profiles.filter(age__lt=18).exists())
+        self.assertFalse(profiles.filter(gender__isnull=True).exists())
+        self.assertTrue(models.Profile.wishes.through.objects.exists())
+        self.assertEqual(len(profile_index.get_index()), 300)
+
+        call_command('generate_profiles', 10, seed=1, stdout=StringIO())
+        self.assertEqual(profiles.count(), 310)
+
+    def _round_trip(self, format: str):
+        create_profiles(3)
+        exported = StringIO()
+        call_command('export_profiles', format=format, stdout=exported, stderr=StringIO())
+        models.Profile.objects.all().delete()
+        User.objects.all().delete()
+
+        with tempfile.NamedTemporaryFile('w', suffix=f'.{format}', delete=False) as file:
+            file.write(exported.getvalue())
+        try:
+            call_command('import_profiles', file.name, batch_size=2, stdout=StringIO())
+            call_command('import_profiles', file.name, stdout=StringIO())
+        finally:
+            os.remove(file.name)
+
+        profiles = listing.profile_listing().order_by('user__username')
+        self.assertEqual([profile.user.username for profile in profiles], ['user0000', 'user0001', 'user0002'])
+        self.assertEqual(profiles[1].age, 19)
+        self.assertEqual(str(profiles[1].gender), 'Agender')
+        self.assertEqual(sorted(map(str, profiles[1].wishes.all())), ['Friendship', 'Friendship with Agender humans'])
+
+    def test_jsonl_round_trip(self):
+        self._round_trip('jsonl')
+
+    def test_csv_round_trip(self):
+        self._round_trip('csv')
+
+
+class BenchmarkTests(ChaosDatingTestCase):
+    def test_run_measures_scenarios(self):
+        self.client.force_login(create_profiles(30)[0].user)
+        results = benchmark.run(self.client, repeat=2, only=['filter_combined', 'filter_page_5', 'profile'])
+        self.assertEqual(set(results), {'filter_combined:cold', 'filter_combined:warm', 'filter_page_5:cold',
+                                        'filter_page_5:warm', 'profile:cold', 'profile:warm'})
+        for summary in results.values():
+            self.assertEqual(summary['errors'], 0)
+            self.assertGreater(summary['queries'], 0)
+        self.assertGreater(results['filter_combined:cold']['render_ms'], 0)
+
+    def test_compare(self):
+        summary = {'p50_ms': 10.0, 'p95_ms': 20.0, 'queries': 4, 'errors': 0}
+        baseline = {'1000': {'filter_all:cold': summary}}
+        same = {'1000': {'filter_all:cold': dict(summary, p50_ms=12.0), 'profile:warm': summary}}
+        self.assertEqual(benchmark.compare(same, baseline, threshold=0.25), [])
+
+        slower = {'1000': {'filter_all:cold': dict(summary, p95_ms=40.0, queries=5)}}
+        regressions = benchmark.compare(slower, baseline, threshold=0.25)
+        self.assertEqual(len(regressions), 2)
+        self.assertIn('p95_ms', regressions[0])
+
+
+class ProfileQueryPlanTests(ChaosDatingTestCase):
+    FILTERS = (
+        {},
+        {'min_age': 25, 'max_age': 35},
+        {'gender': 'one'},
+        {'gender': 'all'},
+        {'wishes': 'all'},
+        {'gender': 'one', 'wishes': 'one', 'min_age': 20, 'max_age': 40},
+        {'wishes': 'all', 'wish_match': 'all'},
+        {'gender': 'one', 'wishes': 'all', 'wish_match': 'at_least', 'wish_min_count': 2},
+    )
+    ORDERS = (('username', '+'), ('username', '-'), ('age', '+'), ('age', '-'))
+
+    def setUp(self):
+        super().setUp()
+        create_profiles(30)
+        models.Gender.objects.create(name='Woman')
+        self.genders = list(models.Gender.objects.values_list('pk', flat=True))
+        self.wishes = list(models.Wish.objects.values_list('pk', flat=True))
+
+    def _form_data(self, filters: dict, order_by: str, direction: str) -> dict:
+        choices = {'gender': self.genders, 'wishes': self.wishes}
+        data = {key: value if key not in choices else choices[key][:1] if value == 'one' else choices[key]
+                for key, value in filters.items()}
+        return dict(data, order_by=order_by, order_direction=direction)
+
+    def _plan(self, data: dict) -> str:
+        form = FilterForm(data)
+        self.assertTrue(form.is_valid(), form.errors)
+        order_by, descending = listing.sort_order(form.cleaned_data)
+        queryset = page_queryset(listing.profile_query(form.cleaned_data), order_by, descending, None)[:21]
+        if connection.vendor == 'postgresql':
+            # tiny test tables are always scanned; without sequential scans the plan shows usable indexes
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        return queryset.explain()
+
+    def test_filters_use_indexes(self):
+        if connection.vendor not in ('sqlite', 'postgresql'):
+            self.skipTest(f'no plan checks for {connection.vendor}')
+
+        for filters in self.FILTERS:
+            for order_by, direction in self.ORDERS:
+                data = self._form_data(filters, order_by, direction)
+                with self.subTest(**data):
+                    plan = self._plan(data)
+                    self.assertNotIn('auth_user', plan)
+                    if connection.vendor == 'sqlite':
+                        self.assertNotRegex(plan, r'\bSCAN \w+(?! USING (COVERING )?INDEX)\b')
+                    else:
+                        self.assertNotIn('Seq Scan', plan)
+
+
+class ProfileUsernameTests(ChaosDatingTestCase):
+    def test_username_is_copied(self):
+        profile = create_profiles(1)[0]
+        self.assertEqual(models.Profile.objects.get(pk=profile.pk).username, 'user0000')
+
+        profile.user.username = 'renamed'
+        profile.user.save()
+        self.assertEqual(models.Profile.objects.get(pk=profile.pk).username, 'renamed')
+        self.assertEqual(str(models.Profile.objects.get(pk=profile.pk)), 'renamed')
+
+
+class WishMatchTests(MatchTestCase):
+    def setUp(self):
+        super().setUp()
+        self.viewer = self._profile('viewer', self.woman)
+        self._profile('alice', self.woman, self.chess)
+        self._profile('bob', self.man, self.chess, self.dating_women)
+        self._profile('carol', self.woman, self.chess, self.dating_women, self.dating_men)
+        self.wishes = [self.chess.pk, self.dating_women.pk, self.dating_men.pk]
+
+    def _usernames(self, **data) -> list:
+        form = FilterForm(dict(data, wishes=self.wishes))
+        self.assertTrue(form.is_valid(), form.errors)
+        page = find_profiles(form.cleaned_data)
+        names = dict(models.Profile.objects.filter(pk__in=page.items).values_list('pk', 'username'))
+        return [names[pk] for pk in page.items]
+
+    def _assert_modes(self):
+        self.assertEqual(self._usernames(), ['alice', 'bob', 'carol'])
+        self.assertEqual(self._usernames(wish_match='all'), ['carol'])
+        self.assertEqual(self._usernames(wish_match='at_least', wish_min_count=2), ['bob', 'carol'])
+
+    def test_match_modes_with_index(self):
+        self._assert_modes()
+
+    @override_settings(PROFILE_INDEX_ENABLED=False)
+    def test_match_modes_in_database(self):
+        self._assert_modes()
+
+    def test_at_least_needs_a_valid_count(self):
+        self.assertIn('wish_min_count', FilterForm({'wishes': self.wishes, 'wish_match': 'at_least'}).errors)
+        form = FilterForm({'wishes': self.wishes[:1], 'wish_match': 'at_least', 'wish_min_count': 2})
+        self.assertIn('wish_min_count', form.errors)
+
+    def test_modes_have_different_keys(self):
+        keys = set()
+        for data in ({}, {'wish_match': 'all'}, {'wish_match': 'at_least', 'wish_min_count': 2}):
+            form = FilterForm(dict(data, wishes=self.wishes))
+            self.assertTrue(form.is_valid())
+            keys.add(listing.filter_key(form.cleaned_data))
+        self.assertEqual(len(keys), 3)
+
+
+@override_settings(PROFILES_PAGE_SIZE=2)
+class BestMatchTests(MatchTestCase):
+    def setUp(self):
+        super().setUp()
+        models.Interest.objects.filter(name='Dating').update(weight=3)
+        self.viewer = self._profile('viewer', self.woman, self.chess, self.dating_women)
+        self._profile('alice', self.woman, self.chess)
+        self._profile('bob', self.man, self.chess, self.dating_women)
+        self._profile('carol', self.woman, self.dating_women)
+        self._profile('dave', self.man, self.dating_men)
+        self._profile('erin', None)
+
+    def _usernames(self, data: dict) -> list:
+        form = FilterForm(dict(data, order_by='match'), user=self.viewer.user)
+        self.assertTrue(form.is_valid(), form.errors)
+        usernames = []
+        cursor = None
+        while True:
+            page = find_profiles(form.cleaned_data, cursor)
+            names = dict(models.Profile.objects.filter(pk__in=page.items).values_list('pk', 'username'))
+            usernames.extend(names[pk] for pk in page.items)
+            cursor = page.next_cursor
+            if cursor is None:
+                return usernames
+
+    def _assert_order(self):
+        # ties and profiles sharing no wish are ordered by descending id
+        self.assertEqual(self._usernames({}), ['bob', 'viewer', 'carol', 'alice', 'erin', 'dave'])
+        self.assertEqual(self._usernames({'gender': [self.woman.pk]}), ['viewer', 'carol', 'alice'])
+        self.assertEqual(self._usernames({'wishes': [self.dating_men.pk, self.chess.pk]}),
+                         ['bob', 'viewer', 'alice', 'dave'])
+
+    def test_order_with_index(self):
+        self._assert_order()
+
+    @override_settings(PROFILE_INDEX_ENABLED=False)
+    def test_order_in_database(self):
+        self._assert_order()
+
+    def test_weights_are_part_of_the_key(self):
+        form = FilterForm({'order_by': 'match'}, user=self.viewer.user)
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['match_weights'], {self.chess.pk: 1, self.dating_women.pk: 3})
+        other = FilterForm({'order_by': 'match'}, user=User.objects.get(username='dave'))
+        self.assertTrue(other.is_valid())
+        self.assertNotEqual(listing.filter_key(form.cleaned_data), listing.filter_key(other.cleaned_data))
+
+    def test_filter_rest(self):
+        self.client.force_login(self.viewer.user)
+        response = self.client.get(reverse('chaos_dating:filterREST'), {'order_by': 'match'}, secure=True)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(reverse('chaos_dating:filterREST'),
+                                   {'order_by': 'match', 'cursor': response.json()['next_cursor']}, secure=True)
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(DATABASE_REPLICAS=['replica1', 'replica2'])
+class ReplicaRoutingTests(SimpleTestCase):
+    def _request(self, view, cookies=None) -> HttpResponse:
+        request = RequestFactory().get('/')
+        request.COOKIES.update(cookies or {})
+        return db_routing.ReplicaPinningMiddleware(view)(request)
+
+    def _reads(self, write: bool = False, cookies=None, decorate: bool = True):
+        router = db_routing.ReplicaRouter()
+        reads = []
+
+        def view(request):
+            if write:
+                router.db_for_write(models.Profile)
+            reads.extend(router.db_for_read(model) for model in (models.Profile, models.Wish, User))
+            with db_routing.primary():
+                reads.append(router.db_for_read(models.Profile))
+            return HttpResponse()
+
+        response = self._request(db_routing.use_replicas(view) if decorate else view, cookies)
+        return reads, response
+
+    def test_reads_go_to_one_replica(self):
+        reads, response = self._reads()
+        self.assertIn(reads[0], ('replica1', 'replica2'))
+        # users and sessions as well as reads within primary() stay on the primary
+        self.assertEqual(reads, [reads[0], reads[0], None, None])
+        self.assertNotIn(db_routing.PIN_COOKIE, response.cookies)
+
+    def test_undecorated_views_read_from_primary(self):
+        reads, response = self._reads(decorate=False)
+        self.assertEqual(reads, [None, None, None, None])
+
+    def test_writes_pin_to_primary(self):
+        reads, response = self._reads(write=True)
+        self.assertEqual(reads, [None, None, None, None])
+        self.assertEqual(response.cookies[db_routing.PIN_COOKIE]['max-age'], 15)
+
+        reads, response = self._reads(cookies={db_routing.PIN_COOKIE: '1'})
+        self.assertEqual(reads, [None, None, None, None])
+
+
+class AsyncViewTests(ChaosDatingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.profiles = create_profiles(30)
+        self.client.force_login(self.profiles[0].user)
+        self.async_client.force_login(self.profiles[0].user)
+        views = benchmark.async_views(True)
+        views.__enter__()
+        self.addCleanup(views.__exit__, None, None, None)
+
+    async def test_filter_rest_matches_sync_view(self):
+        url = reverse('chaos_dating:filterREST')
+        data = {'order_by': 'age', 'order_direction': '-', 'min_age': 20}
+        response = await self.async_client.get(url, data, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), (await sync_to_async(self._sync_get)(url, data)).json())
+
+        data['cursor'] = response.json()['next_cursor']
+        response = await self.async_client.get(url, data, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.json()['next_cursor'])
+
+        response = await self.async_client.get(url, data, secure=True, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def _sync_get(self, url: str, data: dict):
+        with benchmark.async_views(False):
+            return self.client.get(url, data, secure=True)
+
+    async def test_profile(self):
+        url = reverse('chaos_dating:profile', kwargs={'username': 'user0001'})
+        response = await self.async_client.get(url, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'user0001')
+
+    async def test_server_timing_is_sent_to_staff_only(self):
+        url = reverse('chaos_dating:filterREST')
+        self.assertNotIn('Server-Timing', await self.async_client.get(url, secure=True))
+        await User.objects.filter(pk=self.profiles[0].user.pk).aupdate(is_staff=True)
+        self.assertIn('Server-Timing', await self.async_client.get(url, secure=True))
+
+    async def test_login_required(self):
+        await sync_to_async(self.async_client.logout)()
+        response = await self.async_client.get(reverse('chaos_dating:filterREST'), secure=True)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].startswith(reverse('login')))
+
+
+class MetricsTests(ChaosDatingTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+        self.profiles = create_profiles(5)
+        self.client.force_login(self.profiles[0].user)
+
+    def _filter_rest(self) -> HttpResponse:
+        response = self.client.get(reverse('chaos_dating:filterREST'), {'order_by': 'age'}, secure=True)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_server_timing(self):
+        self.assertNotIn('Server-Timing', self._filter_rest())
+        with override_settings(METRICS_TOKEN='secret'):
+            response = self.client.get(reverse('chaos_dating:filterREST'), {'order_by': 'age'}, secure=True,
+                                       headers={'Authorization': 'Bearer secret'})
+        self.assertIn('Server-Timing', response)
+
+        User.objects.filter(pk=self.profiles[0].user.pk).update(is_staff=True)
+        timing = self._filter_rest()['Server-Timing']
+        self.assertRegex(timing, r'^sql;dur=[\d.]+;desc="[1-9]\d* queries", tpl;dur=[\d.]+, sql-1;dur=[\d.]+, ')
+        self.assertRegex(timing, r'total;dur=[\d.]+$')
+        self.assertNotIn('SELECT', timing)
+
+    def test_timings_of_nested_templates_count_once(self):
+        timings = metrics.Timings()
+        token = metrics._timings.set(timings)
+        try:
+            render_to_string('chaos_dating/profiles.html', {'cards': render_cards(find_profiles().items)})
+        finally:
+            metrics._timings.reset(token)
+        self.assertEqual(timings.render_depth, 0)
+        self.assertGreater(timings.render_time, 0)
+        self.assertGreater(timings.queries, 0)
+
+    @override_settings(METRICS_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_not_timed(self):
+        self.assertNotIn('Server-Timing', self._filter_rest())
+        self.assertNotIn('chaos_dating:filterREST', metrics.exposition())
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_endpoint(self):
+        self._filter_rest()
+        self._filter_rest()
+        self.assertEqual(self.client.get(reverse('metrics'), secure=True).status_code, 401)
+        response = self.client.get(reverse('metrics'), secure=True, headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(response.status_code, 401)
+
+        response = self.client.get(reverse('metrics'), secure=True, headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.content.decode()
+        self.assertIn('# TYPE chaos_dating_request_duration_seconds histogram', text)
+        self.assertIn('chaos_dating_request_duration_seconds_bucket{view="chaos_dating:filterREST",le="+Inf"} 2', text)
+        self.assertIn('chaos_dating_sql_queries_count{view="chaos_dating:filterREST"} 2', text)
+
+    def test_staff_can_read_metrics(self):
+        self.assertEqual(self.client.get(reverse('metrics'), secure=True).status_code, 401)
+        User.objects.filter(pk=self.profiles[0].user.pk).update(is_staff=True)
+        self.assertEqual(self.client.get(reverse('metrics'), secure=True).status_code, 200)
+
+
+class CacheVersionTests(ChaosDatingTestCase):
+    def test_evicted_counters_do_not_return_to_old_versions(self):
+        key = caching.cache_key('test', 'version')
+        first = caching.version(key)
+        self.assertEqual(caching.bump(key), first + 1)
+        cache.delete(key)
+        self.assertGreater(caching.version(key), first + 1)
+
+    def test_cards_are_not_served_from_an_evicted_version(self):
+        profile = create_profiles(1)[0]
+        self.assertIn('user0000', render_cards([profile.pk])[0])
+        models.Profile.objects.filter(pk=profile.pk).update(username='renamed')
+        # the counter is evicted before the bump reaches it
+        cache.delete(cards.profile_version_key(profile.pk))
+        self.assertIn('renamed', render_cards([profile.pk])[0])
+
+    def test_sessions_are_read_from_the_cache(self):
+        user = create_profiles(1)[0].user
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('chaos_dating:filterREST'), secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([query for query in context.captured_queries if 'django_session' in query['sql']])
+
+
+class StaticFilesTests(SimpleTestCase):
+    CSS = 'body { color: #333; }\n' * 100
+
+    def setUp(self):
+        source = tempfile.TemporaryDirectory()
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(source.cleanup)
+        self.addCleanup(root.cleanup)
+        os.mkdir(os.path.join(source.name, 'css'))
+        for name in ('site.css', 'main.css'):
+            with open(os.path.join(source.name, 'css', name), 'w') as file:
+                file.write(self.CSS)
+
+        overrides = override_settings(
+            STATICFILES_DIRS=[source.name],
+            STATICFILES_FINDERS=['django.contrib.staticfiles.finders.FileSystemFinder'],
+            STATIC_ROOT=root.name,
+            STORAGES={'staticfiles': {'BACKEND': 'chaos_dating.assets.CompressedManifestStaticFilesStorage'}},
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        call_command('collectstatic', interactive=False, verbosity=0)
+        self.middleware = assets.StaticFilesMiddleware(lambda request: HttpResponse('view'))
+
+    def _get(self, path: str, **headers) -> HttpResponse:
+        return self.middleware(RequestFactory().get(path, headers=headers))
+
+    def test_fingerprinted_files_are_immutable(self):
+        url = staticfiles_storage.url('css/site.css')
+        self.assertRegex(url, r'^/static/css/site\.[0-9a-f]{12}\.css$')
+        response = self._get(url, **{'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response['Cache-Control'], f'public, max-age={assets.IMMUTABLE_MAX_AGE}, immutable')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(response['Content-Type'], 'text/css; charset=utf-8')
+        self.assertEqual(gzip.decompress(response.content).decode(), self.CSS)
+
+        response = self._get(url, **{'If-None-Match': response['ETag'], 'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 304)
+
+    def test_files_without_fingerprint_are_revalidated(self):
+        response = self._get('/static/css/site.css', **{'Accept-Encoding': 'gzip;q=0'})
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response.content.decode(), self.CSS)
+
+    def test_other_requests_pass(self):
+        self.assertEqual(self._get('/static/css/missing.css').content, b'view')
+        self.assertEqual(self._get('/app/').content, b'view')
+
+    @override_settings(DEBUG=False)
+    def test_pages_render_without_the_vendored_files(self):
+        html = render_to_string('base.html')
+        self.assertRegex(html, r'href="/static/css/main\.[0-9a-f]{12}\.css"')
+        # not collected, so the page falls back to the other copies
+        self.assertIn('src="/static/vendor/jquery.min.js"', html)
+        self.assertIn('window.jQuery || document.write', html)
+
+
+class SearchTests(MatchTestCase):
+    def setUp(self):
+        super().setUp()
+        models.Interest.objects.filter(name='Chess').update(name_de_de='Schach')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice = self._profile('alice', self.woman, self.chess)
+            self.alicia = self._profile('alicia', self.man, self.dating_women)
+            self.bob = self._profile('bob', self.man, self.chess, self.dating_women)
+
+    def _usernames(self, query: str) -> list:
+        return [username for pk, username in search.search_profiles(query, 10)]
+
+    def test_usernames_by_part_prefix_and_typo(self):
+        self.assertEqual(self._usernames('alice'), ['alice'])
+        self.assertEqual(self._usernames('lici'), ['alicia'])
+        self.assertEqual(self._usernames('al'), ['alice', 'alicia'])
+        self.assertEqual(self._usernames('alicee'), ['alice', 'alicia'])
+
+    def test_translated_names(self):
+        self.assertEqual(self._usernames('schach'), ['alice', 'bob'])
+        self.assertEqual(self._usernames('dating woman'), ['alicia', 'bob'])
+
+    def test_signals_keep_the_rows_current(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.wishes.set([self.dating_men])
+        self.assertEqual(self._usernames('schach'), ['bob'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Interest.objects.get(name='Dating').save()
+            self.man.name = 'Gentleman'
+            self.man.save()
+        self.assertEqual(self._usernames('gentleman'), ['alice', 'alicia', 'bob'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chess.delete()
+        self.assertEqual(self._usernames('schach'), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            user = self.bob.user
+            user.username = 'robert'
+            user.save()
+            self.alicia.delete()
+        self.assertEqual(self._usernames('robert'), ['robert'])
+        self.assertEqual(self._usernames('alicia'), ['alice'])
+
+    def test_rebuild(self):
+        models.ProfileSearch.objects.all().delete()
+        self.assertEqual(search.rebuild(), 3)
+        self.assertEqual(self._usernames('schach'), ['alice', 'bob'])
+
+    def test_hidden_profiles_are_left_out_before_the_limit(self):
+        for query in ('al', 'ali', 'alicee'):
+            first, second = search.search_profiles(query, 2)
+            with self.captureOnCommitCallbacks(execute=True):
+                hiding.hide(self.bob.user, models.Profile.objects.get(pk=first[0]))
+            self.assertEqual(search.search_profiles(query, 1, hiding.hidden_profiles(self.bob.user)), [second])
+            with self.captureOnCommitCallbacks(execute=True):
+                hiding.unhide(self.bob.user, models.Profile.objects.get(pk=first[0]))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            hiding.hide(self.alicia.user, self.alice)
+        hidden = hiding.hidden_profiles(self.alicia.user)
+        everyone = [[self.alice.pk, 'alice'], [self.alicia.pk, 'alicia']]
+        self.assertEqual(search.autocomplete('ali')['profiles'], everyone)
+        self.assertEqual(search.autocomplete('ali', hidden)['profiles'], [[self.alicia.pk, 'alicia']])
+        self.assertEqual(search.autocomplete('ali', hiding.hidden_profiles(self.bob.user))['profiles'], everyone)
+
+        # bob blocks alicia, who then no longer finds bob either
+        with self.captureOnCommitCallbacks(execute=True):
+            hiding.hide(self.bob.user, self.alicia, blocked=True)
+        hidden = hiding.hidden_profiles(self.alicia.user)
+        self.assertEqual(self._usernames('bob'), ['bob'])
+        self.assertEqual(search.search_profiles('bob', 10, hidden), [])
+        self.assertEqual(search.search_profiles('chess', 10, hidden), [])
+        visible = models.ProfileSearch.objects.filter(hidden.condition('profile_id', 'profile__user_id'))
+        self.assertEqual(list(visible.values_list('profile_id', flat=True)), [self.alicia.pk])
+
+    def test_autocomplete_api(self):
+        self.client.force_login(self.alice.user)
+        response = self.client.get(reverse('chaos_dating:autocompleteAPI'), {'q': 'ali'}, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['profiles'], [[self.alice.pk, 'alice'], [self.alicia.pk, 'alicia']])
+
+        response = self.client.get(reverse('chaos_dating:autocompleteAPI'), {'q': 'dat'}, secure=True)
+        self.assertEqual(response.json()['profiles'], [])
+        self.assertEqual(response.json()['interests'], [[models.Interest.objects.get(name='Dating').pk, 'Dating']])
+
+        response = self.client.get(reverse('chaos_dating:autocompleteAPI'), {'q': 'dat'}, secure=True,
+                                   headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_search_api(self):
+        self.client.force_login(self.alice.user)
+        response = self.client.get(reverse('chaos_dating:searchAPI'), {'q': 'chess'}, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['profiles'], [[self.alice.pk, 'alice'], [self.bob.pk, 'bob']])
+
+
+class FacetTests(MatchTestCase):
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice = self._profile('alice', self.woman, self.chess)
+            self.bob = self._profile('bob', self.man, self.chess, self.dating_women)
+            self.carol = self._profile('carol', self.woman, self.dating_men)
+            self.carol.age = 50
+            self.carol.save()
+
+    def _counts(self) -> dict:
+        facets.clear_counts()
+        return facets.counts()
+
+    def test_counts_follow_changes(self):
+        self.assertEqual(self._counts(), {
+            'genders': {self.woman.pk: 2, self.man.pk: 1},
+            'wishes':  {self.chess.pk: 2, self.dating_women.pk: 1, self.dating_men.pk: 1},
+            'ages':    {1: 0, 18: 0, 25: 2, 35: 0, 45: 1, 55: 0, 65: 0},
+        })
+
+        bob = models.Profile.objects.get(pk=self.bob.pk)
+        bob.gender = self.woman
+        bob.save()
+        bob.wishes.remove(self.chess)
+        self.dating_men.profile_set.add(self.alice)
+        self.carol.wishes.clear()
+        self.chess.profile_set.clear()
+        models.Profile.objects.only('id').get(pk=self.alice.pk).save()
+        self.assertEqual(self._counts()['genders'], {self.woman.pk: 3})
+        self.assertEqual(self._counts()['wishes'], {self.dating_women.pk: 1, self.dating_men.pk: 1})
+
+        self.carol.user.delete()
+        self.man.delete()
+        self.assertEqual(self._counts()['ages'], {1: 0, 18: 0, 25: 2, 35: 0, 45: 0, 55: 0, 65: 0})
+        self.assertEqual(self._counts()['wishes'], {self.dating_women.pk: 1})
+        self.assertEqual(facets.recount(), {})
+
+    def test_bulk_created_profiles_are_counted(self):
+        bulk.create_profiles([bulk.ProfileRow('dave', 70, self.man.pk, None, frozenset([self.chess.pk]))])
+        self.assertEqual(self._counts()['wishes'][self.chess.pk], 3)
+        self.assertEqual(self._counts()['ages'][65], 1)
+        self.assertEqual(facets.recount(), {})
+
+    def test_recount_corrects_drift(self):
+        models.Profile.objects.filter(pk=self.alice.pk).update(gender=self.man, age=70)
+        out = StringIO()
+        call_command('recount_facets', stdout=out)
+        self.assertIn(f'gender {self.man.pk}: stored 1, counted 2', out.getvalue())
+        self.assertEqual(self._counts()['genders'], {self.woman.pk: 1, self.man.pk: 2})
+        self.assertEqual(self._counts()['ages'][65], 1)
+        self.assertEqual(facets.recount(), {})
+
+    def test_filter_counts_ignore_the_own_selection(self):
+        form = FilterForm({'gender': [self.woman.pk], 'max_age': 40})
+        self.assertTrue(form.is_valid())
+        expected = {
+            'genders': {self.woman.pk: 1, self.man.pk: 1},
+            'wishes':  {self.chess.pk: 1},
+            'ages':    {1: 0, 18: 0, 25: 1, 35: 0, 45: 1, 55: 0, 65: 0},
+        }
+        self.assertEqual(facets.filter_counts(form.cleaned_data), expected)
+        facets.clear_counts()
+        with override_settings(PROFILE_INDEX_ENABLED=False):
+            self.assertEqual(facets.filter_counts(form.cleaned_data), expected)
+
+    def test_facets_api(self):
+        self.client.force_login(self.alice.user)
+        response = self.client.get(reverse('chaos_dating:facetsAPI'), {'wishes': [self.chess.pk]}, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['genders'], {str(self.woman.pk): 1, str(self.man.pk): 1})
+        self.assertEqual(response.json()['ages'][2], [25, 34, 2])
+
+        response = self.client.get(reverse('chaos_dating:facetsAPI'), {'wishes': [self.chess.pk]}, secure=True,
+                                   headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+
+class SavedSearchTests(MatchTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = self._profile('alice', self.woman, self.chess)
+        self.bob = self._profile('bob', self.man, self.chess, self.dating_women)
+        saved_searches.evaluate()
+
+    def _save(self, user: User, data: dict) -> models.SavedSearch:
+        form = FilterForm(data)
+        self.assertTrue(form.is_valid())
+        return saved_searches.save_search(user, 'search', form.cleaned_data)
+
+    def _matches(self, search: models.SavedSearch) -> list:
+        return list(search.matches.order_by('profile__username').values_list('profile__username', flat=True))
+
+    def test_only_changed_profiles_are_evaluated(self):
+        women = self._save(self.bob.user, {'gender': [self.woman.pk], 'max_age': 40})
+        chess = self._save(self.alice.user, {'wishes': [self.chess.pk, self.dating_men.pk], 'wish_match': 'all'})
+        self.assertEqual(saved_searches.evaluate(), (0, 0, 0))
+
+        carol = self._profile('carol', self.woman, self.chess, self.dating_men)
+        dave = self._profile('dave', self.woman)
+        dave.age = 50
+        dave.save()
+        with self.assertNumQueries(10):
+            # numbering in a savepoint, searches, profiles, wishes, matches, marks
+            self.assertEqual(saved_searches.evaluate(), (2, 2, 2))
+        self.assertEqual(self._matches(women), ['carol'])
+        self.assertEqual(self._matches(chess), ['carol'])
+
+        # wish changes count as changes, the own profile never matches
+        self.alice.wishes.add(self.dating_men)
+        self.bob.wishes.add(self.dating_men)
+        self.assertEqual(saved_searches.evaluate(), (2, 2, 2))
+        self.assertEqual(self._matches(women), ['alice', 'carol'])
+        self.assertEqual(self._matches(chess), ['bob', 'carol'])
+        self.assertEqual(saved_searches.evaluate(), (0, 0, 0))
+
+    def test_changes_are_numbered_in_order(self):
+        seq = saved_searches.current_seq()
+        self.alice.save()
+        self.assertIsNone(models.Profile.objects.get(pk=self.alice.pk).change_seq)
+        self.assertEqual(saved_searches.stamp_changes(), seq + 1)
+        self.assertEqual(saved_searches.stamp_changes(), seq + 1)
+
+        models.Profile.objects.get(pk=self.bob.pk).save(update_fields=['age'])
+        self.assertEqual(saved_searches.stamp_changes(), seq + 2)
+        self.assertEqual(models.Profile.objects.get(pk=self.bob.pk).change_seq, seq + 2)
+        self.assertEqual(models.Profile.objects.get(pk=self.alice.pk).change_seq, seq + 1)
+
+    def test_new_matches_are_shown_once(self):
+        self._save(self.bob.user, {'gender': [self.woman.pk]})
+        self._profile('carol', self.woman)
+        out = StringIO()
+        call_command('evaluate_saved_searches', stdout=out)
+        self.assertIn('found 1 matches', out.getvalue())
+
+        self.assertEqual(saved_searches.new_match_count(self.bob.user), 1)
+        self.client.force_login(self.bob.user)
+        response = self.client.get(reverse('chaos_dating:savedSearches'), secure=True)
+        self.assertContains(response, '>carol</a>')
+        response = self.client.get(reverse('chaos_dating:savedSearches'), secure=True)
+        self.assertContains(response, '>carol</a>')
+        last_match = response.context['last_match']
+
+        # a match found after the page was shown stays unseen
+        self._profile('dave', self.woman)
+        saved_searches.evaluate()
+        response = self.client.post(reverse('chaos_dating:markSavedSearchesSeen'), {'last_match': last_match},
+                                    secure=True)
+        self.assertRedirects(response, reverse('chaos_dating:savedSearches'), fetch_redirect_response=False)
+        self.assertEqual(saved_searches.new_match_count(self.bob.user), 1)
+        response = self.client.get(reverse('chaos_dating:savedSearches'), secure=True)
+        self.assertNotContains(response, '>carol</a>')
+        self.assertContains(response, '>dave</a>')
+
+        self.client.post(reverse('chaos_dating:markSavedSearchesSeen'), {'last_match': response.context['last_match']},
+                         secure=True)
+        response = self.client.get(reverse('chaos_dating:savedSearches'), secure=True)
+        self.assertContains(response, 'No new matching profiles.')
+        self.assertNotContains(response, 'Mark all as seen')
+
+    def test_changes_before_saving_are_not_new_matches(self):
+        carol = self._profile('carol', self.woman)
+        self._save(self.bob.user, {'gender': [self.woman.pk]})
+        self.assertEqual(saved_searches.evaluate(), (0, 0, 0))
+
+        carol.save()
+        self.assertEqual(saved_searches.evaluate(), (1, 1, 1))
+
+    def test_save_and_delete_search(self):
+        self.client.force_login(self.alice.user)
+        response = self.client.post(reverse('chaos_dating:saveSearch'), {
+            'name': 'Chess', 'wishes': [self.chess.pk], 'min_age': 20, 'order_by': 'age'
+        }, secure=True)
+        self.assertRedirects(response, reverse('chaos_dating:savedSearches'), fetch_redirect_response=False)
+        search = self.alice.user.saved_searches.get()
+        self.assertEqual(search.query, f'wishes={self.chess.pk}&min_age=20')
+        self.assertEqual(search.last_seq, saved_searches.current_seq())
+
+        self.client.force_login(self.bob.user)
+        response = self.client.post(reverse('chaos_dating:deleteSavedSearch', kwargs={'pk': search.pk}), secure=True)
+        self.assertEqual(response.status_code, 404)
+        self.client.force_login(self.alice.user)
+        self.client.post(reverse('chaos_dating:deleteSavedSearch', kwargs={'pk': search.pk}), secure=True)
+        self.assertFalse(models.SavedSearch.objects.exists())
+
+
+class HidingTests(ChaosDatingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.profiles = create_profiles(45)
+        self.viewer = self.profiles[0].user
+        self.client.force_login(self.viewer)
+
+    def _hide(self, *profiles, blocked: bool = False):
+        with self.captureOnCommitCallbacks(execute=True):
+            for profile in profiles:
+                hiding.hide(self.viewer, profile, blocked=blocked)
+
+    def _all_pages(self, cleaned_data=None) -> list:
+        hidden = hiding.hidden_profiles(self.viewer)
+        ids, cursor = [], None
+        while True:
+            page = find_profiles(cleaned_data, cursor, hidden=hidden)
+            self.assertLessEqual(len(page.items), 20)
+            ids += page.items
+            if page.next_cursor is None:
+                return ids
+            self.assertEqual(len(page.items), 20)
+            cursor = page.next_cursor
+
+    def test_listings_leave_out_hidden_profiles(self):
+        everyone = self._all_pages()
+        hidden = self.profiles[3:30]
+        self._hide(*hidden)
+        expected = [pk for pk in everyone if pk not in {profile.pk for profile in hidden}]
+        self.assertEqual(self._all_pages(), expected)
+
+        listing.clear_results()
+        with override_settings(PROFILE_INDEX_ENABLED=False):
+            self.assertEqual(self._all_pages(), expected)
+
+        form = FilterForm({'order_by': 'match'}, user=self.viewer)
+        self.assertTrue(form.is_valid())
+        matches = self._all_pages(form.cleaned_data)
+        self.assertEqual(sorted(matches), sorted(expected))
+        with override_settings(PROFILE_INDEX_ENABLED=False):
+            listing.clear_results()
+            self.assertEqual(self._all_pages(form.cleaned_data), matches)
+
+    def test_hidden_profiles_cost_no_queries_once_loaded(self):
+        self._hide(*self.profiles[1:3])
+        hiding.hidden_profiles(self.viewer)
+        find_profiles()
+        with self.assertNumQueries(0):
+            hidden = hiding.hidden_profiles(self.viewer)
+            page = find_profiles(hidden=hidden)
+            find_profiles(hidden=hidden)
+        self.assertEqual(hidden.ids, {self.profiles[1].pk, self.profiles[2].pk})
+        self.assertNotIn(self.profiles[1].pk, page.items)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            hiding.unhide(self.viewer, self.profiles[1])
+        self.assertEqual(hiding.hidden_profiles(self.viewer).ids, {self.profiles[2].pk})
+
+    def test_blocking_hides_both_ways(self):
+        blocked = self.profiles[1]
+        self._hide(blocked, blocked=True)
+        self.assertEqual(hiding.hidden_profiles(blocked.user).blocked, {self.profiles[0].pk})
+        self.assertNotIn(blocked.pk, self._all_pages())
+        self.assertNotIn(self.profiles[0].pk, find_profiles(hidden=hiding.hidden_profiles(blocked.user)).items)
+
+        response = self.client.get(reverse('chaos_dating:profile', kwargs={'username': blocked.username}),
+                                   secure=True)
+        self.assertEqual(response.status_code, 404)
+        self.client.force_login(blocked.user)
+        response = self.client.get(reverse('chaos_dating:profile', kwargs={'username': self.viewer.username}),
+                                   secure=True)
+        self.assertEqual(response.status_code, 404)
+
+    def test_views_leave_out_hidden_profiles(self):
+        viewer = self.profiles[0]
+        recommended = self.profiles[1:4]
+        models.Recommendation.objects.bulk_create([
+            models.Recommendation(profile=viewer, recommended=profile, score=1.0, rank=rank)
+            for rank, profile in enumerate(recommended)
+        ])
+        response = self.client.get(reverse('chaos_dating:profilesAPI'), {'fields': 'id'}, secure=True)
+        self.assertIn([self.profiles[2].pk], response.json()['profiles'])
 
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('chaos_dating:hideProfile',
+                                                kwargs={'username': self.profiles[2].username}),
+                                        {'action': 'hide'}, secure=True)
+        self.assertRedirects(response, reverse('chaos_dating:index'), fetch_redirect_response=False)
+        response = self.client.get(reverse('chaos_dating:profilesAPI'), {'fields': 'id'}, secure=True)
+        self.assertNotIn([self.profiles[2].pk], response.json()['profiles'])
+        self.assertEqual(len(response.json()['profiles']), 20)
+        self.assertEqual(matching.recommendations(viewer.pk, hidden=hiding.hidden_profiles(self.viewer)),
+                         [self.profiles[1].pk, self.profiles[3].pk])
 
-# Create your tests here.
+        response = self.client.get(reverse('chaos_dating:hiddenProfiles'), secure=True)
+        self.assertContains(response, self.profiles[2].username)
+        response = self.client.post(reverse('chaos_dating:hideProfile', kwargs={'username': self.viewer.username}),
+                                    {'action': 'block'}, secure=True)
+        self.assertEqual(response.status_code, 400)
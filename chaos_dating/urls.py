@@ -1,14 +1,26 @@
 # coding=utf-8
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
 app_name = 'chaos_dating'
 urlpatterns = [
-    path('', views.index, name='index'),
-    path('users/<str:username>', views.profile, name='profile'),
+    path('', views.index_async if settings.ASYNC_VIEWS else views.index, name='index'),
+    path('users/<str:username>', views.profile_async if settings.ASYNC_VIEWS else views.profile, name='profile'),
+    path('users/<str:username>/hide/', views.hide_profile, name='hideProfile'),
+    path('hidden/', views.hidden_profile_list, name='hiddenProfiles'),
     path('filter/', views.filter, name='filter'),
-    path('rest/filter/', views.filter_rest, name='filterREST'),
+    path('searches/', views.saved_search_list, name='savedSearches'),
+    path('searches/save/', views.save_search, name='saveSearch'),
+    path('searches/seen/', views.mark_saved_searches_seen, name='markSavedSearchesSeen'),
+    path('searches/<int:pk>/delete/', views.delete_saved_search, name='deleteSavedSearch'),
+    path('rest/filter/', views.filter_rest_async if settings.ASYNC_VIEWS else views.filter_rest, name='filterREST'),
+    path('rest/v1/profiles/', views.profiles_api, name='profilesAPI'),
+    path('rest/v1/vocabulary/', views.vocabulary_api, name='vocabularyAPI'),
+    path('rest/v1/search/', views.search_api, name='searchAPI'),
+    path('rest/v1/autocomplete/', views.autocomplete_api, name='autocompleteAPI'),
+    path('rest/v1/facets/', views.facets_api, name='facetsAPI'),
     path('legal-notice/', views.legal, name='legal'),
     path('privacy/', views.privacy, name='privacy'),
 ]
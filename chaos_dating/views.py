@@ -1,24 +1,74 @@
 # coding=utf-8
+import hashlib
+from functools import wraps
+from typing import Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib import messages
+from django.contrib.auth import get_user
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.views import LoginView
+from django.contrib.auth.views import redirect_to_login
 from django.db import transaction
+from django.http import Http404
 from django.http import HttpResponse
+from django.http import QueryDict
+from django.http import HttpResponseNotAllowed
 from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
 from django.shortcuts import redirect
 from django.shortcuts import render
 from django.template.loader import render_to_string
 from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.cache import patch_cache_control
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.utils.http import quote_etag
+from django.utils.translation import get_language
 from django.utils.translation import gettext as _
+from django.views.decorators.http import require_http_methods
 
+from chaos_dating import caching
 from chaos_dating import models
+from chaos_dating import saved_searches
+from chaos_dating.cards import VOCABULARY_VERSION_KEY
+from chaos_dating.cards import arender_cards
+from chaos_dating.cards import render_cards
+from chaos_dating.db_routing import use_replicas
+from chaos_dating.facets import AGE_BUCKETS
+from chaos_dating.facets import filter_counts
 from chaos_dating.forms import FilterForm
 from chaos_dating.forms import ProfileForm
+from chaos_dating.forms import SavedSearchForm
 from chaos_dating.forms import UserForm
+from chaos_dating.hiding import ahidden_profiles
+from chaos_dating.hiding import hidden_profiles
+from chaos_dating.hiding import hide
+from chaos_dating.hiding import unhide
+from chaos_dating.listing import adata_version
+from chaos_dating.listing import afind_profiles
+from chaos_dating.listing import data_version
+from chaos_dating.listing import filter_key
+from chaos_dating.listing import find_profiles
+from chaos_dating.listing import profile_listing
+from chaos_dating.matching import arecommendations
+from chaos_dating.matching import recommendations
+from chaos_dating.metrics import authorized
+from chaos_dating.metrics import exposition
+from chaos_dating.pagination import InvalidCursor
+from chaos_dating.records import PROFILE_FIELDS
+from chaos_dating.records import profile_records
+from chaos_dating.records import vocabulary_tables
+from chaos_dating.search import autocomplete
+from chaos_dating.search import search_profiles
+from chaos_dating.vocabulary import aget_vocabulary
 
 
+@use_replicas
 def index(request) -> HttpResponse:
     context = {
         'site': {
@@ -26,78 +76,371 @@ def index(request) -> HttpResponse:
         }
     }
     if request.user.is_authenticated:
-        profiles = models.Profile.objects.all()
-        context['profiles'] = profiles
+        hidden = hidden_profiles(request.user)
+        page = find_profiles(hidden=hidden)
+        context['cards'] = render_cards(page.items)
+        context['next_cursor'] = page.next_cursor
         context['filter_form'] = FilterForm()
+        context['new_matches'] = saved_searches.new_match_count(request.user)
+        if hasattr(request.user, 'profile'):
+            context['recommendations'] = render_cards(recommendations(request.user.profile.pk, hidden=hidden))
         return render(request, template_name='chaos_dating/home.html', context=context)
     else:
         return render(request, template_name='chaos_dating/landing.html', context=context)
 
 
 @login_required()
+@use_replicas
 def filter(request) -> HttpResponse:
     context = {
         'site': {
             'title': 'Chaos Dating'
         }
     }
+    hidden = hidden_profiles(request.user)
     if request.method == 'POST':
-        form = FilterForm(request.POST)
+        form = FilterForm(request.POST, user=request.user)
         if form.is_valid():
-            cleaned_data = form.cleaned_data
-            profiles = models.Profile.objects.all()
-            if cleaned_data['gender']:
-                profiles = profiles.filter(gender__in=cleaned_data['gender'])
-            if cleaned_data['wishes']:
-                profiles = profiles.filter(wishes__in=cleaned_data['wishes'])
-            if cleaned_data['order_by'] and cleaned_data['order_direction']:
-                sort_order = '-' if cleaned_data['order_direction'] == '-' else ''
-                profiles = profiles.order_by(f"{sort_order}{cleaned_data['order_by']}")
-            if cleaned_data['min_age']:
-                profiles = profiles.filter(age__gte=cleaned_data['min_age'])
-            if cleaned_data['max_age']:
-                profiles = profiles.filter(age__lte=cleaned_data['max_age'])
-            context['profiles'] = profiles
+            page = find_profiles(form.cleaned_data, hidden=hidden)
+            context['cards'] = render_cards(page.items)
+            context['next_cursor'] = page.next_cursor
         
         context['filter_form'] = form
     
     else:
-        profiles = models.Profile.objects.all()
-        context['profiles'] = profiles
+        page = find_profiles(hidden=hidden)
+        context['cards'] = render_cards(page.items)
+        context['next_cursor'] = page.next_cursor
         context['filter_form'] = FilterForm()
         
     return render(request, template_name='chaos_dating/home.html', context=context)
 
 
 @login_required()
-def filter_rest(request) -> JsonResponse:
-    if request.method != 'POST':
-        return JsonResponse({})
+@require_http_methods(['POST'])
+def save_search(request) -> HttpResponse:
+    form = FilterForm(request.POST, user=request.user)
+    search_form = SavedSearchForm(request.POST)
+    if not (form.is_valid() and search_form.is_valid()):
+        messages.error(request, _('The search could not be saved.'))
+    elif request.user.saved_searches.count() >= settings.SAVED_SEARCHES_PER_USER:
+        messages.error(request, _('Delete a saved search first.'))
+    else:
+        saved_searches.save_search(request.user, search_form.cleaned_data['name'], form.cleaned_data)
+        messages.success(request, _('You will be notified of new matching profiles.'))
     
-    form = FilterForm(request.POST)
-    if form.is_valid():
-        cleaned_data = form.cleaned_data
-        profiles = models.Profile.objects.all()
-        if cleaned_data['gender']:
-            profiles = profiles.filter(gender__in=cleaned_data['gender'])
-        if cleaned_data['wishes']:
-            profiles = profiles.filter(wishes__in=cleaned_data['wishes'])
-        if cleaned_data['order_by'] and cleaned_data['order_direction']:
-            sort_order = '-' if cleaned_data['order_direction'] == '-' else ''
-            profiles = profiles.order_by(f"{sort_order}{cleaned_data['order_by']}")
-        if cleaned_data['min_age']:
-            profiles = profiles.filter(age__gte=cleaned_data['min_age'])
-        if cleaned_data['max_age']:
-            profiles = profiles.filter(age__lte=cleaned_data['max_age'])
-        
+    return redirect(reverse('chaos_dating:savedSearches'))
+
+
+@login_required()
+def saved_search_list(request) -> HttpResponse:
+    # a GET only reads, the matches shown are marked as seen by a POST to markSavedSearchesSeen
+    last_match, matches = saved_searches.new_matches(request.user)
+    hidden = hidden_profiles(request.user)
+    searches = list(request.user.saved_searches.all())
+    for search in searches:
+        search.fields = list(QueryDict(search.query).lists())
+        search.cards = render_cards(hidden.visible(matches.get(search.pk, ())))
+    context = {
+        'active': 'saved_searches',
+        'site':   {
+            'title': 'Chaos Dating'
+        },
+        'searches': searches,
+        'last_match': last_match,
+    }
+    
+    return render(request, template_name='chaos_dating/saved_searches.html', context=context)
+
+
+@login_required()
+@require_http_methods(['POST'])
+def mark_saved_searches_seen(request) -> HttpResponse:
+    try:
+        last_match = int(request.POST.get('last_match', ''))
+    except ValueError:
+        return HttpResponse(status=400)
+    
+    saved_searches.mark_seen(request.user, last_match)
+    return redirect(reverse('chaos_dating:savedSearches'))
+
+
+@login_required()
+@require_http_methods(['POST'])
+def delete_saved_search(request, pk: int) -> HttpResponse:
+    get_object_or_404(models.SavedSearch, pk=pk, user=request.user).delete()
+    messages.success(request, _('The search was deleted.'))
+    return redirect(reverse('chaos_dating:savedSearches'))
+
+
+def _filter_etag(cleaned_data: dict, cursor: str, version: int, *extra: str) -> str:
+    key = ':'.join((str(version), get_language(), filter_key(cleaned_data), cursor) + extra)
+    return quote_etag(hashlib.sha1(key.encode()).hexdigest())
+
+
+def _conditional_response(request, etag: str, last_modified: Optional[float], build_response) -> HttpResponse:
+    response = _not_modified(request, etag, last_modified)
+    if response is None:
+        response = build_response()
+        if response.status_code != 200:
+            return response
+
+    return _cache_headers(response, etag, last_modified)
+
+
+def _not_modified(request, etag: str, last_modified: Optional[float]) -> Optional[HttpResponse]:
+    return get_conditional_response(request, etag=etag, last_modified=int(last_modified) if last_modified else None)
+
+
+def _cache_headers(response: HttpResponse, etag: str, last_modified: Optional[float]) -> HttpResponse:
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(int(last_modified))
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ('Accept-Language',))
+    return response
+
+
+@login_required()
+@require_http_methods(['GET', 'HEAD', 'POST'])
+@use_replicas
+def filter_rest(request) -> HttpResponse:
+    data = request.POST if request.method == 'POST' else request.GET
+    form = FilterForm(data, user=request.user)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    cursor = data.get('cursor', '')
+    hidden = hidden_profiles(request.user)
+
+    def build_response():
+        try:
+            page = find_profiles(form.cleaned_data, cursor=cursor, hidden=hidden)
+        except InvalidCursor:
+            return JsonResponse({'errors': {'cursor': [_('Invalid cursor')]}}, status=400)
+
         context = {
-            'profiles': profiles
+            'cards': render_cards(page.items)
         }
-        
         return JsonResponse({
-            'profiles': render_to_string('chaos_dating/profiles.html', context=context, request=request),
+            'profiles':    render_to_string('chaos_dating/profiles.html', context=context, request=request),
+            'next_cursor': page.next_cursor,
+        })
+
+    version, modified = data_version()
+    etag = _filter_etag(form.cleaned_data, cursor, version, str(hidden.version))
+    return _conditional_response(request, etag, modified, build_response)
+
+
+@login_required()
+@require_http_methods(['GET', 'HEAD'])
+@use_replicas
+def profiles_api(request) -> HttpResponse:
+    form = FilterForm(request.GET, user=request.user)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    fields = request.GET.get('fields', ','.join(PROFILE_FIELDS)).split(',')
+    unknown = [field for field in fields if field not in PROFILE_FIELDS]
+    if unknown:
+        return JsonResponse({'errors': {'fields': [_('Unknown fields: %s') % ', '.join(unknown)]}}, status=400)
+
+    cursor = request.GET.get('cursor', '')
+    hidden = hidden_profiles(request.user)
+
+    def build_response():
+        try:
+            page = find_profiles(form.cleaned_data, cursor=cursor, hidden=hidden)
+        except InvalidCursor:
+            return JsonResponse({'errors': {'cursor': [_('Invalid cursor')]}}, status=400)
+
+        return JsonResponse({
+            'fields':             fields,
+            'profiles':           profile_records(page.items, fields),
+            'next_cursor':        page.next_cursor,
+            'vocabulary_version': caching.version(VOCABULARY_VERSION_KEY),
+        }, json_dumps_params={'separators': (',', ':')})
+
+    version, modified = data_version()
+    etag = _filter_etag(form.cleaned_data, cursor, version, ','.join(fields), str(hidden.version))
+    return _conditional_response(request, etag, modified, build_response)
+
+
+@login_required()
+@require_http_methods(['GET', 'HEAD'])
+def vocabulary_api(request) -> HttpResponse:
+    tables = vocabulary_tables()
+    etag = quote_etag(f"{tables['version']}:{get_language()}")
+    return _conditional_response(request, etag, None, lambda: JsonResponse(
+        tables, json_dumps_params={'separators': (',', ':')}
+    ))
+
+
+def _search_etag(query: str, version: int, kind: str, hidden_version: int) -> str:
+    key = ':'.join((kind, str(version), str(hidden_version), get_language(), query))
+    return quote_etag(hashlib.sha1(key.encode()).hexdigest())
+
+
+@login_required()
+@require_http_methods(['GET', 'HEAD'])
+@use_replicas
+def autocomplete_api(request) -> HttpResponse:
+    query = request.GET.get('q', '')
+    hidden = hidden_profiles(request.user)
+    version, modified = data_version()
+
+    def build_response():
+        return JsonResponse(autocomplete(query, hidden), json_dumps_params={'separators': (',', ':')})
+
+    etag = _search_etag(query, version, 'autocomplete', hidden.version)
+    return _conditional_response(request, etag, modified, build_response)
+
+
+@login_required()
+@require_http_methods(['GET', 'HEAD'])
+@use_replicas
+def search_api(request) -> HttpResponse:
+    query = request.GET.get('q', '')
+    hidden = hidden_profiles(request.user)
+    version, modified = data_version()
+    etag = _search_etag(query, version, 'search', hidden.version)
+    return _conditional_response(request, etag, modified, lambda: JsonResponse({
+        'profiles': [list(row) for row in search_profiles(query, settings.PROFILES_PAGE_SIZE, hidden)],
+    }, json_dumps_params={'separators': (',', ':')}))
+
+
+@login_required()
+@require_http_methods(['GET', 'HEAD'])
+@use_replicas
+def facets_api(request) -> HttpResponse:
+    form = FilterForm(request.GET, user=request.user)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    def build_response():
+        counts = filter_counts(form.cleaned_data)
+        return JsonResponse({
+            'genders': counts['genders'],
+            'wishes':  counts['wishes'],
+            'ages':    [[lower, upper, counts['ages'].get(lower, 0)] for lower, upper in AGE_BUCKETS],
+        }, json_dumps_params={'separators': (',', ':')})
+
+    version, modified = data_version()
+    etag = _filter_etag(form.cleaned_data, '', version, 'facets')
+    return _conditional_response(request, etag, modified, build_response)
+
+
+@require_http_methods(['GET', 'HEAD'])
+def metrics(request) -> HttpResponse:
+    if not authorized(request):
+        response = HttpResponse(status=401)
+        response['WWW-Authenticate'] = 'Bearer realm="metrics"'
+        return response
+
+    response = HttpResponse(exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    patch_cache_control(response, private=True, no_store=True)
+    return response
+
+
+# Async versions of the read views, served instead of the sync ones under ASGI, see asgi.py.
+# The session and the user are loaded in a thread once per request; everything else is read
+# with the async cache and ORM APIs, and only cache misses are computed in threads. Templates
+# are rendered on the event loop once the vocabulary they use is loaded.
+
+async def _auser(request):
+    # the lazy request.user would query the database on the event loop
+    user = await sync_to_async(get_user)(request)
+    request.user = user
+    return user
+
+
+def async_login_required(view):
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        user = await _auser(request)
+        if not user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+
+    return wrapper
+
+
+@use_replicas
+async def index_async(request) -> HttpResponse:
+    context = {
+        'site': {
+            'title': 'Chaos Dating'
+        }
+    }
+    user = await _auser(request)
+    await aget_vocabulary()
+    if user.is_authenticated:
+        hidden = await ahidden_profiles(user)
+        page = await afind_profiles(hidden=hidden)
+        context['cards'] = await arender_cards(page.items)
+        context['next_cursor'] = page.next_cursor
+        context['filter_form'] = FilterForm()
+        context['new_matches'] = await sync_to_async(saved_searches.new_match_count)(user)
+        profile_id = await models.Profile.objects.filter(user=user).values_list('pk', flat=True).afirst()
+        if profile_id is not None:
+            context['recommendations'] = await arender_cards(await arecommendations(profile_id, hidden=hidden))
+        return render(request, template_name='chaos_dating/home.html', context=context)
+    else:
+        return render(request, template_name='chaos_dating/landing.html', context=context)
+
+
+@async_login_required
+@use_replicas
+async def filter_rest_async(request) -> HttpResponse:
+    if request.method not in ('GET', 'HEAD', 'POST'):
+        return HttpResponseNotAllowed(['GET', 'HEAD', 'POST'])
+
+    data = request.POST if request.method == 'POST' else request.GET
+    form = FilterForm(data, user=request.user)
+    # unknown choices and the wishes of the viewer may have to be looked up
+    if not await sync_to_async(form.is_valid)():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    cursor = data.get('cursor', '')
+    hidden = await ahidden_profiles(request.user)
+    version, modified = await adata_version()
+    etag = _filter_etag(form.cleaned_data, cursor, version, str(hidden.version))
+    response = _not_modified(request, etag, modified)
+    if response is None:
+        try:
+            page = await afind_profiles(form.cleaned_data, cursor=cursor, hidden=hidden)
+        except InvalidCursor:
+            return JsonResponse({'errors': {'cursor': [_('Invalid cursor')]}}, status=400)
+
+        context = {
+            'cards': await arender_cards(page.items)
+        }
+        response = JsonResponse({
+            'profiles':    render_to_string('chaos_dating/profiles.html', context=context, request=request),
+            'next_cursor': page.next_cursor,
         })
 
+    return _cache_headers(response, etag, modified)
+
+
+@async_login_required
+@use_replicas
+async def profile_async(request, username: str) -> HttpResponse:
+    await aget_vocabulary()
+    profile = await profile_listing().aget(username=username)
+    hidden = await ahidden_profiles(request.user)
+    if profile.pk in hidden.blocked:
+        raise Http404
+    context = {
+        'site': {
+            'title': 'Chaos Dating'
+        },
+        'profile': profile,
+        'hidden':  profile.pk in hidden.ids,
+    }
+
+    return render(request, template_name='chaos_dating/profile.html', context=context)
+
 
 @transaction.atomic
 def register(request) -> HttpResponse:
@@ -142,17 +485,57 @@ def user_login(request) -> HttpResponse:
 
 
 @login_required()
+@use_replicas
 def profile(request, username: str) -> HttpResponse:
+    profile = profile_listing().get(username=username)
+    hidden = hidden_profiles(request.user)
+    if profile.pk in hidden.blocked:
+        raise Http404
     context = {
         'site': {
             'title': 'Chaos Dating'
         },
-        'profile': models.Profile.objects.get(user__username=username)
+        'profile': profile,
+        'hidden':  profile.pk in hidden.ids,
     }
     
     return render(request, template_name='chaos_dating/profile.html', context=context)
 
 
+@login_required()
+@require_http_methods(['POST'])
+def hide_profile(request, username: str) -> HttpResponse:
+    profile = get_object_or_404(models.Profile, username=username)
+    action = request.POST.get('action')
+    if profile.user_id == request.user.pk or action not in ('hide', 'block', 'unhide'):
+        return HttpResponse(status=400)
+    
+    if action == 'unhide':
+        unhide(request.user, profile)
+        messages.success(request, _('%s is shown to you again.') % profile.username)
+        return redirect(reverse('chaos_dating:profile', kwargs={'username': username}))
+    
+    hide(request.user, profile, blocked=action == 'block')
+    if action == 'block':
+        messages.success(request, _('%s is blocked.') % profile.username)
+    else:
+        messages.success(request, _('%s is hidden from you.') % profile.username)
+    return redirect(reverse('chaos_dating:index'))
+
+
+@login_required()
+def hidden_profile_list(request) -> HttpResponse:
+    context = {
+        'active': 'hidden_profiles',
+        'site':   {
+            'title': 'Chaos Dating'
+        },
+        'hidden_profiles': request.user.hidden_profiles.select_related('profile'),
+    }
+    
+    return render(request, template_name='chaos_dating/hidden_profiles.html', context=context)
+
+
 @login_required()
 @transaction.atomic
 def edit_profile(request) -> HttpResponse:
@@ -171,23 +554,7 @@ def edit_profile(request) -> HttpResponse:
     }
     
     if request.method == "POST":
-        post = request.POST.copy()
-        pronoun_input = post['pronoun']
-        gender_input = post['gender']
-        try:
-            int(pronoun_input)
-        except ValueError:
-            pronoun = models.Pronoun(name=pronoun_input)
-            pronoun.save()
-            post['pronoun'] = str(pronoun.id)
-            request.POST = post
-        try:
-            int(gender_input)
-        except ValueError:
-            gender = models.Gender(name=gender_input)
-            gender.save()
-            post['gender'] = str(gender.id)
-            request.POST = post
+        # typed pronouns and genders are resolved and created by the fields of ProfileForm
         if user_form.is_valid() and profile_form.is_valid():
             user_form.save()
             profile = profile_form.save(commit=False)
@@ -0,0 +1,277 @@
+# coding=utf-8
+"""
+Process-local cache of the vocabulary: genders, interests, pronouns and wishes.
+
+These tables are tiny and rarely change, so every process loads them once and serves
+choice lists and labels from memory. Labels are translated by modeltranslation and kept
+per language. The snapshot is replaced when the vocabulary version in the cache changes;
+the signal handlers in ``chaos_dating.signals`` bump it whenever a vocabulary row is
+saved or deleted. Other processes notice the new version within
+``settings.VOCABULARY_CHECK_INTERVAL`` seconds.
+
+Free-text names, e.g. genders and pronouns typed into the profile form, are resolved by
+``resolve()`` against the names in every language before anything is created.
+"""
+import threading
+import time
+from bisect import bisect_left
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Model
+from django.utils.translation import get_language
+from django.utils.translation import gettext as _
+from modeltranslation.settings import AVAILABLE_LANGUAGES
+from modeltranslation.utils import build_localized_fieldname
+
+from chaos_dating import caching
+from chaos_dating import models
+from chaos_dating.cards import VOCABULARY_VERSION_KEY
+from chaos_dating.db_routing import primary
+
+# searched terms whose results every snapshot keeps
+SEARCH_CACHE_SIZE = 1000
+
+
+class Vocabulary:
+    MODELS = (models.Gender, models.Interest, models.Pronoun, models.Wish)
+
+    def __init__(self, instances: Dict[type, Dict[int, Model]], version: int = 0):
+        """
+        :param instances: the instances of every vocabulary model by id
+        :param version: the vocabulary version the instances were loaded at
+        """
+        self.version = version
+        self.checked_at = time.monotonic()
+        self._instances = instances
+        self._labels: Dict[tuple, Dict[int, str]] = {}
+        self._names: Dict[type, Dict[str, int]] = {}
+        self._words: Dict[type, List[Tuple[str, int]]] = {}
+        self._results: Dict[tuple, List[int]] = {}
+
+    @classmethod
+    def build(cls, version: int = 0) -> 'Vocabulary':
+        """
+        Returns a vocabulary containing every row of the vocabulary tables.
+        """
+        return cls({model: {instance.pk: instance for instance in model.objects.order_by('pk')}
+                    for model in cls.MODELS}, version)
+
+    def all(self, model: type) -> List[Model]:
+        return list(self._instances[model].values())
+
+    def get(self, model: type, pk) -> Optional[Model]:
+        """
+        Returns the instance of the model with the id, or None if it is unknown.
+        """
+        try:
+            return self._instances[model].get(int(pk))
+        except (TypeError, ValueError):
+            return None
+
+    def labels(self, model: type) -> Dict[int, str]:
+        """
+        Returns the labels of all instances of the model in the active language by id.
+        """
+        key = (model, get_language())
+        labels = self._labels.get(key)
+        if labels is None:
+            label = self.wish_label if model is models.Wish else str
+            labels = {pk: label(instance) for pk, instance in self._instances[model].items()}
+            self._labels[key] = labels
+
+        return labels
+
+    def label(self, model: type, pk) -> Optional[str]:
+        if pk is None:
+            return None
+        return self.labels(model).get(pk)
+
+    def ids_by_name(self, model: type) -> Dict[str, int]:
+        """
+        Returns the ids of all instances of the model by their normalized name in every language.
+        """
+        names = self._names.get(model)
+        if names is None:
+            names = {}
+            for pk, instance in self._instances[model].items():
+                for name in map(normalize, all_names(instance)):
+                    if name:
+                        names.setdefault(name, pk)
+            self._names[model] = names
+
+        return names
+
+    def _word_index(self, model: type) -> List[Tuple[str, int]]:
+        # the sorted words of the names in every language with the id of their instance;
+        # wishes are found by the names of their interest and gender
+        words = self._words.get(model)
+        if words is None:
+            words = set()
+            for pk, instance in self._instances[model].items():
+                if model is models.Wish:
+                    names = (all_names(self.get(models.Interest, instance.interest_id))
+                             + all_names(self.get(models.Gender, instance.gender_id)))
+                else:
+                    names = all_names(instance)
+                words.update((word, pk) for name in names for word in normalize(name).split())
+            words = sorted(words)
+            self._words[model] = words
+
+        return words
+
+    def _starting_with(self, model: type, prefix: str) -> Set[int]:
+        words = self._word_index(model)
+        ids = set()
+        for index in range(bisect_left(words, (prefix,)), len(words)):
+            word, pk = words[index]
+            if not word.startswith(prefix):
+                break
+            ids.add(pk)
+        return ids
+
+    def search(self, model: type, term: str) -> List[int]:
+        """
+        Returns the ids of the instances of the model with a word of their name in any language
+        starting with every word of the term, by label in the active language; labels starting
+        with the term come first. A blank term returns every instance.
+        """
+        term = normalize(term)
+        key = (model, get_language(), term)
+        ids = self._results.get(key)
+        if ids is None:
+            labels = self.labels(model)
+            matches = set(labels)
+            for word in term.split():
+                matches &= self._starting_with(model, word)
+            folded = {pk: labels[pk].casefold() for pk in matches}
+            ids = sorted(matches, key=lambda pk: (not folded[pk].startswith(term), folded[pk], pk))
+            if len(self._results) >= SEARCH_CACHE_SIZE:
+                self._results.clear()
+            self._results[key] = ids
+
+        return ids
+
+    def wish_label(self, wish: models.Wish) -> str:
+        # wishes missing from the snapshot, e.g. new ones in an open transaction, fall back to their relations
+        interest = self.get(models.Interest, wish.interest_id) or wish.interest
+        if wish.gender_id is None:
+            return f"{interest}"
+
+        gender = self.get(models.Gender, wish.gender_id) or wish.gender
+        return f"{interest} {_('with')} {gender} {_('humans')}"
+
+
+def all_names(instance: Optional[Model]) -> List[str]:
+    """
+    Returns the names of the vocabulary instance in every language, blank where untranslated.
+    """
+    if instance is None:
+        return []
+    fields = ['name'] + [build_localized_fieldname('name', language) for language in AVAILABLE_LANGUAGES]
+    return [getattr(instance, field, None) or '' for field in fields]
+
+
+def normalize(name: str) -> str:
+    """
+    Returns the name without surrounding and repeated whitespace and case-folded, for comparisons.
+    """
+    return ' '.join(str(name).split()).casefold()
+
+
+def resolve_instance(model: type, value: str) -> Optional[Model]:
+    """
+    Returns the instance of the model with the id or name given as value and creates it if it is new.
+
+    Known ids and names cost no queries. A new name is created as typed, with its whitespace
+    normalized, by one atomic get-or-create; concurrent requests creating the same name get
+    the same row. Returns None for blank values.
+    """
+    vocabulary = get_vocabulary()
+    name = ' '.join(str(value).split())
+    if not name:
+        return None
+
+    instance = vocabulary.get(model, name)
+    if instance is not None:
+        return instance
+
+    pk = vocabulary.ids_by_name(model).get(normalize(name))
+    if pk is not None:
+        return vocabulary.get(model, pk)
+
+    if name.isdigit():
+        # an id of a row newer than the vocabulary of this process
+        instance = model.objects.filter(pk=name).first()
+        if instance is not None:
+            return instance
+
+    try:
+        # get_or_create() inserts in a savepoint and fetches the row of a concurrent insert instead
+        instance, created = model.objects.get_or_create(name__iexact=name, defaults={'name': name})
+    except model.MultipleObjectsReturned:
+        instance = model.objects.filter(name__iexact=name).order_by('pk').first()
+
+    return instance
+
+
+def resolve(model: type, value: str) -> Optional[int]:
+    """
+    Returns the id of the instance of the model with the id or name given as value, see ``resolve_instance()``.
+    """
+    instance = resolve_instance(model, value)
+    return instance.pk if instance is not None else None
+
+
+_vocabulary: Optional[Vocabulary] = None
+_vocabulary_lock = threading.Lock()
+
+
+def get_vocabulary(current: bool = False) -> Vocabulary:
+    """
+    Returns the vocabulary of this process and reloads it if the vocabulary version changed.
+
+    The version is looked up at most once per ``settings.VOCABULARY_CHECK_INTERVAL`` seconds, or
+    right away if ``current`` is set, e.g. for tables labelled with the shared version.
+    """
+    global _vocabulary
+    vocabulary = _vocabulary
+    if not current and vocabulary is not None \
+            and time.monotonic() - vocabulary.checked_at < settings.VOCABULARY_CHECK_INTERVAL:
+        return vocabulary
+
+    version = caching.version(VOCABULARY_VERSION_KEY)
+    with _vocabulary_lock:
+        if _vocabulary is None or _vocabulary.version != version:
+            with primary():
+                _vocabulary = Vocabulary.build(version)
+        else:
+            _vocabulary.checked_at = time.monotonic()
+
+        return _vocabulary
+
+
+async def aget_vocabulary() -> Vocabulary:
+    """
+    Async version of ``get_vocabulary()``; only looks the version up in a thread when it is due.
+
+    Templates and forms using the vocabulary query nothing within the check interval after it.
+    """
+    vocabulary = _vocabulary
+    if vocabulary is not None and time.monotonic() - vocabulary.checked_at < settings.VOCABULARY_CHECK_INTERVAL:
+        return vocabulary
+
+    return await sync_to_async(get_vocabulary)()
+
+
+def reset():
+    """
+    Drops the vocabulary of this process; it is reloaded on next use.
+    """
+    global _vocabulary
+    _vocabulary = None
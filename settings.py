@@ -48,8 +48,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chaos_dating.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'chaos_dating.assets.StaticFilesMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'chaos_dating.db_routing.ReplicaPinningMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -61,7 +64,8 @@ ROOT_URLCONF = 'urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # the Django backend timing the rendering, see chaos_dating.metrics
+        'BACKEND': 'chaos_dating.metrics.DjangoTemplates',
         'DIRS': [
             os.path.join(BASE_DIR, "templates"),
         ],
@@ -80,6 +84,8 @@ TEMPLATES = [
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
 WSGI_APPLICATION = 'wsgi.application'
+# serve the async versions of the read views, set by asgi.py
+ASYNC_VIEWS = os.environ.get('DJANGO_ASYNC_VIEWS', 'False') == 'True'
 
 
 # Database
@@ -87,12 +93,85 @@ WSGI_APPLICATION = 'wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'ENGINE':             os.environ.get('DJANGO_DB_ENGINE', 'django.db.backends.sqlite3'),
+        'NAME':               os.environ.get('DJANGO_DB_NAME', os.path.join(BASE_DIR, 'db.sqlite3')),
+        'USER':               os.environ.get('DJANGO_DB_USER', ''),
+        'PASSWORD':           os.environ.get('DJANGO_DB_PASSWORD', ''),
+        'HOST':               os.environ.get('DJANGO_DB_HOST', ''),
+        'PORT':               os.environ.get('DJANGO_DB_PORT', ''),
+        # persistent connections, checked before they are reused by a new request
+        'CONN_MAX_AGE':       int(os.environ.get('DJANGO_DB_CONN_MAX_AGE', '60')),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
 
+def _replica(location: str) -> dict:
+    # SQLite replicas are other files, the others other servers given as host[:port]
+    replica = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+    if replica['ENGINE'] == 'django.db.backends.sqlite3':
+        replica['NAME'] = location
+    else:
+        host, port = location.partition(':')[::2]
+        replica['HOST'], replica['PORT'] = host, port or replica['PORT']
+    return replica
+
+
+# comma separated read replicas of the default database, see chaos_dating.db_routing
+for _number, _location in enumerate(filter(None, os.environ.get('DJANGO_DB_REPLICAS', '').split(',')), 1):
+    DATABASES[f'replica{_number}'] = _replica(_location.strip())
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['chaos_dating.db_routing.ReplicaRouter']
+# seconds a browser reads from the primary after it wrote, longer than the replication lag
+DATABASE_REPLICA_PIN_SECONDS = 15
+
+
+# Caches
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+_CACHE_BACKENDS = {
+    'locmem':    'django.core.cache.backends.locmem.LocMemCache',
+    'file':      'django.core.cache.backends.filebased.FileBasedCache',
+    'memcached': 'django.core.cache.backends.memcached.PyMemcacheCache',
+    'redis':     'django.core.cache.backends.redis.RedisCache',
+    'rediss':    'django.core.cache.backends.redis.RedisCache',
+}
+
+
+def _cache(url: str) -> dict:
+    # locmem://, file:///path, memcached://host:port[,host:port] or redis://host:port/db
+    scheme, location = url.partition('://')[::2]
+    cache = {
+        'BACKEND':    _CACHE_BACKENDS[scheme],
+        'LOCATION':   url if scheme.startswith('redis') else location.split(',') if scheme == 'memcached' else location,
+        'KEY_PREFIX': os.environ.get('DJANGO_CACHE_KEY_PREFIX', ''),
+        # raise to drop every cached entry at once, see chaos_dating.caching
+        'VERSION':    int(os.environ.get('DJANGO_CACHE_VERSION', '1')),
+    }
+    if scheme in ('locmem', 'file'):
+        # the default of 300 entries would not even hold the cards of a few list pages
+        cache['OPTIONS'] = {'MAX_ENTRIES': int(os.environ.get('DJANGO_CACHE_MAX_ENTRIES', '50000'))}
+    return cache
+
+
+# processes share invalidations only through a shared cache, locmem:// is for a single process
+CACHES = {
+    'default': _cache(os.environ.get('DJANGO_CACHE_URL', 'locmem://')),
+    # the AJAX widgets of django-select2 registered by rendered forms, kept while their pages are open
+    'select2': dict(_cache(os.environ.get('DJANGO_CACHE_URL', 'locmem://')), TIMEOUT=60 * 60 * 24),
+}
+SELECT2_CACHE_BACKEND = 'select2'
+# select2 from the copy of django.contrib.admin, collected and fingerprinted like the other static files
+SELECT2_JS = ['admin/js/vendor/select2/select2.full.min.js']
+SELECT2_CSS = ['admin/css/vendor/select2/select2.min.css']
+SELECT2_I18N_PATH = 'admin/js/vendor/select2/i18n'
+
+# sessions are read from the cache and written through to the database, set
+# DJANGO_SESSION_ENGINE=signed_cookies to keep them in the cookie instead
+SESSION_ENGINE = 'django.contrib.sessions.backends.' + os.environ.get('DJANGO_SESSION_ENGINE', 'cached_db')
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -143,9 +222,50 @@ STATIC_URL = '/static/'
 STATICFILES_DIRS = [
     os.path.join(BASE_DIR, "static"),
 ]
+# collectstatic writes the fingerprinted and compressed files here, see chaos_dating.assets
+STATIC_ROOT = os.environ.get('DJANGO_STATIC_ROOT', os.path.join(BASE_DIR, 'staticfiles'))
+# seconds browsers cache static files requested without fingerprint
+STATIC_MAX_AGE = 60
+
+STORAGES = {
+    'default':     {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    # the manifest only exists after collectstatic, the development server serves the sources
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage' if DEBUG
+        else 'chaos_dating.assets.CompressedManifestStaticFilesStorage',
+    },
+}
 
 # Security settings
 SECURE_SSL_REDIRECT = not DEBUG
 SESSION_COOKIE_SECURE = not DEBUG
 CSRF_COOKIE_SECURE = not DEBUG
 SECURE_REFERRER_POLICY = 'same-origin'
+
+# Profile listings
+PROFILES_PAGE_SIZE = 20
+# answer profile listings from the in-process index in chaos_dating.profile_index
+PROFILE_INDEX_ENABLED = True
+# seconds a rendered profile card stays in the cache, see chaos_dating.cards
+PROFILE_CARD_TIMEOUT = 60 * 60 * 24
+# process-local cache of profile list pages, see chaos_dating.listing
+PROFILE_RESULTS_CACHE_SIZE = 1024
+PROFILE_RESULTS_CACHE_TIMEOUT = 60
+# match recommendations, see chaos_dating.matching
+RECOMMENDATIONS_COUNT = 8
+# saved filters with notifications of new matches, see chaos_dating.saved_searches
+SAVED_SEARCHES_PER_USER = 20
+# suggestions per kind of the autocomplete API, see chaos_dating.search
+AUTOCOMPLETE_COUNT = 8
+# seconds between checks for vocabulary changes made by other processes, see chaos_dating.vocabulary
+VOCABULARY_CHECK_INTERVAL = 5
+# per-request timings, see chaos_dating.metrics
+METRICS_SAMPLE_RATE = float(os.environ.get('DJANGO_METRICS_SAMPLE_RATE', '1'))
+METRICS_SERVER_TIMING = True
+METRICS_SLOWEST_QUERIES = 3
+# requests taking longer log their slowest queries
+METRICS_SLOW_REQUEST_SECONDS = 1.0
+# bearer token of the Prometheus scraper, staff users can read /metrics with their session
+METRICS_TOKEN = os.environ.get('DJANGO_METRICS_TOKEN', '')
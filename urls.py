@@ -14,6 +14,7 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import include
 from django.urls import path
@@ -24,5 +25,6 @@ urlpatterns = [
     path('app/', include('chaos_dating.urls')),
     path('accounts/', include('chaos_dating.account_urls')),
     path('select2/', include('django_select2.urls')),
-    path('', views.index)
+    path('metrics', views.metrics, name='metrics'),
+    path('', views.index_async if settings.ASYNC_VIEWS else views.index)
 ]